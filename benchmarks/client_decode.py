@@ -0,0 +1,112 @@
+"""Micro-benchmark of the client's decode path on full-market snapshots"""
+import argparse
+import random
+import time
+from tse_utils.tsetmc import MarketWatchTradeData, MarketWatchClientTypeData
+from tsetmc_pusher.client import TsetmcClient, TsetmcClientSubscription
+from tsetmc_pusher.server.repository import MarketRealtimeData
+from tsetmc_pusher.server.websocket import PayloadCache
+from tsetmc_pusher.wire import WireFormat
+
+
+def market_watch_row(index: int, rand: random.Random) -> dict:
+    """Builds a raw market watch row for a synthetic instrument"""
+    return {
+        "insCode": str(1000 + index),
+        "insID": f"IRO1{index:08d}",
+        "lva": f"T{index}",
+        "lvc": f"Instrument {index}",
+        "ztd": 1000,
+        "bv": 1,
+        "eps": 1,
+        "pMax": 11000,
+        "pMin": 9000,
+        "py": 10000,
+        "pf": rand.randint(9000, 11000),
+        "pcl": rand.randint(9000, 11000),
+        "pdv": rand.randint(9000, 11000),
+        "pmx": 11000,
+        "pmn": 9000,
+        "qtc": rand.randint(1, 10**12),
+        "qtj": rand.randint(1, 10**8),
+        "ztt": rand.randint(1, 10**4),
+        "hEven": rand.randint(9, 12) * 10000
+        + rand.randint(0, 59) * 100
+        + rand.randint(0, 59),
+        "blDs": [
+            {
+                "zmd": rand.randint(1, 99),
+                "qmd": rand.randint(1, 10**6),
+                "pmd": 10000 - row,
+                "zmo": rand.randint(1, 99),
+                "qmo": rand.randint(1, 10**6),
+                "pmo": 10001 + row,
+                "rid": row,
+            }
+            for row in range(5)
+        ],
+    }
+
+
+def client_type_row(index: int, rand: random.Random) -> dict:
+    """Builds a raw client type row for a synthetic instrument"""
+    return {
+        "insCode": str(1000 + index),
+        "buy_I_Volume": rand.randint(1, 10**8),
+        "buy_N_Volume": rand.randint(1, 10**8),
+        "buy_CountI": rand.randint(1, 10**3),
+        "buy_CountN": rand.randint(1, 10**4),
+        "sell_I_Volume": rand.randint(1, 10**8),
+        "sell_N_Volume": rand.randint(1, 10**8),
+        "sell_CountI": rand.randint(1, 10**3),
+        "sell_CountN": rand.randint(1, 10**4),
+    }
+
+
+def full_market_snapshot(instruments: int, wire_format: WireFormat) -> str | bytes:
+    """Encodes a full-market snapshot the way the server sends it"""
+    rand = random.Random(0)
+    market_realtime_data = MarketRealtimeData()
+    market_realtime_data.apply_new_trade_data(
+        [MarketWatchTradeData(market_watch_row(x, rand)) for x in range(instruments)]
+    )
+    market_realtime_data.apply_new_client_type(
+        [
+            MarketWatchClientTypeData(client_type_row(x, rand))
+            for x in range(instruments)
+        ]
+    )
+    return PayloadCache(market_realtime_data).global_snapshot("all", wire_format)
+
+
+def measure(snapshot: str | bytes, repeat: int) -> float:
+    """Returns the number of snapshots a global subscriber decodes per second"""
+    client = TsetmcClient(
+        websocket_host="localhost",
+        websocket_port=0,
+        subscription=TsetmcClientSubscription(global_subscriber=True),
+    )
+    client.process_message(snapshot)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        client.process_message(snapshot)
+    return repeat / (time.perf_counter() - start)
+
+
+def main():
+    """Runs the benchmark for every wire format"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--instruments", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+    for wire_format in WireFormat:
+        snapshot = full_market_snapshot(args.instruments, wire_format)
+        rate = measure(snapshot, args.repeat)
+        print(
+            f"{wire_format.value:>6}: {len(snapshot):>9} bytes, "
+            f"{rate:>8.1f} messages/s, {rate * args.instruments:>10.0f} instruments/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+"""
+Benchmark suite of the repository diffing, serialization and fan-out hot paths, \
+writing machine-readable results that can be compared across commits
+Run from the repository root, e.g. to compare with an earlier run:
+PYTHONPATH=. python benchmarks/hot_paths.py --output new.json --baseline old.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Callable
+from tse_utils.tsetmc import MarketWatchTradeData, MarketWatchClientTypeData
+from client_decode import (
+    client_type_row,
+    full_market_snapshot,
+    market_watch_row,
+    measure as measure_decode,
+)
+from tsetmc_pusher.server.repository import MarketRealtimeData, MarketUpdateBatch
+from tsetmc_pusher.server.websocket import (
+    PayloadCache,
+    TsetmcWebsocket,
+    TsetmcWebsocketSettings,
+    instrument_data_all,
+    instrument_data_clienttype,
+    instrument_data_orderbook,
+    instrument_data_thresholds,
+    instrument_data_trade,
+)
+from tsetmc_pusher.wire import WireFormat
+
+
+class FakeConnection:  # pylint: disable=too-few-public-methods
+    """Stands in for a websocket connection, counting what is sent to it"""
+
+    def __init__(self, index: int):
+        self.id: str = f"client-{index}"  # pylint: disable=invalid-name
+        self.frames: int = 0
+        self.sent_bytes: int = 0
+
+    async def send(self, payload: str | bytes) -> None:
+        """Counts a sent frame"""
+        self.frames += 1
+        self.sent_bytes += len(payload)
+
+
+def trade_cycles(instruments: int) -> list[list[MarketWatchTradeData]]:
+    """Builds two market watch responses differing in every instrument"""
+    return [
+        [
+            MarketWatchTradeData(market_watch_row(x, random.Random(seed * 10**6 + x)))
+            for x in range(instruments)
+        ]
+        for seed in (1, 2)
+    ]
+
+
+def client_type_cycles(instruments: int) -> list[list[MarketWatchClientTypeData]]:
+    """Builds two client type responses differing in every instrument"""
+    return [
+        [
+            MarketWatchClientTypeData(
+                client_type_row(x, random.Random(seed * 10**6 + x))
+            )
+            for x in range(instruments)
+        ]
+        for seed in (1, 2)
+    ]
+
+
+DISPATCHERS: dict[MarketRealtimeData, asyncio.Task] = {}
+
+
+async def new_repository(instruments: int) -> MarketRealtimeData:
+    """Builds a repository dispatching to no-op pushers on the running loop"""
+    market_realtime_data = MarketRealtimeData()
+    market_realtime_data.attach_event_loop(asyncio.get_running_loop())
+    DISPATCHERS[market_realtime_data] = asyncio.create_task(
+        market_realtime_data.dispatch_updates()
+    )
+    trade, client_type = trade_cycles(instruments), client_type_cycles(instruments)
+    market_realtime_data.apply_new_trade_data(trade[0])
+    market_realtime_data.apply_new_client_type(client_type[0])
+    await asyncio.sleep(0)
+    return market_realtime_data
+
+
+async def release_repository(market_realtime_data: MarketRealtimeData) -> None:
+    """Stops the dispatching of a repository built for a benchmark"""
+    dispatcher = DISPATCHERS.pop(market_realtime_data)
+    dispatcher.cancel()
+    await asyncio.gather(dispatcher, return_exceptions=True)
+    market_realtime_data.detach_event_loop()
+
+
+async def measure(
+    func: Callable[[int], object], repeat: int, settle: bool = True
+) -> list[float]:
+    """Times each call of a function, letting the loop dispatch between calls"""
+    timings = []
+    for iteration in range(repeat):
+        start = time.perf_counter()
+        func(iteration)
+        timings.append(time.perf_counter() - start)
+        if settle:
+            await asyncio.sleep(0)
+    return timings
+
+
+def result(timings: list[float], operations: int, **params) -> dict:
+    """Summarizes the timings of a benchmark"""
+    median = statistics.median(timings)
+    return {
+        "params": params,
+        "median_seconds": median,
+        "min_seconds": min(timings),
+        "operations_per_second": operations / median if median else None,
+    }
+
+
+async def bench_repository(size: int, repeat: int) -> dict[str, dict]:
+    """Benchmarks applying changed and unchanged cycles to the repository"""
+    market_realtime_data = await new_repository(size)
+    trade, client_type = trade_cycles(size), client_type_cycles(size)
+    timings = {
+        "apply_new_trade_data/changed": await measure(
+            lambda x: market_realtime_data.apply_new_trade_data(trade[x % 2]), repeat
+        ),
+        "apply_new_trade_data/unchanged": await measure(
+            lambda x: market_realtime_data.apply_new_trade_data(trade[1]), repeat
+        ),
+        "apply_new_client_type/changed": await measure(
+            lambda x: market_realtime_data.apply_new_client_type(client_type[x % 2]),
+            repeat,
+        ),
+    }
+    await release_repository(market_realtime_data)
+    return {
+        f"{name}/{size}": result(x, size, instruments=size)
+        for name, x in timings.items()
+    }
+
+
+async def bench_serializers(size: int, repeat: int) -> dict[str, dict]:
+    """Benchmarks the channel data serializers over a whole market"""
+    market_realtime_data = await new_repository(size)
+    instruments = market_realtime_data.get_all_instruments()
+    await release_repository(market_realtime_data)
+    results = {}
+    for serializer in (
+        instrument_data_thresholds,
+        instrument_data_trade,
+        instrument_data_orderbook,
+        instrument_data_clienttype,
+        instrument_data_all,
+    ):
+        results[f"{serializer.__name__}/{size}"] = result(
+            await measure(
+                lambda x, y=serializer: [y(z) for z in instruments], repeat, False
+            ),
+            size,
+            instruments=size,
+        )
+    return results
+
+
+async def bench_global_subscription(size: int, repeat: int) -> dict[str, dict]:
+    """Benchmarks answering 1.all.* with and without an already encoded snapshot"""
+    market_realtime_data = await new_repository(size)
+    websocket = TsetmcWebsocket(market_realtime_data, "localhost", 0)
+    client = FakeConnection(0)
+    websocket.open_session(client)
+
+    def subscribe(message: str, cold: bool) -> None:
+        if cold:
+            websocket.payload_cache = PayloadCache(market_realtime_data)
+        websocket.handle_connection_message(client, message)
+
+    results = {}
+    for wire_format in WireFormat:
+        for cold in (True, False):
+            timings = await measure(
+                lambda x, y=f"1.all.*.format={wire_format.value}", z=cold: subscribe(
+                    y, z
+                ),
+                repeat,
+                False,
+            )
+            state = "cold" if cold else "cached"
+            results[
+                f"handle_connection_message/{state}/{wire_format.value}/{size}"
+            ] = result(timings, 1, instruments=size)
+    websocket.close_session(client)
+    await release_repository(market_realtime_data)
+    return results
+
+
+async def bench_broadcast(
+    market_realtime_data: MarketRealtimeData,
+    count: int,
+    batch_frames: bool,
+    repeat: int,
+) -> dict[str, dict]:
+    """Benchmarks fanning trade updates out to in-process clients until delivered"""
+    instruments = market_realtime_data.get_all_instruments()
+    websocket = TsetmcWebsocket(
+        market_realtime_data,
+        "localhost",
+        0,
+        TsetmcWebsocketSettings(batch_frames=batch_frames),
+    )
+    clients = [FakeConnection(x) for x in range(count)]
+    for client in clients:
+        websocket.open_session(client)
+        websocket.handle_connection_message(client, "1.trade.*")
+    await asyncio.sleep(0.01)
+    frames = 1 if batch_frames else len(instruments)
+    timings = []
+    for _ in range(repeat):
+        expected = [x.frames + frames for x in clients]
+        start = time.perf_counter()
+        if batch_frames:
+            await websocket.pusher_batch_data(MarketUpdateBatch(trade=instruments))
+        else:
+            await websocket.pusher_trade_data(instruments)
+        while any(x.frames < y for x, y in zip(clients, expected)) and any(
+            websocket.client_queue_depths().values()
+        ):
+            await asyncio.sleep(0)
+        timings.append(time.perf_counter() - start)
+    for client in clients:
+        websocket.remove_from_channels(client)
+        websocket.close_session(client)
+    mode = "batch" if batch_frames else "per_update"
+    return {
+        f"broadcast/{mode}/{count}": result(
+            timings, count * len(instruments), clients=count, updates=len(instruments)
+        )
+    }
+
+
+def bench_client_decode(size: int, repeat: int) -> dict[str, dict]:
+    """Benchmarks a global subscriber decoding full-market snapshots"""
+    results = {}
+    for wire_format in WireFormat:
+        snapshot = full_market_snapshot(size, wire_format)
+        results[f"process_message/{wire_format.value}/{size}"] = result(
+            [1 / measure_decode(snapshot, 1) for _ in range(repeat)],
+            size,
+            instruments=size,
+            frame_bytes=len(snapshot),
+        )
+    return results
+
+
+def git_commit() -> str:
+    """Returns the commit being benchmarked, if known"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Prints the change of every benchmark and returns the regressed ones"""
+    regressions = []
+    for name, current in results["benchmarks"].items():
+        previous = baseline["benchmarks"].get(name)
+        if not previous:
+            continue
+        ratio = current["median_seconds"] / previous["median_seconds"]
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<55} {ratio:>6.2f}x{flag}")
+    return regressions
+
+
+async def run(args: argparse.Namespace) -> dict:
+    """Runs the selected benchmarks"""
+    sizes = [int(x) for x in args.sizes.split(",")]
+    client_counts = [int(x) for x in args.clients.split(",")]
+    benchmarks = {}
+    for size in sizes:
+        if "repository" in args.only:
+            benchmarks |= await bench_repository(size, args.repeat)
+        if "subscription" in args.only:
+            benchmarks |= await bench_global_subscription(size, args.repeat)
+    if "serializers" in args.only:
+        benchmarks |= await bench_serializers(sizes[0], args.repeat)
+    if "broadcast" in args.only:
+        market_realtime_data = await new_repository(args.updates)
+        for count in client_counts:
+            for batch_frames in (False, True):
+                benchmarks |= await bench_broadcast(
+                    market_realtime_data, count, batch_frames, args.repeat
+                )
+        await release_repository(market_realtime_data)
+    if "client" in args.only:
+        benchmarks |= bench_client_decode(sizes[0], args.repeat)
+    return {
+        "commit": git_commit(),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "benchmarks": benchmarks,
+    }
+
+
+def main():
+    """Runs the suite, writes its results and compares them to a baseline"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1000,5000,10000")
+    parser.add_argument("--clients", default="10,100,1000")
+    parser.add_argument("--updates", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--only",
+        default="repository,serializers,subscription,broadcast,client",
+        help="comma separated groups to run",
+    )
+    parser.add_argument("--output", help="file to write the results to")
+    parser.add_argument("--baseline", help="results of an earlier run to compare to")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+    results = asyncio.run(run(args))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output)
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,23 +2,34 @@
 import os
 import asyncio
 import logging
+import multiprocessing
 from logging.handlers import TimedRotatingFileHandler
 from dotenv import load_dotenv
+from tsetmc_pusher.server.fanout import FanoutWorker
 from tsetmc_pusher.server.operation import TsetmcOperator
+from tsetmc_pusher.server.relay import TsetmcRelay
+from tsetmc_pusher.server.scheduler import CrawlSchedulerSettings
+from tsetmc_pusher.server.websocket import TsetmcWebsocketSettings
 from tsetmc_pusher.timing import sleep_until_tomorrow
 
 load_dotenv()
 
 WEBSOCKET_HOST = os.getenv("WEBSOCKET_HOST")
 WEBSOCKET_PORT = int(os.getenv("WEBSOCKET_PORT"))
+WEBSOCKET_WORKERS = int(os.getenv("WEBSOCKET_WORKERS", "0"))
+FANOUT_SOCKET_PATH = os.getenv("FANOUT_SOCKET_PATH", "/tmp/tsetmc_pusher.sock")
+JOURNAL_DIRECTORY = os.getenv("JOURNAL_DIRECTORY")
+UPSTREAM_HOST = os.getenv("UPSTREAM_HOST")
+UPSTREAM_PORT = int(os.getenv("UPSTREAM_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
 
 
-async def main():
-    """Manually testing the pusher"""
+def setup_logging(log_file_path: str = "logs/log_") -> None:
+    """Logs to the console and to a daily rotated file"""
     logger = logging.getLogger("tsetmc_pusher")
     formatter = logging.Formatter("%(asctime)s | %(name)s | %(levelname)s: %(message)s")
     logger.setLevel(logging.INFO)
-    log_file_path = "logs/log_"
     os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
     file_handler = TimedRotatingFileHandler(
         filename=log_file_path, when="midnight", backupCount=30
@@ -33,9 +44,67 @@ async def main():
     stream_handler.setFormatter(formatter)
     logger.addHandler(stream_handler)
 
+
+async def operate_worker(worker_id: int) -> None:
+    """Serves the websocket clients from the updates published by the crawler"""
+    worker = FanoutWorker(
+        socket_path=FANOUT_SOCKET_PATH,
+        websocket_host=WEBSOCKET_HOST,
+        websocket_port=WEBSOCKET_PORT,
+        websocket_settings=TsetmcWebsocketSettings(single_loop_dispatch=True),
+    )
+    if METRICS_PORT:
+        # Each worker has its own metrics, on the ports after the crawler's
+        worker.expose_metrics(METRICS_HOST, METRICS_PORT + 1 + worker_id)
+    while True:
+        await worker.perform_daily()
+        await sleep_until_tomorrow()
+
+
+def run_worker(worker_id: int) -> None:
+    """Runs a websocket worker in its own process"""
+    setup_logging(f"logs/worker_{worker_id}_log_")
+    asyncio.run(operate_worker(worker_id))
+
+
+async def operate_relay() -> None:
+    """Serves the websocket clients from the data of an upstream pusher"""
+    relay = TsetmcRelay(
+        upstream_host=UPSTREAM_HOST,
+        upstream_port=UPSTREAM_PORT,
+        websocket_host=WEBSOCKET_HOST,
+        websocket_port=WEBSOCKET_PORT,
+        websocket_settings=TsetmcWebsocketSettings(single_loop_dispatch=True),
+    )
+    if METRICS_PORT:
+        relay.expose_metrics(METRICS_HOST, METRICS_PORT)
+    while True:
+        await relay.perform_daily()
+        await sleep_until_tomorrow()
+
+
+async def main():
+    """Manually testing the pusher"""
+    setup_logging()
+    if UPSTREAM_HOST:
+        await operate_relay()
+        return
     operator = TsetmcOperator(
-        websocket_host=WEBSOCKET_HOST, websocket_port=WEBSOCKET_PORT
+        websocket_host=WEBSOCKET_HOST,
+        websocket_port=WEBSOCKET_PORT,
+        websocket_settings=TsetmcWebsocketSettings(single_loop_dispatch=True),
+        crawl_settings=CrawlSchedulerSettings(incremental_market_watch=True),
     )
+    if JOURNAL_DIRECTORY:
+        operator.journal_to(JOURNAL_DIRECTORY)
+    if METRICS_PORT:
+        operator.expose_metrics(METRICS_HOST, METRICS_PORT)
+    if WEBSOCKET_WORKERS:
+        operator.publish_to_workers(FANOUT_SOCKET_PATH)
+        for worker_id in range(WEBSOCKET_WORKERS):
+            multiprocessing.Process(
+                target=run_worker, args=(worker_id,), daemon=True
+            ).start()
     while True:
         await operator.perform_daily()
         await sleep_until_tomorrow()
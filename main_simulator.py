@@ -0,0 +1,75 @@
+"""Runs the pusher against a simulated TSETMC for offline load tests"""
+import argparse
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from tsetmc_pusher.server.operation import TsetmcOperator
+from tsetmc_pusher.server.scheduler import CrawlSchedulerSettings
+from tsetmc_pusher.server.simulator import (
+    JournalReplayTsetmc,
+    SyntheticMarketSettings,
+    SyntheticTsetmc,
+)
+from tsetmc_pusher.server.websocket import TsetmcWebsocketSettings
+
+
+async def main(args: argparse.Namespace):
+    """Serves the simulated market for the given duration"""
+    logging.basicConfig(
+        level=logging.WARNING,
+        format="%(asctime)s | %(name)s | %(levelname)s: %(message)s",
+    )
+    if args.replay:
+        scraper = JournalReplayTsetmc(args.replay, speed=args.speed)
+    else:
+        scraper = SyntheticTsetmc(
+            SyntheticMarketSettings(
+                instruments=args.instruments,
+                tick_rate=args.tick_rate,
+                orderbook_churn=args.orderbook_churn,
+                speed=args.speed,
+                seed=args.seed,
+            )
+        )
+    operator = TsetmcOperator(
+        websocket_host=args.host,
+        websocket_port=args.port,
+        websocket_settings=TsetmcWebsocketSettings(single_loop_dispatch=True),
+        crawl_settings=CrawlSchedulerSettings(
+            incremental_market_watch=True,
+            parse_in_process_pool=args.pooled,
+        ),
+        scraper=scraper,
+    )
+    if args.journal:
+        operator.journal_to(args.journal)
+    if args.metrics_port:
+        operator.expose_metrics(args.host, args.metrics_port)
+    await operator.market_time_operations(
+        end_time=datetime.now() + timedelta(seconds=args.duration)
+    )
+    if operator.journal:
+        operator.journal.close()
+    print(
+        f"{scraper.requests} requests served, "
+        f"repository version advanced to {operator.market_realtime_date.version}"
+    )
+    for name, state in operator.crawl_state().items():
+        print(f"{name}: {state}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--instruments", type=int, default=1000)
+    parser.add_argument("--tick-rate", type=float, default=50.0)
+    parser.add_argument("--orderbook-churn", type=float, default=200.0)
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replay", help="journal file to replay instead")
+    parser.add_argument("--journal", help="directory to journal the changes in")
+    parser.add_argument("--pooled", action="store_true")
+    parser.add_argument("--metrics-port", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
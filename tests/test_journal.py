@@ -0,0 +1,49 @@
+"""Tests the daily journal of the pushed updates"""
+import os
+from datetime import datetime
+import pytest
+from tsetmc_pusher import wire
+from tsetmc_pusher.journal import (
+    JournalReader,
+    JournalWriter,
+    index_path,
+    journal_path,
+    to_timestamp,
+)
+
+ISINS = ("IRO1AAAA0001", "IRO1BBBB0001")
+
+
+def trade_frame(price: int) -> bytes:
+    """Encodes a frame holding a trade of each instrument"""
+    moment = datetime(2026, 1, 3, 9, 0, price % 60)
+    return wire.encode_frame(
+        [
+            wire.encode_record(x, "trade", [price, price, moment] + [price] * 7)
+            for x in ISINS
+        ],
+        price,
+    )
+
+
+@pytest.mark.parametrize("keep_index", [True, False])
+def test_cut_off_entry_is_left_out(tmp_path, keep_index):
+    """An entry cut off by a crash is neither indexed nor read"""
+    writer = JournalWriter(str(tmp_path))
+    moment = to_timestamp(datetime(2026, 1, 3, 9, 0))
+    for position in range(3):
+        if position == 2:
+            writer.flush()
+            path = journal_path(str(tmp_path), datetime(2026, 1, 3).date())
+            complete_size = os.path.getsize(path)
+        writer.append(trade_frame(100 + position), moment + position)
+    writer.close()
+    with open(path, "r+b") as file:
+        file.truncate(complete_size + 40)
+    if not keep_index:
+        os.remove(index_path(path))
+    with JournalReader(path) as reader:
+        assert len(reader) == 2
+        records = list(reader.records(isins=[ISINS[0]]))
+        assert [x.data[0] for x in records] == [100, 101]
+        assert len(list(reader.records())) == 4
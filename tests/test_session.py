@@ -0,0 +1,74 @@
+"""Tests the outbound sessions of the websocket clients"""
+import asyncio
+import json
+from tsetmc_pusher import wire
+from tsetmc_pusher.server.session import (
+    ClientSession,
+    InstrumentUpdate,
+    SendQueueSettings,
+    SubscriptionOptions,
+)
+
+SLOW_ISIN = "IRO1AAAA0001"
+FAST_ISIN = "IRO1BBBB0001"
+
+
+class RecordingClient:
+    """Stands in for a websocket connection, keeping the frames sent to it"""
+
+    id = "recording"
+
+    def __init__(self):
+        self.frames: list[dict] = []
+
+    async def send(self, payload: str) -> None:
+        """Keeps a sent frame"""
+        self.frames.append(json.loads(payload))
+
+    async def close(self, code: int, reason: str) -> None:
+        """Ignores closing the connection"""
+
+
+def render(updates: dict, *_) -> str:
+    """Encodes the instruments of the merged updates"""
+    return json.dumps({x: {} for x, _ in updates})
+
+
+def test_sequence_stays_behind_held_back_updates():
+    """A sequenced client's stamps never pass the updates a slower rate holds"""
+
+    async def run() -> list[dict]:
+        client = RecordingClient()
+        session = ClientSession(client, SendQueueSettings(), render)
+        session.options = SubscriptionOptions.parse("seq=0")
+        session.subscribe(SLOW_ISIN, ["trade"], SubscriptionOptions(max_rate=5))
+        session.subscribe(FAST_ISIN, ["trade"], SubscriptionOptions())
+        session.start()
+        session.enqueue(None, [InstrumentUpdate(SLOW_ISIN, "trade")], 9)
+        await asyncio.sleep(0.05)
+        session.enqueue(None, [InstrumentUpdate(SLOW_ISIN, "trade")], 10)
+        session.enqueue('{"fast": {}}', [InstrumentUpdate(FAST_ISIN, "trade")], 11)
+        session.enqueue(None, [InstrumentUpdate(FAST_ISIN, "trade")], 12)
+        await asyncio.sleep(0.4)
+        session.stop()
+        return client.frames
+
+    frames = asyncio.run(run())
+    stamps = [(list(x)[1], x.get(wire.SEQUENCE_KEY)) for x in frames]
+    assert stamps == [
+        (SLOW_ISIN, 9),
+        ("fast", 9),
+        (FAST_ISIN, 9),
+        (SLOW_ISIN, 10),
+    ]
+
+
+def test_subscription_options_keep_connection_options():
+    """Options of a later subscription only change the connection wide ones they set"""
+    options = SubscriptionOptions().with_connection_options("format=binary;seq=5")
+    options = options.with_connection_options("depth=1;rate=2")
+    assert options.wire_format == wire.WireFormat.BINARY
+    assert options.sequenced
+    assert options.orderbook_depth is None and options.max_rate is None
+    options = options.with_connection_options("format=json")
+    assert options.wire_format == wire.WireFormat.JSON and options.sequenced
@@ -0,0 +1,136 @@
+"""
+This module contains the intraday OHLCV bars shared by the pusher's server and client
+"""
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+from tsetmc_pusher.wire import EPOCH
+
+BAR_FIELDS: tuple[str, ...] = ("start", "open", "high", "low", "close", "volume")
+SECONDS_PER_DAY: int = 86400
+
+
+class IntradayBars:
+    """
+    Holds the OHLCV bars of an instrument's trading day, \
+    each field in a compact array with an item per bar
+    """
+
+    def __init__(self, isin: str, interval: int = 60):
+        self.isin: str = isin
+        self.interval: int = interval
+        self.columns: tuple[array, ...] = tuple(array("q") for _ in BAR_FIELDS)
+        self.__volume: int = 0
+        self.__day_high: int = None
+        self.__day_low: int = None
+
+    def __len__(self) -> int:
+        # The volumes are appended last, so every bar counted here is complete
+        return len(self.columns[-1])
+
+    def clear(self) -> None:
+        """Drops the bars of the previous trading day"""
+        self.columns = tuple(array("q") for _ in BAR_FIELDS)
+        self.__volume = 0
+        self.__day_high = self.__day_low = None
+
+    def bar_start(self, moment: datetime) -> int:
+        """Returns the start of the bar holding a moment, in seconds since the epoch"""
+        seconds = int((moment - EPOCH).total_seconds())
+        return seconds - seconds % self.interval
+
+    def update(  # pylint: disable=too-many-arguments
+        self,
+        moment: datetime,
+        price: int,
+        volume: int,
+        day_high: int = None,
+        day_low: int = None,
+    ) -> list[int]:
+        """
+        Folds the last trade of an instrument into its bar and returns the indexes \
+        of the changed bars, the volume and extremes being the day's cumulative ones
+        """
+        if moment is None or price is None:
+            return []
+        start = self.bar_start(moment)
+        starts = self.columns[0]
+        if starts and start // SECONDS_PER_DAY != starts[-1] // SECONDS_PER_DAY:
+            self.clear()
+            starts = self.columns[0]
+        # Bars cover the whole day's volume, even from before the first update
+        traded = max(volume - self.__volume, 0) if volume is not None else 0
+        high, low = self.__extremes(price, day_high, day_low)
+        if volume is not None:
+            self.__volume = max(self.__volume, volume)
+        if not starts or start > starts[-1]:
+            for column, value in zip(self.columns, (start, price, high, low, price)):
+                column.append(value)
+            self.columns[5].append(traded)
+            return [len(starts) - 1]
+        # Late trades are folded into the last bar
+        columns = self.columns
+        columns[2][-1] = max(columns[2][-1], high)
+        columns[3][-1] = min(columns[3][-1], low)
+        columns[4][-1] = price
+        columns[5][-1] += traded
+        return [len(starts) - 1]
+
+    def __extremes(self, price: int, day_high: int, day_low: int) -> tuple[int, int]:
+        """
+        Returns the high and low of a trade, taking the day's extremes when they move \
+        as the trades between two updates may have reached beyond the last price
+        """
+        high = (
+            day_high
+            if day_high is not None
+            and self.__day_high is not None
+            and day_high > self.__day_high
+            else price
+        )
+        low = (
+            day_low
+            if day_low is not None
+            and self.__day_low is not None
+            and day_low < self.__day_low
+            else price
+        )
+        if day_high is not None:
+            self.__day_high = day_high
+        if day_low is not None:
+            self.__day_low = day_low
+        return high, low
+
+    def rows(self, indexes: list[int] = None) -> list[list[int]]:
+        """Returns some bars, or all of them, each as a list of its fields"""
+        columns = self.columns
+        count = len(columns[-1])
+        if indexes is None:
+            indexes = range(count)
+        return [[x[y] for x in columns] for y in indexes if y < count]
+
+    def assign(self, rows: list[list[int]]) -> list[int]:
+        """
+        Sets the bars published by another repository and returns the indexes \
+        of the changed ones, once all are set as inserted bars shift the later ones
+        """
+        changed = set()
+        starts = self.columns[0]
+        for row in rows:
+            if starts and row[0] // SECONDS_PER_DAY != starts[-1] // SECONDS_PER_DAY:
+                if row[0] < starts[-1]:
+                    continue
+                self.clear()
+                starts = self.columns[0]
+                changed.clear()
+            index = bisect_left(starts, row[0])
+            if index < len(starts) and starts[index] == row[0]:
+                if all(x[index] == y for x, y in zip(self.columns, row)):
+                    continue
+                for column, value in zip(self.columns, row):
+                    column[index] = value
+            else:
+                for column, value in zip(self.columns, row):
+                    column.insert(index, value)
+            changed.add(row[0])
+        return [bisect_left(starts, x) for x in sorted(changed)]
@@ -1,17 +1,22 @@
 """
 This module contains the necessary codes for the TSETMC pusher's client.
 """
-import json
 import logging
 import asyncio
+import time
 from threading import Lock
 from datetime import datetime
 from enum import Enum
+from typing import AsyncIterator, Callable
 from dataclasses import dataclass
 from websockets import client
-from websockets.exceptions import ConnectionClosedError
+from websockets.exceptions import ConnectionClosed
 from websockets.sync.client import ClientConnection
 from tse_utils.models.instrument import Instrument, InstrumentIdentification
+from tsetmc_pusher import wire
+from tsetmc_pusher.bars import IntradayBars
+from tsetmc_pusher.metrics import Histogram
+from tsetmc_pusher.wire import WireFormat
 
 
 class SubscriptionType(Enum):
@@ -21,32 +26,139 @@ class SubscriptionType(Enum):
     TRADE = "trade"
     ORDERBOOK = "orderbook"
     CLIENTTYPE = "clienttype"
+    BARS = "bars"
 
 
 @dataclass
-class TsetmcClientSubscription:
+class TsetmcClientEvent:
+    """Identifies a change applied to a subscribed instrument"""
+
+    isin: str
+    channel: str
+    instrument: Instrument
+    rows: list[int] = None
+
+
+ClientEventListener = Callable[[list[TsetmcClientEvent]], None]
+ORDERBOOK_ROW_FIELDS: tuple[tuple[str, str], ...] = tuple(
+    (x, y) for x in ("demand", "supply") for y in wire.ORDERBOOK_FIELD_NAMES
+)
+# Each stage spans two of the timing stamps, network and total also spanning \
+# the clocks of two machines, so that any skew between them is included
+LATENCY_STAGES: dict[str, tuple[int, int]] = {
+    "upstream": (0, 1),
+    "diff": (1, 2),
+    "fanout": (2, 3),
+    "network": (3, 4),
+    "total": (0, 4),
+}
+
+
+@dataclass
+class LatencyState:
+    """A summary of the latency of a stage, from scraping to receiving updates"""
+
+    count: int
+    mean: float
+    p50: float
+    p95: float
+    p99: float
+
+
+@dataclass
+class TsetmcClientSubscription:  # pylint: disable=too-many-instance-attributes
     """Identifies the details of a client's subscription"""
 
     subscribed_instruments: list[Instrument] = None
     subscribed_instruments_lock: Lock = None
+    instruments_by_isin: dict[str, Instrument] = None
     global_subscriber: bool = False
     subscription_type: SubscriptionType = SubscriptionType.ALL
+    conflate: bool = False
+    wire_format: WireFormat = WireFormat.JSON
+    sequence: int = None
+    timed: bool = False
+    max_rate: float = None
+    orderbook_depth: int = None
+    orderbook_fields: list[str] = None
+    orderbook_fields_mask: int = wire.ORDERBOOK_ALL_FIELDS
+    bars: bool = False
 
-    def __init__(
+    def __init__(  # pylint: disable=too-many-arguments
         self,
         subscribed_instruments: list[Instrument] = None,
         global_subscriber: bool = False,
         subscription_type: SubscriptionType = SubscriptionType.ALL,
+        conflate: bool = False,
+        wire_format: WireFormat = WireFormat.JSON,
+        sequenced: bool = False,
+        timed: bool = False,
+        max_rate: float = None,
+        orderbook_depth: int = None,
+        orderbook_fields: list[str] = None,
+        bars: bool = False,
     ):
         self.subscribed_instruments: list[Instrument] = (
             subscribed_instruments if subscribed_instruments else []
         )
         self.subscribed_instruments_lock: Lock = Lock()
+        self.instruments_by_isin: dict[str, Instrument] = {
+            x.identification.isin: x for x in self.subscribed_instruments
+        }
         self.subscription_type: SubscriptionType = subscription_type
         self.global_subscriber: bool = global_subscriber
+        self.conflate: bool = conflate
+        self.wire_format: WireFormat = wire_format
+        self.sequence: int = 0 if sequenced else None
+        self.timed: bool = timed
+        self.max_rate: float = max_rate
+        self.orderbook_depth: int = orderbook_depth
+        self.orderbook_fields: list[str] = orderbook_fields
+        self.orderbook_fields_mask: int = (
+            wire.orderbook_fields_mask(orderbook_fields)
+            if orderbook_fields
+            else wire.ORDERBOOK_ALL_FIELDS
+        )
+        self.bars: bool = bars
 
+    def options(self) -> str:
+        """Returns the delivery options to send along with the subscription"""
+        options = []
+        if self.conflate:
+            options.append("conflate=1")
+        if self.wire_format != WireFormat.JSON:
+            options.append(f"format={self.wire_format.value}")
+        if self.sequence is not None:
+            options.append(f"seq={self.sequence}")
+        if self.timed:
+            options.append("timing=1")
+        if self.max_rate is not None:
+            options.append(f"rate={self.max_rate:g}")
+        if self.orderbook_depth is not None:
+            options.append(f"depth={self.orderbook_depth}")
+        if self.orderbook_fields:
+            options.append(f"fields={','.join(self.orderbook_fields)}")
+        return ";".join(options)
 
-class TsetmcClient:
+    def get_instrument(self, isin: str) -> Instrument:
+        """Gets the subscribed instrument by Isin, adding it if it is not there yet"""
+        instrument = self.instruments_by_isin.get(isin)
+        if instrument is not None:
+            return instrument
+        with self.subscribed_instruments_lock:
+            if len(self.instruments_by_isin) != len(self.subscribed_instruments):
+                self.instruments_by_isin = {
+                    x.identification.isin: x for x in self.subscribed_instruments
+                }
+            instrument = self.instruments_by_isin.get(isin)
+            if instrument is None:
+                instrument = Instrument(InstrumentIdentification(isin=isin))
+                self.subscribed_instruments.append(instrument)
+                self.instruments_by_isin[isin] = instrument
+        return instrument
+
+
+class TsetmcClient:  # pylint: disable=too-many-instance-attributes
     """
 The class used for connecting to the TSETMC pusher websocket \
 and subscribe to its realtime data
@@ -66,91 +178,210 @@ and subscribe to its realtime data
         self.__websocket: ClientConnection = None
         self.operation_flag: bool = False
         self.subscription: TsetmcClientSubscription = subscription
+        self.__channel_handlers: dict[str, Callable[[Instrument, list], None]] = {
+            "thresholds": self.__message_thresholds,
+            "trade": self.__message_trade,
+            "orderbook": self.__message_orderbook,
+            "clienttype": self.__message_clienttype,
+            "bars": self.__message_bars,
+        }
+        self.__bars: dict[str, IntradayBars] = {}
+        self.__listeners: list[ClientEventListener] = []
+        self.latency: Histogram = Histogram(
+            "tsetmc_client_latency_seconds",
+            "Latency of the received updates, by the stage they went through.",
+            ("stage",),
+            registry=None,
+        )
+
+    def add_listener(self, listener: ClientEventListener) -> None:
+        """Registers a callback receiving the events of each processed message"""
+        self.__listeners.append(listener)
+
+    def remove_listener(self, listener: ClientEventListener) -> None:
+        """Unregisters a callback added by add_listener"""
+        try:
+            self.__listeners.remove(listener)
+        except ValueError:
+            pass
+
+    async def events(self) -> AsyncIterator[list[TsetmcClientEvent]]:
+        """Yields the events of each processed message as they arrive"""
+        queue: asyncio.Queue[list[TsetmcClientEvent]] = asyncio.Queue()
+        listener = queue.put_nowait
+        self.add_listener(listener)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.remove_listener(listener)
 
     async def listen(self) -> None:
         """Listens to websocket updates"""
         while self.operation_flag:
             message = await self.__websocket.recv()
+            received_at = time.time_ns() // 1000
             self._LOGGER.debug("Client received: %s", message)
-            self.process_message(message=message)
+            self.process_message(message=message, received_at=received_at)
 
-    def process_message(self, message: str) -> None:
+    def process_message(self, message: str | bytes, received_at: int = None) -> None:
         """Processes a new message received from websocket"""
-        message_js = json.loads(message)
+        message_js = wire.decode_message(message)
+        sequence = message_js.pop(wire.SEQUENCE_KEY, None)
+        timing = message_js.pop(wire.TIMING_KEY, None)
+        if timing:
+            self.record_latency(timing, received_at)
+        get_instrument = self.subscription.get_instrument
+        events: list[TsetmcClientEvent] = [] if self.__listeners else None
         for isin, channels in message_js.items():
-            instrument = self.get_subscribed_instrument(isin)
+            instrument = get_instrument(isin)
             for channel, data in channels.items():
-                match channel:
-                    case "thresholds":
-                        self.__message_thresholds(instrument, data)
-                    case "trade":
-                        self.__message_trade(instrument, data)
-                    case "orderbook":
-                        self.__message_orderbook(instrument, data)
-                    case "clienttype":
-                        self.__message_clienttype(instrument, data)
-                    case _:
-                        self._LOGGER.fatal("Unknown message channel: %s", channel)
+                handler = self.__channel_handlers.get(channel)
+                if not handler:
+                    self._LOGGER.fatal("Unknown message channel: %s", channel)
+                    continue
+                handler(instrument, data)
+                if events is not None:
+                    events.append(
+                        TsetmcClientEvent(
+                            isin=isin,
+                            channel=channel,
+                            instrument=instrument,
+                            rows=[x[0] for x in data]
+                            if channel == "orderbook"
+                            else None,
+                        )
+                    )
+        if sequence and self.subscription.sequence is not None:
+            self.subscription.sequence = max(self.subscription.sequence, sequence)
+        if events:
+            self.__notify(events)
+
+    def record_latency(self, timing: list[int], received_at: int = None) -> None:
+        """Records the latency of each stage of a message stamped with timing"""
+        stamps = list(timing) + [received_at if received_at else time.time_ns() // 1000]
+        for stage, (start, end) in LATENCY_STAGES.items():
+            if stamps[start] and stamps[end]:
+                self.latency.labels(stage).observe(
+                    max(stamps[end] - stamps[start], 0) / 1e6
+                )
+
+    def latency_state(self) -> dict[str, LatencyState]:
+        """Summarizes the latency recorded for each stage so far"""
+        states = {}
+        for stage in LATENCY_STAGES:
+            child = self.latency.labels(stage)
+            count = child.count
+            states[stage] = LatencyState(
+                count=count,
+                mean=child.sum / count if count else None,
+                p50=child.quantile(0.5),
+                p95=child.quantile(0.95),
+                p99=child.quantile(0.99),
+            )
+        return states
+
+    def __notify(self, events: list[TsetmcClientEvent]) -> None:
+        """Hands the events of a message to the registered listeners"""
+        for listener in tuple(self.__listeners):
+            try:
+                listener(events)
+            except Exception as ex:  # pylint: disable=broad-exception-caught
+                self._LOGGER.error("Exception on notifying listener: %s", repr(ex))
+
+    def pending_messages(self) -> int:
+        """Number of the received messages waiting to be processed"""
+        websocket = self.__websocket
+        return len(websocket.messages) if websocket and websocket.open else 0
 
     def get_subscribed_instrument(self, isin) -> Instrument:
         """Gets the subscribed instrument by Isin"""
-        with self.subscription.subscribed_instruments_lock:
-            instrument = next(
-                (
-                    x
-                    for x in self.subscription.subscribed_instruments
-                    if x.identification.isin == isin
-                ),
-                None,
-            )
-            if instrument is None:
-                instrument = Instrument(InstrumentIdentification(isin=isin))
-                self.subscription.subscribed_instruments.append(instrument)
-        return instrument
+        return self.subscription.get_instrument(isin)
+
+    def get_bars(self, isin: str) -> IntradayBars:
+        """Gets the received intraday bars of an instrument by Isin"""
+        return self.__bars.get(isin)
 
     def __message_thresholds(self, instrument: Instrument, data: list) -> None:
         """Handles a threshold update message"""
-        instrument.order_limitations.max_price = int(data[0])
-        instrument.order_limitations.min_price = int(data[1])
+        limitations = instrument.order_limitations
+        limitations.max_price, limitations.min_price = data
 
     def __message_trade(self, instrument: Instrument, data: list) -> None:
         """Handles a trade update message"""
-        instrument.intraday_trade_candle.close_price = int(data[0])
-        instrument.intraday_trade_candle.last_price = int(data[1])
-        instrument.intraday_trade_candle.last_trade_datetime = datetime.fromisoformat(
-            data[2]
+        candle = instrument.intraday_trade_candle
+        (
+            candle.close_price,
+            candle.last_price,
+            last_trade_datetime,
+            candle.max_price,
+            candle.min_price,
+            candle.open_price,
+            candle.previous_price,
+            candle.trade_num,
+            candle.trade_value,
+            candle.trade_volume,
+        ) = data
+        if last_trade_datetime == "None":
+            # The JSON format sends a missing trade time as a string
+            last_trade_datetime = None
+        candle.last_trade_datetime = (
+            datetime.fromisoformat(last_trade_datetime)
+            if isinstance(last_trade_datetime, str)
+            else last_trade_datetime
         )
-        instrument.intraday_trade_candle.max_price = int(data[3])
-        instrument.intraday_trade_candle.min_price = int(data[4])
-        instrument.intraday_trade_candle.open_price = int(data[5])
-        instrument.intraday_trade_candle.previous_price = int(data[6])
-        instrument.intraday_trade_candle.trade_num = int(data[7])
-        instrument.intraday_trade_candle.trade_value = int(data[8])
-        instrument.intraday_trade_candle.trade_volume = int(data[9])
 
     def __message_orderbook(self, instrument: Instrument, data: list) -> None:
         """Handles an orderbook update message"""
+        rows = instrument.orderbook.rows
+        fields_mask = self.subscription.orderbook_fields_mask
+        if fields_mask != wire.ORDERBOOK_ALL_FIELDS:
+            # Rows only hold the fields the subscription has asked for
+            fields = [
+                ORDERBOOK_ROW_FIELDS[x]
+                for x in wire.orderbook_field_indexes(fields_mask)
+            ]
+            for row in data:
+                orderbook_row = rows[row[0]]
+                for (side, name), value in zip(fields, row[1:]):
+                    setattr(getattr(orderbook_row, side), name, value)
+            return
         for row in data:
-            rn = int(row[0])
-            instrument.orderbook.rows[rn].demand.num = int(row[1])
-            instrument.orderbook.rows[rn].demand.price = int(row[2])
-            instrument.orderbook.rows[rn].demand.volume = int(row[3])
-            instrument.orderbook.rows[rn].supply.num = int(row[4])
-            instrument.orderbook.rows[rn].supply.price = int(row[5])
-            instrument.orderbook.rows[rn].supply.volume = int(row[6])
+            orderbook_row = rows[row[0]]
+            demand, supply = orderbook_row.demand, orderbook_row.supply
+            (
+                _,
+                demand.num,
+                demand.price,
+                demand.volume,
+                supply.num,
+                supply.price,
+                supply.volume,
+            ) = row
 
     def __message_clienttype(self, instrument: Instrument, data: list) -> None:
         """Handles an orderbook update message"""
         if data[0] is None:
             return
-        instrument.client_type.legal.buy.num = int(data[0])
-        instrument.client_type.legal.buy.volume = int(data[1])
-        instrument.client_type.legal.sell.num = int(data[2])
-        instrument.client_type.legal.sell.volume = int(data[3])
-        instrument.client_type.natural.buy.num = int(data[4])
-        instrument.client_type.natural.buy.volume = int(data[5])
-        instrument.client_type.natural.sell.num = int(data[6])
-        instrument.client_type.natural.sell.volume = int(data[7])
+        legal, natural = instrument.client_type.legal, instrument.client_type.natural
+        (
+            legal.buy.num,
+            legal.buy.volume,
+            legal.sell.num,
+            legal.sell.volume,
+            natural.buy.num,
+            natural.buy.volume,
+            natural.sell.num,
+            natural.sell.volume,
+        ) = data
+
+    def __message_bars(self, instrument: Instrument, data: list) -> None:
+        """Handles an intraday bars update message"""
+        isin = instrument.identification.isin
+        bars = self.__bars.get(isin)
+        if bars is None:
+            bars = self.__bars[isin] = IntradayBars(isin)
+        bars.assign(data)
 
     async def subscribe(self) -> None:
         """Subscribe to the channels for the appointed instruemtns"""
@@ -169,9 +400,16 @@ and subscribe to its realtime data
                         for x in self.subscription.subscribed_instruments
                     ]
                 )
-        await self.__websocket.send(
-            f"1.{self.subscription.subscription_type.value}.{isins}"
-        )
+        subscription_types = [self.subscription.subscription_type]
+        if self.subscription.bars and SubscriptionType.BARS not in subscription_types:
+            # The intraday bars are not part of the other subscription types
+            subscription_types.append(SubscriptionType.BARS)
+        options = self.subscription.options()
+        for subscription_type in subscription_types:
+            message = f"1.{subscription_type.value}.{isins}"
+            if options:
+                message = f"{message}.{options}"
+            await self.__websocket.send(message)
 
     async def start_operation(self) -> None:
         """Start connecting to the websocket and listening for updates for a single loop"""
@@ -186,7 +424,7 @@ and subscribe to its realtime data
         while self.operation_flag:
             try:
                 await self.__operation_single_try()
-            except (OSError, ConnectionClosedError) as exc:
+            except (OSError, ConnectionClosed) as exc:
                 self._LOGGER.error("Connection error: %s", repr(exc))
                 await asyncio.sleep(self._OPERATION_RECONNECT_WAIT)
 
@@ -0,0 +1,263 @@
+"""
+This module contains the append-only daily journal of the pushed updates
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Iterator
+from tsetmc_pusher import wire
+
+JOURNAL_MAGIC: bytes = b"TSEJ"
+JOURNAL_VERSION: int = 2
+FILE_HEADER = struct.Struct("<4sB")
+ENTRY_HEADER = struct.Struct("<qI")
+INDEX_ENTRY = struct.Struct("<qQ")
+
+
+def journal_path(directory: str, day: date) -> str:
+    """Returns the path of a day's journal in a directory"""
+    return os.path.join(directory, f"journal_{day:%Y%m%d}.bin")
+
+
+def index_path(path: str) -> str:
+    """Returns the path of the time index next to a journal"""
+    return path[: -len(".bin")] + ".idx"
+
+
+def to_timestamp(moment: datetime) -> int:
+    """Converts a naive local time into the microseconds stored in journals"""
+    return int(moment.timestamp() * 1_000_000)
+
+
+def from_timestamp(timestamp: int) -> datetime:
+    """Converts the microseconds stored in journals into a naive local time"""
+    return datetime.fromtimestamp(timestamp // 1_000_000) + timedelta(
+        microseconds=timestamp % 1_000_000
+    )
+
+
+@dataclass
+class JournalRecord:
+    """A single channel's data of an instrument, as applied at some moment"""
+
+    timestamp: datetime
+    version: int
+    isin: str
+    channel: str
+    data: list
+
+
+class JournalWriter:  # pylint: disable=too-many-instance-attributes
+    """
+    Appends binary frames to a daily journal and their offsets \
+    to a time index, switching files when the day changes
+    Both are buffered together, so the index never lags far behind the journal
+    """
+
+    def __init__(self, directory: str, buffer_size: int = 2**20):
+        self.directory: str = directory
+        self.buffer_size: int = buffer_size
+        self.__lock: threading.Lock = threading.Lock()
+        self.__day: date = None
+        self.__journal = None
+        self.__index = None
+        self.__offset: int = 0
+        self.__buffer: bytearray = bytearray()
+        self.__index_buffer: bytearray = bytearray()
+        os.makedirs(directory, exist_ok=True)
+
+    def __open(self, day: date) -> None:
+        """Opens the journal of a day for appending"""
+        self.__close()
+        path = journal_path(self.directory, day)
+        self.__journal = open(  # pylint: disable=consider-using-with
+            path, "ab", buffering=0
+        )
+        self.__index = open(  # pylint: disable=consider-using-with
+            index_path(path), "ab", buffering=0
+        )
+        self.__offset = self.__journal.tell()
+        if not self.__offset:
+            self.__buffer += FILE_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION)
+            self.__offset = FILE_HEADER.size
+        self.__day = day
+
+    def append(self, frame: bytes, timestamp: int = None) -> None:
+        """Appends a binary frame, stamped with the current time unless given"""
+        timestamp = timestamp if timestamp else time.time_ns() // 1000
+        with self.__lock:
+            day = from_timestamp(timestamp).date()
+            if day != self.__day:
+                self.__open(day)
+            self.__buffer += ENTRY_HEADER.pack(timestamp, len(frame))
+            self.__buffer += frame
+            self.__index_buffer += INDEX_ENTRY.pack(timestamp, self.__offset)
+            self.__offset += ENTRY_HEADER.size + len(frame)
+            if len(self.__buffer) >= self.buffer_size:
+                self.__flush()
+
+    def __flush(self) -> None:
+        """Writes the buffered entries, the journal's before their index"""
+        if self.__buffer:
+            self.__journal.write(self.__buffer)
+            self.__buffer.clear()
+        if self.__index_buffer:
+            self.__index.write(self.__index_buffer)
+            self.__index_buffer.clear()
+
+    def flush(self) -> None:
+        """Hands the buffered entries to the operating system"""
+        with self.__lock:
+            if self.__journal:
+                self.__flush()
+
+    def __close(self) -> None:
+        """Closes the files of the current day"""
+        if self.__journal:
+            self.__flush()
+            self.__journal.close()
+            self.__index.close()
+            self.__journal = self.__index = None
+            self.__day = None
+
+    def close(self) -> None:
+        """Flushes and closes the journal"""
+        with self.__lock:
+            self.__close()
+
+
+class JournalReader:
+    """
+    Reads a journal through a memory map, seeking by time through its index \
+    and by instrument through the record headers, without decoding the rest
+    """
+
+    def __init__(self, path: str):
+        self.path: str = path
+        with open(path, "rb") as file:
+            self.__journal = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = FILE_HEADER.unpack_from(self.__journal, 0)
+        if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION:
+            raise ValueError(f"Unsupported journal [{path}]")
+        self.__index: list[tuple[int, int]] = self.__read_index()
+        self.__instrument_entries: dict[str, list[int]] = None
+
+    def __read_index(self) -> list[tuple[int, int]]:
+        """
+        Reads the time index, extending it over the entries written after \
+        its last one, as after a crash, or rebuilding it if it is missing, \
+        leaving out a last entry that was cut off
+        """
+        size = len(self.__journal)
+        index, offset = [], FILE_HEADER.size
+        try:
+            with open(index_path(self.path), "rb") as file:
+                raw = file.read()
+            raw = raw[: len(raw) - len(raw) % INDEX_ENTRY.size]
+            index = [
+                x
+                for x in INDEX_ENTRY.iter_unpack(raw)
+                if self.__entry_end(x[1]) <= size
+            ]
+        except FileNotFoundError:
+            pass
+        if index:
+            offset = self.__entry_end(index[-1][1])
+        while self.__entry_end(offset) <= size:
+            timestamp, _ = ENTRY_HEADER.unpack_from(self.__journal, offset)
+            index.append((timestamp, offset))
+            offset = self.__entry_end(offset)
+        return index
+
+    def __entry_end(self, offset: int) -> int:
+        """Returns the offset past an entry, or past the journal if it is cut off"""
+        if offset + ENTRY_HEADER.size > len(self.__journal):
+            return len(self.__journal) + 1
+        _, length = ENTRY_HEADER.unpack_from(self.__journal, offset)
+        return offset + ENTRY_HEADER.size + length
+
+    def __len__(self) -> int:
+        return len(self.__index)
+
+    def seek(self, moment: datetime) -> int:
+        """Returns the position of the first entry applied at or after a moment"""
+        timestamp = to_timestamp(moment)
+        low, high = 0, len(self.__index)
+        while low < high:
+            middle = (low + high) // 2
+            if self.__index[middle][0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __entry_records(
+        self, offset: int, isins: set[str] = None
+    ) -> Iterator[JournalRecord]:
+        """Decodes the records of an entry, keeping only the wanted instruments"""
+        timestamp, length = ENTRY_HEADER.unpack_from(self.__journal, offset)
+        offset += ENTRY_HEADER.size
+        if offset + length > len(self.__journal):
+            return
+        count, version, _, offset = wire.decode_frame_header(self.__journal, offset)
+        moment = from_timestamp(timestamp)
+        for isin, channel, data in wire.iter_records(self.__journal, offset, count):
+            if isins is None or isin in isins:
+                yield JournalRecord(moment, version, isin, channel, data)
+
+    def instrument_entries(self, isin: str) -> list[int]:
+        """Returns the positions of the entries touching an instrument"""
+        if self.__instrument_entries is None:
+            self.__instrument_entries = {}
+            for position, (_, offset) in enumerate(self.__index):
+                for record in self.__entry_isins(offset):
+                    entries = self.__instrument_entries.setdefault(record, [])
+                    if not entries or entries[-1] != position:
+                        entries.append(position)
+        return self.__instrument_entries.get(isin, [])
+
+    def __entry_isins(self, offset: int) -> Iterator[str]:
+        """Reads the instruments of an entry's records without decoding them"""
+        count, _, _, offset = wire.decode_frame_header(
+            self.__journal, offset + ENTRY_HEADER.size
+        )
+        for isin, _, _ in wire.iter_records(self.__journal, offset, count, False):
+            yield isin
+
+    def records(
+        self,
+        start: datetime = None,
+        end: datetime = None,
+        isins: list[str] = None,
+    ) -> Iterator[JournalRecord]:
+        """Iterates over the records applied in a period, optionally of some isins"""
+        first = self.seek(start) if start else 0
+        last = self.seek(end) if end else len(self.__index)
+        if isins is None:
+            positions = range(first, last)
+        else:
+            positions = sorted(
+                {
+                    x
+                    for isin in isins
+                    for x in self.instrument_entries(isin)
+                    if first <= x < last
+                }
+            )
+        wanted = None if isins is None else set(isins)
+        for position in positions:
+            yield from self.__entry_records(self.__index[position][1], wanted)
+
+    def close(self) -> None:
+        """Releases the memory map"""
+        self.__journal.close()
+
+    def __enter__(self) -> "JournalReader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,349 @@
+"""
+This module contains the metrics of the pusher and their HTTP endpoint, \
+in the Prometheus text exposition format
+"""
+import asyncio
+import logging
+import threading
+from bisect import bisect_left
+from datetime import datetime, time
+from typing import Callable, Iterator
+from tsetmc_pusher.timing import sleep_until, MARKET_END_TIME
+
+LATENCY_BUCKETS: tuple[float, ...] = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+COUNT_BUCKETS: tuple[float, ...] = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+SIZE_BUCKETS: tuple[float, ...] = tuple(2 ** (10 + 2 * x) for x in range(8))
+CONTENT_TYPE: str = "text/plain; version=0.0.4; charset=utf-8"
+
+# Suffix, label names, label values and value of a rendered sample
+Sample = tuple[str, tuple[str, ...], tuple[str, ...], float]
+
+
+def format_value(value: float) -> str:
+    """Formats a sample value the way Prometheus parses it"""
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape_label_value(value: str) -> str:
+    """Escapes the backslashes, quotes and line feeds of a label value"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    """Formats the labels of a sample"""
+    if not names:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{x}="{escape_label_value(y)}"' for x, y in zip(names, values))
+        + "}"
+    )
+
+
+class MetricsRegistry:
+    """Holds the metrics exposed by a process"""
+
+    def __init__(self):
+        self.__metrics: dict[str, "Metric"] = {}
+        self.__lock: threading.Lock = threading.Lock()
+
+    def register(self, metric: "Metric") -> None:
+        """Adds a metric, each name being registered only once"""
+        with self.__lock:
+            if metric.name in self.__metrics:
+                raise ValueError(f"Metric [{metric.name}] is already registered")
+            self.__metrics[metric.name] = metric
+
+    def get(self, name: str) -> "Metric":
+        """Returns a registered metric by its name"""
+        return self.__metrics.get(name)
+
+    def render(self) -> str:
+        """Renders all metrics in the text exposition format"""
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, names, values, value in metric.samples():
+                lines.append(
+                    f"{metric.name}{suffix}{format_labels(names, values)} "
+                    f"{format_value(value)}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY: MetricsRegistry = MetricsRegistry()
+
+
+class MetricChild:
+    """
+    The values of a metric for a single combination of label values, \
+    updated without a lock when only a single thread updates them
+    """
+
+    def __init__(self, lock: threading.Lock, size: int):
+        self._lock: threading.Lock = lock
+        self.values: list[float] = [0] * size
+
+    def inc(self, amount: float = 1) -> None:
+        """Adds to the value of a counter or a gauge"""
+        if self._lock is None:
+            self.values[0] += amount
+            return
+        with self._lock:
+            self.values[0] += amount
+
+    def set(self, value: float) -> None:
+        """Sets the value of a gauge"""
+        self.values[0] = value
+
+
+class HistogramChild(MetricChild):
+    """The bucket counts and the sum of a histogram for some label values"""
+
+    def __init__(self, lock: threading.Lock, buckets: tuple[float, ...]):
+        # A count per bucket, one for the values above all buckets, then the sum
+        super().__init__(lock, len(buckets) + 2)
+        self.buckets: tuple[float, ...] = buckets
+
+    def observe(self, value: float) -> None:
+        """Records an observed value"""
+        index = bisect_left(self.buckets, value)
+        if self._lock is None:
+            self.values[index] += 1
+            self.values[-1] += value
+            return
+        with self._lock:
+            self.values[index] += 1
+            self.values[-1] += value
+
+    @property
+    def count(self) -> int:
+        """Number of the observed values"""
+        return sum(self.values[:-1])
+
+    @property
+    def sum(self) -> float:
+        """Sum of the observed values"""
+        return self.values[-1]
+
+    def quantile(self, quantile: float) -> float:
+        """
+        Estimates a quantile of the observed values the way Prometheus does, \
+        interpolating linearly within the bucket that holds it
+        """
+        counts = list(self.values[:-1])
+        rank = quantile * sum(counts)
+        if not rank:
+            return None
+        cumulative, lower = 0, 0.0
+        for bound, count in zip(self.buckets, counts):
+            if cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return self.buckets[-1]
+
+
+class Metric:
+    """Base of the metrics, holding a child for each combination of label values"""
+
+    kind: str = "untyped"
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        registry: MetricsRegistry = REGISTRY,
+        thread_safe: bool = True,
+    ):
+        self.name: str = name
+        self.documentation: str = documentation
+        self.label_names: tuple[str, ...] = tuple(labels)
+        self.thread_safe: bool = thread_safe
+        self._lock: threading.Lock = threading.Lock()
+        self._children: dict[tuple[str, ...], MetricChild] = {}
+        if registry is not None:
+            registry.register(self)
+
+    @property
+    def _child_lock(self) -> threading.Lock:
+        """The lock guarding the updates of the children, if they need one"""
+        return self._lock if self.thread_safe else None
+
+    def _new_child(self) -> MetricChild:
+        """Returns the child of a new combination of label values"""
+        return MetricChild(self._child_lock, 1)
+
+    def labels(self, *label_values: str) -> MetricChild:
+        """Returns the child of some label values, creating it on first use"""
+        child = self._children.get(label_values)
+        if child is None:
+            if len(label_values) != len(self.label_names):
+                raise ValueError(f"Metric [{self.name}] takes {self.label_names}")
+            with self._lock:
+                child = self._children.setdefault(label_values, self._new_child())
+        return child
+
+    def _snapshot(self) -> list[tuple[tuple[str, ...], list[float]]]:
+        """Copies the values of all children"""
+        with self._lock:
+            return [(x, list(y.values)) for x, y in self._children.items()]
+
+    def samples(self) -> Iterator[Sample]:
+        """Iterates over the samples of all children"""
+        for label_values, values in self._snapshot():
+            yield "", self.label_names, label_values, values[0]
+
+
+class Counter(Metric):
+    """A value that only goes up, like the number of frames sent"""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1) -> None:
+        """Adds to the value of an unlabelled counter"""
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, either set directly or read \
+    from a function whenever the metrics are rendered
+    """
+
+    kind = "gauge"
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        registry: MetricsRegistry = REGISTRY,
+        thread_safe: bool = True,
+    ):
+        super().__init__(name, documentation, labels, registry, thread_safe)
+        self.function: Callable[[], float | dict[tuple[str, ...], float]] = None
+
+    def set(self, value: float) -> None:
+        """Sets the value of an unlabelled gauge"""
+        self.labels().set(value)
+
+    def set_function(
+        self, function: Callable[[], float | dict[tuple[str, ...], float]]
+    ) -> None:
+        """
+        Reads the gauge from a function on rendering, \
+        which returns a value per tuple of label values when labelled
+        """
+        self.function = function
+
+    def samples(self) -> Iterator[Sample]:
+        if self.function is None:
+            yield from super().samples()
+            return
+        values = self.function()
+        if not self.label_names:
+            values = {(): values}
+        for label_values, value in values.items():
+            yield "", self.label_names, label_values, value
+
+
+class Histogram(Metric):
+    """Counts the observed values in cumulative buckets, along with their sum"""
+
+    kind = "histogram"
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+        registry: MetricsRegistry = REGISTRY,
+        thread_safe: bool = True,
+    ):
+        self.buckets: tuple[float, ...] = tuple(sorted(buckets))
+        super().__init__(name, documentation, labels, registry, thread_safe)
+
+    def _new_child(self) -> HistogramChild:
+        return HistogramChild(self._child_lock, self.buckets)
+
+    def observe(self, value: float) -> None:
+        """Records a value in an unlabelled histogram"""
+        self.labels().observe(value)
+
+    def samples(self) -> Iterator[Sample]:
+        names = self.label_names + ("le",)
+        for label_values, values in self._snapshot():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                cumulative += count
+                yield "_bucket", names, label_values + (
+                    format_value(bound),
+                ), cumulative
+            yield "_sum", self.label_names, label_values, values[-1]
+            yield "_count", self.label_names, label_values, cumulative
+
+
+class MetricsServer:
+    """Serves the rendered metrics of a registry over HTTP for scraping"""
+
+    _LOGGER = logging.getLogger(__name__)
+
+    def __init__(self, host: str, port: int, registry: MetricsRegistry = None):
+        self.host: str = host
+        self.port: int = port
+        self.registry: MetricsRegistry = registry if registry else REGISTRY
+
+    async def handle_request(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Answers a single request, rendering the metrics on GET /metrics"""
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            while (await reader.readline()).strip():
+                pass
+            if request_line[:1] == ["GET"] and request_line[1:2] == ["/metrics"]:
+                status, body = "200 OK", self.registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except ConnectionError as ex:
+            self._LOGGER.error("Exception on serving metrics: %s", repr(ex))
+        finally:
+            writer.close()
+
+    async def serve(self, end_time: time | datetime = None) -> None:
+        """Serves the metrics until the market, or the given time, ends"""
+        server = await asyncio.start_server(self.handle_request, self.host, self.port)
+        self._LOGGER.info("Metrics are served on [%s:%d].", self.host, self.port)
+        async with server:
+            await sleep_until(end_time if end_time else MARKET_END_TIME)
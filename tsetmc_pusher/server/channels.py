@@ -0,0 +1,137 @@
+"""
+This module contains the subscription channels of the instruments
+"""
+from dataclasses import dataclass
+from websockets.sync.client import ClientConnection
+
+
+@dataclass
+class InstrumentChannel:
+    """Holds essential channels for each instrument"""
+
+    isin: str = None
+    trade_subscribers: set[ClientConnection] = None
+    orderbook_subscribers: set[ClientConnection] = None
+    clienttype_subscribers: set[ClientConnection] = None
+    bars_subscribers: set[ClientConnection] = None
+
+    def __init__(self, isin: str):
+        self.isin = isin
+        self.trade_subscribers = set()
+        self.orderbook_subscribers = set()
+        self.clienttype_subscribers = set()
+        self.bars_subscribers = set()
+
+    def __repr__(self) -> str:
+        return f"{self.isin}: {[x.id for x in self.orderbook_subscribers]}"
+
+    def subscribers(self, channel: str) -> set[ClientConnection]:
+        """Returns the subscribers of one of the channel's data"""
+        match channel:
+            case "trade":
+                return self.trade_subscribers
+            case "orderbook":
+                return self.orderbook_subscribers
+            case "clienttype":
+                return self.clienttype_subscribers
+            case "bars":
+                return self.bars_subscribers
+        return set()
+
+    def has_subscriber(self, client: ClientConnection) -> bool:
+        """Checks if client is subscribed to any of the channel's data"""
+        return (
+            client in self.trade_subscribers
+            or client in self.orderbook_subscribers
+            or client in self.clienttype_subscribers
+            or client in self.bars_subscribers
+        )
+
+    def is_empty(self) -> bool:
+        """Checks if channel has no subscribers left"""
+        return not (
+            self.trade_subscribers
+            or self.orderbook_subscribers
+            or self.clienttype_subscribers
+            or self.bars_subscribers
+        )
+
+
+def subscribe_trade(client: ClientConnection, instrument_channel: InstrumentChannel):
+    """Subscribe to instrument's trade data"""
+    instrument_channel.trade_subscribers.add(client)
+
+
+def subscribe_orderbook(
+    client: ClientConnection, instrument_channel: InstrumentChannel
+):
+    """Subscribe to instrument's orderbook data"""
+    instrument_channel.orderbook_subscribers.add(client)
+
+
+def subscribe_clienttype(
+    client: ClientConnection, instrument_channel: InstrumentChannel
+):
+    """Subscribe to instrument's clienttype data"""
+    instrument_channel.clienttype_subscribers.add(client)
+
+
+def subscribe_bars(client: ClientConnection, instrument_channel: InstrumentChannel):
+    """Subscribe to instrument's intraday bars"""
+    instrument_channel.bars_subscribers.add(client)
+
+
+def subscribe_all(client: ClientConnection, instrument_channel: InstrumentChannel):
+    """Subscribe to all instrument's data, except for the opt-in intraday bars"""
+    subscribe_trade(client, instrument_channel)
+    subscribe_orderbook(client, instrument_channel)
+    subscribe_clienttype(client, instrument_channel)
+
+
+def unsubscribe_trade(client: ClientConnection, instrument_channel: InstrumentChannel):
+    """Unsubscribe from instrument's trade data"""
+    try:
+        instrument_channel.trade_subscribers.remove(client)
+    except KeyError:
+        pass
+
+
+def unsubscribe_orderbook(
+    client: ClientConnection, instrument_channel: InstrumentChannel
+):
+    """Unsubscribe from instrument's orderbook data"""
+    try:
+        instrument_channel.orderbook_subscribers.remove(client)
+    except KeyError:
+        pass
+
+
+def unsubscribe_clienttype(
+    client: ClientConnection, instrument_channel: InstrumentChannel
+):
+    """Unsubscribe from instrument's clienttype data"""
+    try:
+        instrument_channel.clienttype_subscribers.remove(client)
+    except KeyError:
+        pass
+
+
+def unsubscribe_bars(client: ClientConnection, instrument_channel: InstrumentChannel):
+    """Unsubscribe from instrument's intraday bars"""
+    try:
+        instrument_channel.bars_subscribers.remove(client)
+    except KeyError:
+        pass
+
+
+def unsubscribe_all(client: ClientConnection, instrument_channel: InstrumentChannel):
+    """Unsubscribe from all instrument's data, except for the opt-in intraday bars"""
+    unsubscribe_trade(client, instrument_channel)
+    unsubscribe_orderbook(client, instrument_channel)
+    unsubscribe_clienttype(client, instrument_channel)
+
+
+def remove_subscriber(client: ClientConnection, instrument_channel: InstrumentChannel):
+    """Remove a client from all instrument's data, including the intraday bars"""
+    unsubscribe_all(client, instrument_channel)
+    unsubscribe_bars(client, instrument_channel)
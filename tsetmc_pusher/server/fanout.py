@@ -0,0 +1,181 @@
+"""
+This module contains the fan-out of a crawler's updates to websocket workers
+"""
+import asyncio
+import logging
+import os
+import struct
+from datetime import datetime, time
+from tsetmc_pusher import wire
+from tsetmc_pusher.metrics import Gauge
+from tsetmc_pusher.wire import WireFormat
+from tsetmc_pusher.server.replica import ReplicaServer
+from tsetmc_pusher.server.repository import (
+    CycleTiming,
+    MarketRealtimeData,
+    MarketUpdateBatch,
+)
+from tsetmc_pusher.server.websocket import (
+    PayloadCache,
+    TsetmcWebsocketSettings,
+    encode_batch,
+)
+from tsetmc_pusher.timing import sleep_until, MARKET_END_TIME
+
+
+MESSAGE_HEADER = struct.Struct("<I")
+WORKERS = Gauge("tsetmc_pusher_fanout_workers", "Websocket workers connected.")
+
+
+class FanoutPublisher:
+    """
+    Publishes the updates of a crawler's repository to the websocket workers \
+    over a Unix socket, each worker first receiving a snapshot of the market
+    """
+
+    _LOGGER = logging.getLogger(__name__)
+
+    def __init__(
+        self,
+        market_realtime_data: MarketRealtimeData,
+        socket_path: str,
+        max_buffer_size: int = 2**24,
+    ):
+        self.market_realtime_data: MarketRealtimeData = market_realtime_data
+        self.socket_path: str = socket_path
+        self.max_buffer_size: int = max_buffer_size
+        self.payload_cache: PayloadCache = PayloadCache(market_realtime_data)
+        self.__workers: dict[asyncio.StreamWriter, int] = {}
+        market_realtime_data.pusher_batch_data = self.publish_batch
+        WORKERS.set_function(lambda: self.worker_count)
+
+    @property
+    def worker_count(self) -> int:
+        """Number of the connected workers"""
+        return len(self.__workers)
+
+    async def publish_batch(self, batch: MarketUpdateBatch) -> None:
+        """Sends a crawl cycle's updates to the workers that have not seen them"""
+        message = None
+        for writer, version in list(self.__workers.items()):
+            if batch.version <= version:
+                continue
+            if message is None:
+                message = encode_batch(batch, self.payload_cache)
+            if self.__write(writer, message):
+                self.__workers[writer] = batch.version
+
+    def __write(self, writer: asyncio.StreamWriter, message: bytes) -> bool:
+        """Writes a message to a worker, dropping the worker if it falls behind"""
+        if writer.transport.get_write_buffer_size() > self.max_buffer_size:
+            self._LOGGER.error("Worker has fallen behind and is being dropped.")
+            self.__workers.pop(writer, None)
+            writer.close()
+            return False
+        writer.write(MESSAGE_HEADER.pack(len(message)) + message)
+        return True
+
+    async def handle_worker(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """
+        Sends a snapshot to a newly connected worker and keeps it updated, \
+        the intraday bars following the rest of the snapshot in another message
+        """
+        self._LOGGER.info("Worker connected to the publisher.")
+        version = self.market_realtime_data.version
+        snapshot = self.payload_cache.global_snapshot("all", WireFormat.BINARY)
+        bars_snapshot = self.payload_cache.global_snapshot("bars", WireFormat.BINARY)
+        self.__workers[writer] = version
+        self.__write(
+            writer,
+            wire.stamp_sequence(snapshot, version)
+            if snapshot
+            else wire.encode_frame([], version),
+        )
+        if bars_snapshot:
+            self.__write(writer, wire.stamp_sequence(bars_snapshot, version))
+        try:
+            await reader.read()
+        except ConnectionError:
+            pass
+        finally:
+            self._LOGGER.info("Worker disconnected from the publisher.")
+            self.__workers.pop(writer, None)
+            writer.close()
+
+    async def serve(self, end_time: time | datetime = None) -> None:
+        """Publishes the updates to the workers until the market, or the given time, ends"""
+        self._LOGGER.info("Publishing has started on [%s].", self.socket_path)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.market_realtime_data.attach_event_loop(asyncio.get_running_loop())
+        dispatcher = asyncio.create_task(self.market_realtime_data.dispatch_updates())
+        try:
+            async with await asyncio.start_unix_server(
+                self.handle_worker, self.socket_path
+            ):
+                await sleep_until(end_time if end_time else MARKET_END_TIME)
+        finally:
+            self.market_realtime_data.detach_event_loop()
+            dispatcher.cancel()
+            for writer in list(self.__workers):
+                writer.close()
+            self.__workers.clear()
+        self._LOGGER.info("Publishing has ended.")
+
+
+class FanoutWorker(ReplicaServer):
+    """
+    Serves websocket clients from a replica of a crawler's repository, \
+    letting several workers share the same port through SO_REUSEPORT
+    """
+
+    _RECONNECT_WAIT: int = 1
+
+    def __init__(
+        self,
+        socket_path: str,
+        websocket_host: str,
+        websocket_port: int,
+        websocket_settings: TsetmcWebsocketSettings = None,
+    ):
+        websocket_settings = (
+            websocket_settings if websocket_settings else TsetmcWebsocketSettings()
+        )
+        websocket_settings.reuse_port = True
+        super().__init__(websocket_host, websocket_port, websocket_settings)
+        self.socket_path: str = socket_path
+
+    async def follow(self) -> None:
+        """Applies the published updates, reconnecting whenever the publisher drops"""
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.socket_path)
+            except OSError as ex:
+                self._LOGGER.error("Cannot connect to publisher: %s", repr(ex))
+                await asyncio.sleep(self._RECONNECT_WAIT)
+                continue
+            self._LOGGER.info("Worker is following the publisher.")
+            try:
+                await self.__apply_messages(reader)
+            except (asyncio.IncompleteReadError, ConnectionError) as ex:
+                self._LOGGER.error("Publisher connection lost: %s", repr(ex))
+            finally:
+                writer.close()
+            await asyncio.sleep(self._RECONNECT_WAIT)
+
+    async def __apply_messages(self, reader: asyncio.StreamReader) -> None:
+        """Applies the messages of a publisher connection, the first being a snapshot"""
+        snapshot = True
+        while True:
+            (length,) = MESSAGE_HEADER.unpack(
+                await reader.readexactly(MESSAGE_HEADER.size)
+            )
+            data = wire.decode_frame(await reader.readexactly(length))
+            version = data.pop(wire.SEQUENCE_KEY)
+            timing = data.pop(wire.TIMING_KEY, None)
+            self.market_realtime_data.apply_published_data(
+                data, version, snapshot, CycleTiming(*timing[:3]) if timing else None
+            )
+            snapshot = False
@@ -4,139 +4,463 @@ This module contains the operational classes in this project
 
 import asyncio
 import logging
-from datetime import datetime
+from time import monotonic
+from datetime import datetime, time
+from typing import Awaitable, Callable, TypeVar
 import httpx
 from tse_utils import tsetmc
 from tse_utils.tsetmc.models import TsetmcScrapeException
-from tsetmc_pusher.server.repository import MarketRealtimeData
-from tsetmc_pusher.server.websocket import TsetmcWebsocket
+from tsetmc_pusher.journal import JournalWriter
+from tsetmc_pusher.metrics import (
+    COUNT_BUCKETS,
+    SIZE_BUCKETS,
+    Counter,
+    Histogram,
+    MetricsServer,
+)
+from tsetmc_pusher.server.fanout import FanoutPublisher
+from tsetmc_pusher.server.parsing import PooledTsetmcScraper
+from tsetmc_pusher.server.repository import (
+    CycleTiming,
+    MarketRealtimeData,
+    MarketUpdateBatch,
+    now_stamp,
+)
+from tsetmc_pusher.server.scheduler import (
+    CrawlController,
+    CrawlControllerState,
+    CrawlScheduler,
+    CrawlSchedulerSettings,
+)
+from tsetmc_pusher.server.websocket import (
+    TsetmcWebsocket,
+    TsetmcWebsocketSettings,
+    encode_batch,
+)
 from tsetmc_pusher.timing import (
+    moment_of,
     sleep_until,
     MARKET_END_TIME,
     MARKET_START_TIME,
-    CRAWL_SLEEP_SECONDS,
-    TRADE_DATA_TIMEOUT_MAX,
-    TRADE_DATA_TIMEOUT_MIN,
-    TRADE_DATA_TIMEOUT_STEP,
-    CLIENT_TYPE_TIMEOUT_MAX,
-    CLIENT_TYPE_TIMEOUT_MIN,
-    CLIENT_TYPE_TIMEOUT_STEP,
 )
 
+UPSTREAM_SECONDS = Histogram(
+    "tsetmc_pusher_upstream_seconds",
+    "Latency of the successful requests sent to TSETMC.",
+    ("loop",),
+)
+UPSTREAM_RESPONSE_BYTES = Histogram(
+    "tsetmc_pusher_upstream_response_bytes",
+    "Size of the raw TSETMC responses, when they are parsed in the process pool.",
+    ("loop",),
+    SIZE_BUCKETS,
+)
+UPSTREAM_RESPONSE_ROWS = Histogram(
+    "tsetmc_pusher_upstream_response_rows",
+    "Instruments in the TSETMC responses.",
+    ("loop",),
+    COUNT_BUCKETS,
+)
+UPSTREAM_FAILURES = Counter(
+    "tsetmc_pusher_upstream_failures_total",
+    "Failed requests sent to TSETMC.",
+    ("loop", "reason"),
+)
+MARKET_WATCH_DIVERGENCES = Counter(
+    "tsetmc_pusher_market_watch_divergences_total",
+    "Instruments a full market watch repaired, which the deltas missed or left stale.",
+    ("kind",),
+)
+
+
+T = TypeVar("T")
+
 
-class TsetmcOperator:
+class TsetmcOperator:  # pylint: disable=too-many-instance-attributes
     """This module is responsible for continuously crawling TSETMC"""
 
     _LOGGER = logging.getLogger(__name__)
 
-    def __init__(self, websocket_host: str, websocket_port: int):
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        websocket_host: str,
+        websocket_port: int,
+        websocket_settings: TsetmcWebsocketSettings = None,
+        crawl_settings: CrawlSchedulerSettings = None,
+        scraper: tsetmc.TsetmcScraper = None,
+    ):
         self.market_realtime_date: MarketRealtimeData = MarketRealtimeData()
         self.websocket = TsetmcWebsocket(
             market_realtime_data=self.market_realtime_date,
             websocket_host=websocket_host,
             websocket_port=websocket_port,
+            settings=websocket_settings,
+        )
+        self.crawl_scheduler: CrawlScheduler = CrawlScheduler(crawl_settings)
+        # Another source, like a simulator, also serves the raw responses for pooling
+        self.__tsetmc_scraper = scraper if scraper else tsetmc.TsetmcScraper()
+        self.__pooled_scraper: PooledTsetmcScraper = (
+            PooledTsetmcScraper()
+            if self.crawl_scheduler.settings.parse_in_process_pool
+            else None
+        )
+        self.__raw_scraper = scraper if scraper else self.__pooled_scraper
+        self.__market_watch_request_ids: tuple[int, int] = None
+        self.__delta_isins: set[str] = set()
+        self.__incremental_cycles: int = 0
+        self.__last_full_market_watch: float = 0.0
+        self.__apply_tasks: dict[str, asyncio.Task] = {}
+        self.publisher: FanoutPublisher = None
+        self.journal: JournalWriter = None
+        self.metrics_server: MetricsServer = None
+
+    def publish_to_workers(self, socket_path: str) -> FanoutPublisher:
+        """Hands the updates to websocket worker processes instead of serving them"""
+        self.publisher = FanoutPublisher(self.market_realtime_date, socket_path)
+        return self.publisher
+
+    def journal_to(self, directory: str) -> JournalWriter:
+        """Appends every change applied to the repository to a daily journal"""
+        self.journal = JournalWriter(directory)
+        self.market_realtime_date.batch_listeners.append(
+            lambda x: self.journal.append(encode_batch(x, self.websocket.payload_cache))
+        )
+        return self.journal
+
+    def expose_metrics(self, host: str, port: int) -> MetricsServer:
+        """Serves the metrics over HTTP alongside the market time operations"""
+        self.metrics_server = MetricsServer(host, port)
+        return self.metrics_server
+
+    def crawl_state(self) -> dict[str, CrawlControllerState]:
+        """Returns the state of the crawl loops' controllers"""
+        return self.crawl_scheduler.state()
+
+    def __full_market_watch_due(self) -> bool:
+        """Checks if the next trade data catch should fetch the whole market watch"""
+        settings = self.crawl_scheduler.settings
+        return (
+            not settings.incremental_market_watch
+            or self.__market_watch_request_ids is None
+            or self.__incremental_cycles >= settings.full_market_watch_cycles
+            or monotonic() - self.__last_full_market_watch
+            >= settings.full_market_watch_seconds
         )
-        self.__trade_data_timeout: float = TRADE_DATA_TIMEOUT_MIN
-        self.__client_type_timeout: float = CLIENT_TYPE_TIMEOUT_MIN
-        self.__tsetmc_scraper = tsetmc.TsetmcScraper()
 
     async def __update_trade_data(self) -> None:
         """Updates trade data from TSETMC"""
+        controller = self.crawl_scheduler.trade
+        full = self.__full_market_watch_due()
         self._LOGGER.info(
-            "Trade data catch started, timeout: %.2f", self.__trade_data_timeout
+            "Trade data catch started, full: %s, timeout: %.2f, interval: %.2f",
+            full,
+            controller.timeout,
+            controller.interval,
         )
-        trade_data = await self.__tsetmc_scraper.get_market_watch(
-            # The following line has been removed because of a bug in TSETMC server \
-            # that ignores updates on some instruments, including options
-            # h_even=self.__max_trade_time_int, ref_id=self.__max_order_row_id
-            timeout=self.__trade_data_timeout
+        if full:
+            trade_data, timing = await self.__catch_market_watch(controller)
+        else:
+            # TSETMC server sometimes ignores updates on some instruments, \
+            # including options, in these deltas which full catches make up for
+            h_even, ref_id = self.__market_watch_request_ids
+            trade_data, timing = await self.__catch_market_watch(
+                controller, h_even=h_even, ref_id=ref_id
+            )
+        UPSTREAM_RESPONSE_ROWS.labels(controller.name).observe(len(trade_data or ()))
+        if full:
+            self.__incremental_cycles = 0
+            self.__last_full_market_watch = monotonic()
+        else:
+            self.__incremental_cycles += 1
+        if not trade_data:
+            return
+        watermark = self.__market_watch_request_ids if full else None
+        reported = self.__delta_isins
+        if full:
+            self.__delta_isins = set()
+        else:
+            reported.update(x.identification.isin for x in trade_data)
+        self.__advance_market_watch_request_ids(trade_data)
+        await self.__apply(
+            controller,
+            lambda: self.__apply_trade_data(trade_data, timing, watermark, reported),
         )
-        if trade_data:
-            self.market_realtime_date.apply_new_trade_data(trade_data)
+
+    @classmethod
+    async def __request(
+        cls, controller: CrawlController, request_func: Callable[[], Awaitable[T]]
+    ) -> tuple[T, CycleTiming]:
+        """
+        Sends a request through its loop's controller, recording its latency, \
+        and returns the response along with when it was sent and received
+        """
+        timing = CycleTiming(scrape_started=now_stamp())
+        started = monotonic()
+        response = await controller.request(request_func)
+        UPSTREAM_SECONDS.labels(controller.name).observe(monotonic() - started)
+        timing.scrape_received = now_stamp()
+        if isinstance(response, bytes):
+            UPSTREAM_RESPONSE_BYTES.labels(controller.name).observe(len(response))
+        return response, timing
+
+    async def __catch_market_watch(
+        self, controller: CrawlController, **request_ids: int
+    ) -> tuple[list[tsetmc.MarketWatchTradeData], CycleTiming]:
+        """Catches the market watch, parsing it on the worker process if pooled"""
+        if self.__pooled_scraper is None:
+            return await self.__request(
+                controller,
+                lambda: self.__tsetmc_scraper.get_market_watch(
+                    timeout=controller.timeout, **request_ids
+                ),
+            )
+        payload, timing = await self.__request(
+            controller,
+            lambda: self.__raw_scraper.fetch_market_watch(
+                timeout=controller.timeout, **request_ids
+            ),
+        )
+        return await self.__pooled_scraper.parse_market_watch(payload), timing
+
+    async def __catch_client_type(
+        self, controller: CrawlController
+    ) -> tuple[list[tsetmc.MarketWatchClientTypeData], CycleTiming]:
+        """Catches the client type, parsing it on the worker process if pooled"""
+        if self.__pooled_scraper is None:
+            return await self.__request(
+                controller,
+                lambda: self.__tsetmc_scraper.get_client_type_all(
+                    timeout=controller.timeout
+                ),
+            )
+        payload, timing = await self.__request(
+            controller,
+            lambda: self.__raw_scraper.fetch_client_type_all(
+                timeout=controller.timeout
+            ),
+        )
+        return await self.__pooled_scraper.parse_client_type(payload), timing
+
+    def __apply_trade_data(
+        self,
+        trade_data: list[tsetmc.MarketWatchTradeData],
+        timing: CycleTiming = None,
+        watermark: tuple[int, int] = None,
+        reported: set[str] = None,
+    ) -> None:
+        """
+        Applies caught trade data to the repository, counting the divergences \
+        a full market watch repairs when it follows the request ids of deltas
+        """
+        batch = self.market_realtime_date.apply_new_trade_data(trade_data, timing)
+        if watermark is None:
+            return
+        missed, stale, rows = self.count_divergences(
+            trade_data, batch, watermark, reported
+        )
+        MARKET_WATCH_DIVERGENCES.labels("missed").inc(missed)
+        MARKET_WATCH_DIVERGENCES.labels("stale").inc(stale)
+        self._LOGGER.info(
+            "Full market watch repaired %d instruments the deltas missed "
+            + "and %d they left stale, with %d orderbook rows.",
+            missed,
+            stale,
+            rows,
+        )
+
+    @classmethod
+    def count_divergences(
+        cls,
+        trade_data: list[tsetmc.MarketWatchTradeData],
+        batch: MarketUpdateBatch,
+        watermark: tuple[int, int],
+        reported: set[str],
+    ) -> tuple[int, int, int]:
+        """
+        Counts the instruments and orderbook rows a full market watch changed \
+        that are not newer than the request ids the deltas had reached, \
+        split by whether a delta had reported the instrument since the last full one
+        """
+        max_trade_time, max_order_row_id = watermark
+        by_isin = {x.identification.isin: x for x in trade_data}
+        diverged, rows = set(), 0
+        for instrument in batch.trade:
+            isin = instrument.identification.isin
+            if cls.time_int(by_isin[isin].last_trade_time) <= max_trade_time:
+                diverged.add(isin)
+        for instrument, indexes, _ in batch.orderbook:
+            isin = instrument.identification.isin
+            order_rows = by_isin[isin].orderbook.rows
+            stale_rows = sum(order_rows[x].row_id <= max_order_row_id for x in indexes)
+            if stale_rows:
+                diverged.add(isin)
+                rows += stale_rows
+        stale = len(diverged & reported)
+        return len(diverged) - stale, stale, rows
+
+    async def __apply(
+        self, controller: CrawlController, apply_func: Callable[[], None]
+    ) -> None:
+        """
+        Applies a caught response right away, or when overlapping, \
+        on a worker thread once the loop's previous response is applied, \
+        so that a loop has a single response being applied at a time
+        """
+        if not controller.settings.overlap_apply:
+            try:
+                apply_func()
+            except Exception:
+                await self.__forget_parsed()
+                raise
+            return
+        previous = self.__apply_tasks.get(controller.name)
+        if previous:
+            await asyncio.wait([previous])
+        self.__apply_tasks[controller.name] = asyncio.create_task(
+            self.__apply_in_thread(apply_func)
+        )
+
+    async def __apply_in_thread(self, apply_func: Callable[[], None]) -> None:
+        """Applies a response on a worker thread"""
+        try:
+            await asyncio.to_thread(apply_func)
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            self._LOGGER.error("Exception on applying response: %s", repr(ex))
+            await self.__forget_parsed()
+
+    async def __forget_parsed(self) -> None:
+        """
+        Makes the next catches hand back all instruments after a failed apply, \
+        as the worker has already taken the response's changes as seen
+        """
+        self.__market_watch_request_ids = None
+        if self.__pooled_scraper:
+            await self.__pooled_scraper.reset()
+
+    def __advance_market_watch_request_ids(
+        self, trade_data: list[tsetmc.MarketWatchTradeData]
+    ) -> None:
+        """Moves the market watch request ids past the applied trade data"""
+        if not self.crawl_scheduler.settings.incremental_market_watch:
+            return
+        request_ids = self.next_market_watch_request_ids(trade_data)
+        if self.__market_watch_request_ids:
+            request_ids = tuple(
+                max(x, y) for x, y in zip(request_ids, self.__market_watch_request_ids)
+            )
+        self.__market_watch_request_ids = request_ids
 
     @classmethod
     def next_market_watch_request_ids(cls, trade_data) -> tuple[int, int]:
         """Extracts the maximum trade time and orderbook row id"""
         max_order_row_id = max(
-            max(y.row_id for y in x.orderbook.rows) for x in trade_data if x.orderbook
+            (
+                max(y.row_id for y in x.orderbook.rows)
+                for x in trade_data
+                if x.orderbook and x.orderbook.rows
+            ),
+            default=0,
         )
         max_trade_time = max(x.last_trade_time for x in trade_data)
-        max_trade_time_int = (
-            max_trade_time.hour * 10000
-            + max_trade_time.minute * 100
-            + max_trade_time.second
-        )
-        return max_trade_time_int, max_order_row_id
+        return cls.time_int(max_trade_time), max_order_row_id
 
-    async def __perform_trade_data_loop(self) -> None:
-        """Perform the trade data tasks for the market open time"""
-        while datetime.now().time() < MARKET_END_TIME:
+    @classmethod
+    def time_int(cls, moment: time) -> int:
+        """Converts a trade time into the HHMMSS integer TSETMC requests use"""
+        return moment.hour * 10000 + moment.minute * 100 + moment.second
+
+    async def __perform_crawl_loop(
+        self,
+        controller: CrawlController,
+        update_func,
+        description: str,
+        end_time: time | datetime,
+    ) -> None:
+        """Performs a crawl task until the end time, paced by its controller"""
+        end_moment = moment_of(end_time)
+        while datetime.now() < end_moment:
+            await controller.wait_turn()
             try:
-                await self.__update_trade_data()
-                await asyncio.sleep(CRAWL_SLEEP_SECONDS)
-                self.__trade_data_timeout = max(
-                    TRADE_DATA_TIMEOUT_MIN,
-                    self.__trade_data_timeout - TRADE_DATA_TIMEOUT_STEP,
-                )
+                await update_func()
+            except (httpx.ReadTimeout, httpx.ConnectTimeout) as ex:
+                self._LOGGER.error("Timeout on catching %s: %s", description, repr(ex))
+                UPSTREAM_FAILURES.labels(controller.name, "timeout").inc()
+                controller.record_timeout()
             except (
                 ValueError,
                 TsetmcScrapeException,
                 httpx.RemoteProtocolError,
                 httpx.ReadError,
                 httpx.ConnectError,
-                httpx.ReadTimeout,
-                httpx.ConnectTimeout,
             ) as ex:
-                self._LOGGER.error("Exception on catching trade data: %s", repr(ex))
-                self.__trade_data_timeout = min(
-                    TRADE_DATA_TIMEOUT_MAX,
-                    self.__trade_data_timeout + TRADE_DATA_TIMEOUT_STEP,
+                self._LOGGER.error(
+                    "Exception on catching %s: %s", description, repr(ex)
                 )
+                UPSTREAM_FAILURES.labels(controller.name, "error").inc()
+                controller.record_error()
+
+    async def __perform_trade_data_loop(self, end_time: time | datetime) -> None:
+        """Perform the trade data tasks until the end time"""
+        await self.__perform_crawl_loop(
+            self.crawl_scheduler.trade,
+            self.__update_trade_data,
+            "trade data",
+            end_time,
+        )
 
     async def __update_client_type(self) -> None:
         """Updates client type from TSETMC"""
+        controller = self.crawl_scheduler.client_type
         self._LOGGER.info(
-            "Client type catch started, timeout: %.2f", self.__client_type_timeout
-        )
-        client_type = await self.__tsetmc_scraper.get_client_type_all(
-            timeout=self.__client_type_timeout
+            "Client type catch started, timeout: %.2f, interval: %.2f",
+            controller.timeout,
+            controller.interval,
         )
+        client_type, timing = await self.__catch_client_type(controller)
+        UPSTREAM_RESPONSE_ROWS.labels(controller.name).observe(len(client_type or ()))
         if client_type:
-            self.market_realtime_date.apply_new_client_type(client_type)
-
-    async def __perform_client_type_loop(self) -> None:
-        """Perform the client type tasks for the market open time"""
-        while datetime.now().time() < MARKET_END_TIME:
-            try:
-                await self.__update_client_type()
-                await asyncio.sleep(CRAWL_SLEEP_SECONDS)
-                self.__client_type_timeout = max(
-                    CLIENT_TYPE_TIMEOUT_MIN,
-                    self.__client_type_timeout - CLIENT_TYPE_TIMEOUT_STEP,
-                )
-            except (
-                ValueError,
-                TsetmcScrapeException,
-                httpx.RemoteProtocolError,
-                httpx.ReadError,
-                httpx.ConnectError,
-                httpx.ReadTimeout,
-                httpx.ConnectTimeout,
-            ) as ex:
-                self._LOGGER.error("Exception on catching client type: %s", repr(ex))
-                self.__client_type_timeout = min(
-                    CLIENT_TYPE_TIMEOUT_MAX,
-                    self.__client_type_timeout + CLIENT_TYPE_TIMEOUT_STEP,
-                )
+            await self.__apply(
+                controller,
+                lambda: self.market_realtime_date.apply_new_client_type(
+                    client_type, timing
+                ),
+            )
 
-    async def market_time_operations(self) -> None:
-        """Groups the different market time operations"""
-        group = asyncio.gather(
-            self.__perform_trade_data_loop(),
-            self.__perform_client_type_loop(),
-            self.websocket.serve_websocket(),
+    async def __perform_client_type_loop(self, end_time: time | datetime) -> None:
+        """Perform the client type tasks until the end time"""
+        await self.__perform_crawl_loop(
+            self.crawl_scheduler.client_type,
+            self.__update_client_type,
+            "client type",
+            end_time,
         )
-        await asyncio.wait_for(group, timeout=None)
+
+    async def market_time_operations(self, end_time: time | datetime = None) -> None:
+        """Groups the different market time operations, until the market or end time"""
+        end_time = end_time if end_time else MARKET_END_TIME
+        self.__market_watch_request_ids = None
+        if self.__pooled_scraper:
+            await self.__pooled_scraper.reset()
+        operations = [
+            self.__perform_trade_data_loop(end_time),
+            self.__perform_client_type_loop(end_time),
+            self.publisher.serve(end_time)
+            if self.publisher
+            else self.websocket.serve_websocket(end_time),
+        ]
+        if self.metrics_server:
+            operations.append(self.metrics_server.serve(end_time))
+        group = asyncio.gather(*operations)
+        try:
+            await asyncio.wait_for(group, timeout=None)
+        finally:
+            if self.__apply_tasks:
+                await asyncio.wait(self.__apply_tasks.values())
+                self.__apply_tasks.clear()
+            if self.journal:
+                self.journal.flush()
+            if self.__pooled_scraper:
+                self.__pooled_scraper.shutdown()
 
     async def perform_daily(self) -> None:
         """Daily tasks for the crawler are called from here"""
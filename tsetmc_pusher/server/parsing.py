@@ -0,0 +1,158 @@
+"""
+This module contains the parsing of TSETMC responses on a worker process
+"""
+import asyncio
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable
+import httpx
+from tse_utils.tsetmc import MarketWatchTradeData, MarketWatchClientTypeData
+from tse_utils.tsetmc.models import TsetmcScrapeException
+
+
+MARKET_WATCH_PATH: str = (
+    "api/ClosingPrice/GetMarketWatch?market=0"
+    + "".join(f"&paperTypes[{x}]={x + 1}" for x in range(9))
+    + "&showTraded=false&withBestLimits=true"
+)
+CLIENT_TYPE_PATH: str = "api/ClientType/GetClientTypeAll"
+TRADE_FIELDS: tuple[str] = (
+    "pMax",
+    "pMin",
+    "py",
+    "pdv",
+    "pf",
+    "pcl",
+    "pmx",
+    "pmn",
+    "qtc",
+    "qtj",
+    "ztt",
+    "hEven",
+)
+ORDERBOOK_FIELDS: tuple[str] = ("zmd", "qmd", "pmd", "zmo", "qmo", "pmo")
+CLIENT_TYPE_FIELDS: tuple[str] = (
+    "buy_I_Volume",
+    "buy_N_Volume",
+    "buy_CountI",
+    "buy_CountN",
+    "sell_I_Volume",
+    "sell_N_Volume",
+    "sell_CountI",
+    "sell_CountN",
+)
+_FINGERPRINTS: dict[str, dict[str, tuple]] = {"trade": {}, "clienttype": {}}
+
+
+def reset_fingerprints() -> None:
+    """Forgets the instruments seen by the worker, so all of them are parsed again"""
+    for fingerprints in _FINGERPRINTS.values():
+        fingerprints.clear()
+
+
+def parse_market_watch(payload: bytes) -> list[MarketWatchTradeData]:
+    """Parses a market watch response, keeping the instruments changed since last"""
+    fingerprints = _FINGERPRINTS["trade"]
+    changed = []
+    for row in json.loads(payload)["marketwatch"]:
+        fingerprint = (
+            tuple(row[x] for x in TRADE_FIELDS),
+            tuple(tuple(y[x] for x in ORDERBOOK_FIELDS) for y in row["blDs"]),
+        )
+        if fingerprints.get(row["insID"]) != fingerprint:
+            changed.append(MarketWatchTradeData(tsetmc_raw_data=row))
+            fingerprints[row["insID"]] = fingerprint
+    return changed
+
+
+def parse_client_type(payload: bytes) -> list[MarketWatchClientTypeData]:
+    """Parses a client type response, keeping the instruments changed since last"""
+    fingerprints = _FINGERPRINTS["clienttype"]
+    changed = []
+    for row in json.loads(payload)["clientTypeAllDto"]:
+        fingerprint = tuple(row[x] for x in CLIENT_TYPE_FIELDS)
+        if fingerprints.get(row["insCode"]) != fingerprint:
+            changed.append(MarketWatchClientTypeData(tsetmc_raw_data=row))
+            fingerprints[row["insCode"]] = fingerprint
+    return changed
+
+
+class PooledTsetmcScraper:
+    """
+    Fetches the raw TSETMC responses on the event loop and parses them \
+    on a worker process, which only hands back the changed instruments
+    """
+
+    _LOGGER = logging.getLogger(__name__)
+
+    def __init__(self, tsetmc_domain: str = "cdn.tsetmc.com"):
+        self.tsetmc_domain: str = tsetmc_domain
+        self.__client = httpx.AsyncClient(
+            headers={
+                "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) \
+                AppleWebKit/537.36 (KHTML, like Gecko) \
+                Chrome/89.0.4389.114 Safari/537.36",
+                "accept": "application/json, text/plain, */*",
+            },
+            base_url=f"https://{tsetmc_domain}/",
+        )
+        self.__executor: ProcessPoolExecutor = None
+
+    async def __fetch(self, path: str, timeout: float) -> bytes:
+        """Fetches the raw body of a TSETMC response"""
+        req = await self.__client.get(path, timeout=timeout)
+        if req.status_code != 200:
+            raise TsetmcScrapeException(
+                f"Bad response: [{req.status_code}]", status_code=req.status_code
+            )
+        return req.content
+
+    async def fetch_market_watch(
+        self, ref_id: int = 0, h_even: int = 0, timeout: float = 3
+    ) -> bytes:
+        """Fetches the raw market watch"""
+        return await self.__fetch(
+            f"{MARKET_WATCH_PATH}&hEven={h_even}&RefID={ref_id}", timeout
+        )
+
+    async def fetch_client_type_all(self, timeout: float = 3) -> bytes:
+        """Fetches the raw client type of all instruments"""
+        return await self.__fetch(CLIENT_TYPE_PATH, timeout)
+
+    async def parse_market_watch(self, payload: bytes) -> list[MarketWatchTradeData]:
+        """Parses a raw market watch on the worker process"""
+        return await self.__run(parse_market_watch, payload)
+
+    async def parse_client_type(
+        self, payload: bytes
+    ) -> list[MarketWatchClientTypeData]:
+        """Parses a raw client type on the worker process"""
+        return await self.__run(parse_client_type, payload)
+
+    async def reset(self) -> None:
+        """Makes the worker hand back all instruments on their next parse"""
+        await self.__run(reset_fingerprints)
+
+    async def __run(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Runs a function on the worker, replacing the worker if it has died"""
+        loop = asyncio.get_running_loop()
+        for _ in range(2):
+            if self.__executor is None:
+                self.__executor = ProcessPoolExecutor(
+                    max_workers=1, initializer=reset_fingerprints
+                )
+            try:
+                return await loop.run_in_executor(self.__executor, func, *args)
+            except BrokenProcessPool as ex:
+                self._LOGGER.error("Parser worker has died: %s", repr(ex))
+                self.__executor.shutdown(wait=False)
+                self.__executor = None
+        raise TsetmcScrapeException("Parser worker keeps dying")
+
+    def shutdown(self) -> None:
+        """Stops the worker process"""
+        if self.__executor:
+            self.__executor.shutdown(wait=False)
+            self.__executor = None
@@ -0,0 +1,112 @@
+"""
+This module contains the relay, serving the data of an upstream pusher
+"""
+import time
+from dataclasses import dataclass
+from tsetmc_pusher import wire
+from tsetmc_pusher.client import TsetmcClient, TsetmcClientSubscription
+from tsetmc_pusher.wire import WireFormat
+from tsetmc_pusher.server.repository import CycleTiming, MarketRealtimeData
+from tsetmc_pusher.server.replica import ReplicaServer
+from tsetmc_pusher.server.websocket import TsetmcWebsocketSettings
+
+
+@dataclass
+class RelayState:
+    """A snapshot of how far a relay lags its upstream"""
+
+    upstream_sequence: int
+    messages: int
+    pending_messages: int
+    seconds_since_message: float
+    apply_seconds: float
+
+
+class RelayClient(TsetmcClient):
+    """
+    Subscribes to all instruments of an upstream pusher and applies \
+    the received channel data to a repository as they are
+    """
+
+    def __init__(
+        self,
+        websocket_host: str,
+        websocket_port: int,
+        market_realtime_data: MarketRealtimeData,
+    ):
+        super().__init__(
+            websocket_host=websocket_host,
+            websocket_port=websocket_port,
+            subscription=TsetmcClientSubscription(
+                global_subscriber=True,
+                wire_format=WireFormat.BINARY,
+                sequenced=True,
+                timed=True,
+                bars=True,
+            ),
+        )
+        self.market_realtime_data: MarketRealtimeData = market_realtime_data
+        self.messages: int = 0
+        self.last_message_at: float = None
+        self.apply_seconds: float = 0.0
+
+    def process_message(self, message: str | bytes, received_at: int = None) -> None:
+        """
+        Applies a message to the repository without diffing the whole market, \
+        keeping the timing of the upstream crawl cycle for the downstream clients
+        """
+        started = time.monotonic()
+        data = wire.decode_message(message)
+        sequence = data.pop(wire.SEQUENCE_KEY, None)
+        timing = data.pop(wire.TIMING_KEY, None)
+        if timing:
+            self.record_latency(timing, received_at)
+            timing = CycleTiming(*timing[:3])
+        self.market_realtime_data.apply_published_data(data, timing=timing)
+        if sequence:
+            self.subscription.sequence = max(self.subscription.sequence, sequence)
+        self.messages += 1
+        self.last_message_at = time.monotonic()
+        self.apply_seconds = self.last_message_at - started
+
+
+class TsetmcRelay(ReplicaServer):
+    """
+    Serves downstream clients with the data of an upstream pusher, \
+    so that pushers can be chained instead of all crawling TSETMC
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        upstream_host: str,
+        upstream_port: int,
+        websocket_host: str,
+        websocket_port: int,
+        websocket_settings: TsetmcWebsocketSettings = None,
+    ):
+        super().__init__(websocket_host, websocket_port, websocket_settings)
+        self.upstream: RelayClient = RelayClient(
+            websocket_host=upstream_host,
+            websocket_port=upstream_port,
+            market_realtime_data=self.market_realtime_data,
+        )
+
+    def state(self) -> RelayState:
+        """Returns how far the relay lags its upstream"""
+        upstream = self.upstream
+        return RelayState(
+            upstream_sequence=upstream.subscription.sequence,
+            messages=upstream.messages,
+            pending_messages=upstream.pending_messages(),
+            seconds_since_message=time.monotonic() - upstream.last_message_at
+            if upstream.last_message_at
+            else None,
+            apply_seconds=upstream.apply_seconds,
+        )
+
+    async def follow(self) -> None:
+        """Follows the upstream pusher, reconnecting whenever it drops"""
+        try:
+            await self.upstream.infinite_operation()
+        finally:
+            self.upstream.stop_operation()
@@ -0,0 +1,59 @@
+"""
+This module contains the base of the servers fed by another pusher
+"""
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from datetime import datetime, time
+from tsetmc_pusher.metrics import MetricsServer
+from tsetmc_pusher.server.repository import MarketRealtimeData
+from tsetmc_pusher.server.websocket import TsetmcWebsocket, TsetmcWebsocketSettings
+from tsetmc_pusher.timing import sleep_until, MARKET_START_TIME
+
+
+class ReplicaServer(ABC):
+    """Serves websocket clients from a repository fed by another pusher"""
+
+    _LOGGER = logging.getLogger(__name__)
+
+    def __init__(
+        self,
+        websocket_host: str,
+        websocket_port: int,
+        websocket_settings: TsetmcWebsocketSettings = None,
+    ):
+        self.market_realtime_data: MarketRealtimeData = MarketRealtimeData()
+        self.websocket: TsetmcWebsocket = TsetmcWebsocket(
+            market_realtime_data=self.market_realtime_data,
+            websocket_host=websocket_host,
+            websocket_port=websocket_port,
+            settings=websocket_settings,
+        )
+        self.metrics_server: MetricsServer = None
+
+    def expose_metrics(self, host: str, port: int) -> MetricsServer:
+        """Serves the metrics over HTTP alongside the websocket"""
+        self.metrics_server = MetricsServer(host, port)
+        return self.metrics_server
+
+    @abstractmethod
+    async def follow(self) -> None:
+        """Keeps the repository in line with its source until cancelled"""
+
+    async def market_time_operations(self, end_time: time | datetime = None) -> None:
+        """Serves the clients while following the source"""
+        tasks = [asyncio.create_task(self.follow())]
+        if self.metrics_server:
+            tasks.append(asyncio.create_task(self.metrics_server.serve(end_time)))
+        try:
+            await self.websocket.serve_websocket(end_time)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def perform_daily(self) -> None:
+        """Daily tasks for the server are called from here"""
+        self._LOGGER.info("Replica daily tasks are starting.")
+        await sleep_until(MARKET_START_TIME)
+        await self.market_time_operations()
+        self._LOGGER.info("Replica market time has ended.")
@@ -2,53 +2,286 @@
 This module contains the classes needed for keeping realtime market data 
 """
 import asyncio
+import logging
 import threading
-from typing import Callable, Awaitable
+import time
+from collections import deque
+from operator import attrgetter
+from typing import Callable, Awaitable, Any
+from dataclasses import dataclass, field
 from datetime import datetime
 from tse_utils.models.instrument import Instrument, InstrumentIdentification
 from tse_utils.models.realtime import OrderBookRow, ClientType
 from tse_utils.tsetmc import MarketWatchTradeData, MarketWatchClientTypeData
+from tsetmc_pusher.bars import IntradayBars
+from tsetmc_pusher.metrics import COUNT_BUCKETS, Histogram
 
+PUBLISHED_FIELDS: dict[str, tuple[str, ...]] = {
+    "thresholds": ("order_limitations.max_price", "order_limitations.min_price"),
+    "trade": (
+        "intraday_trade_candle.close_price",
+        "intraday_trade_candle.last_price",
+        "intraday_trade_candle.last_trade_datetime",
+        "intraday_trade_candle.max_price",
+        "intraday_trade_candle.min_price",
+        "intraday_trade_candle.open_price",
+        "intraday_trade_candle.previous_price",
+        "intraday_trade_candle.trade_num",
+        "intraday_trade_candle.trade_value",
+        "intraday_trade_candle.trade_volume",
+    ),
+    "orderbook": (
+        "demand.num",
+        "demand.price",
+        "demand.volume",
+        "supply.num",
+        "supply.price",
+        "supply.volume",
+    ),
+    "clienttype": (
+        "client_type.legal.buy.num",
+        "client_type.legal.buy.volume",
+        "client_type.legal.sell.num",
+        "client_type.legal.sell.volume",
+        "client_type.natural.buy.num",
+        "client_type.natural.buy.volume",
+        "client_type.natural.sell.num",
+        "client_type.natural.sell.volume",
+    ),
+}
+SOURCE_CHANNELS: dict[str, tuple[str, ...]] = {
+    "trade": ("trade", "orderbook", "bars"),
+    "clienttype": ("clienttype",),
+    "published": ("trade", "orderbook", "clienttype", "bars"),
+}
+DIFF_SECONDS = Histogram(
+    "tsetmc_pusher_diff_seconds",
+    "Time spent diffing a response into the repository.",
+    ("source",),
+)
+CHANGED_INSTRUMENTS = Histogram(
+    "tsetmc_pusher_changed_instruments",
+    "Instruments whose channel is changed by a response.",
+    ("source", "channel"),
+    COUNT_BUCKETS,
+)
+CHANGED_ORDERBOOK_ROWS = Histogram(
+    "tsetmc_pusher_changed_orderbook_rows",
+    "Orderbook rows changed by a response.",
+    ("source",),
+    COUNT_BUCKETS,
+)
 
-class MarketRealtimeData:
+
+def assign_fields(target: Any, fields: tuple[str, ...], values: list) -> int:
+    """Sets the dotted fields of an object, returning a mask of the changed ones"""
+    changed = 0
+    for index, (path, value) in enumerate(zip(fields, values)):
+        owner_path, _, name = path.rpartition(".")
+        owner = attrgetter(owner_path)(target) if owner_path else target
+        if getattr(owner, name) != value:
+            setattr(owner, name, value)
+            changed |= 1 << index
+    return changed
+
+
+def assign_orderbook_rows(
+    instrument: Instrument, rows: list[list[int]]
+) -> tuple[list[int], list[int]]:
+    """Sets published orderbook rows, returning the changed ones and their fields"""
+    updated_rows, updated_fields = [], []
+    for row in rows:
+        fields = assign_fields(
+            instrument.orderbook.rows[row[0]], PUBLISHED_FIELDS["orderbook"], row[1:]
+        )
+        if fields:
+            updated_rows.append(row[0])
+            updated_fields.append(fields)
+    return updated_rows, updated_fields
+
+
+def now_stamp() -> int:
+    """Returns the wall clock time in microseconds, as used in timing stamps"""
+    return time.time_ns() // 1000
+
+
+@dataclass
+class CycleTiming:
+    """Holds when a crawl cycle's response was requested, received and applied"""
+
+    scrape_started: int = 0
+    scrape_received: int = 0
+    applied: int = 0
+
+    def stamps(self, pushed: int = None) -> tuple[int, int, int, int]:
+        """Returns the stamps of all timing stages, pushed now unless given"""
+        return (
+            self.scrape_started,
+            self.scrape_received,
+            self.applied,
+            pushed if pushed else now_stamp(),
+        )
+
+
+@dataclass
+class MarketUpdateBatch:
+    """Holds all the updates detected in a single crawl cycle"""
+
+    trade: list[Instrument] = field(default_factory=list)
+    # Each instrument's changed rows, along with a mask of the changed fields of each
+    orderbook: list[tuple[Instrument, list[int], list[int]]] = field(
+        default_factory=list
+    )
+    clienttype: list[Instrument] = field(default_factory=list)
+    # Each instrument's bars, along with the indexes of the changed ones
+    bars: list[tuple[IntradayBars, list[int]]] = field(default_factory=list)
+    version: int = 0
+    timing: CycleTiming = None
+
+    def is_empty(self) -> bool:
+        """Checks if the cycle has not changed anything"""
+        return not (self.trade or self.orderbook or self.clienttype or self.bars)
+
+
+def observe_batch(source: str, batch: MarketUpdateBatch, started: float) -> None:
+    """Records the diff time of a response and the size of its changes"""
+    DIFF_SECONDS.labels(source).observe(time.perf_counter() - started)
+    for channel in SOURCE_CHANNELS[source]:
+        CHANGED_INSTRUMENTS.labels(source, channel).observe(
+            len(getattr(batch, channel))
+        )
+        if channel == "orderbook":
+            CHANGED_ORDERBOOK_ROWS.labels(source).observe(
+                sum(len(x) for _, x, _ in batch.orderbook)
+            )
+
+
+class MarketRealtimeData:  # pylint: disable=too-many-instance-attributes
     """Holds all realtime data for market"""
 
-    def __init__(self):
+    _LOGGER = logging.getLogger(__name__)
+
+    def __init__(self, history_size: int = 600, bar_interval: int = 60):
         self.__instruments: list[Instrument] = []
+        self.__instruments_by_isin: dict[str, Instrument] = {}
+        self.__instruments_by_tsetmc_code: dict[str, Instrument] = {}
         self.__instruments_lock: threading.Lock = threading.Lock()
+        self.__bars: dict[str, IntradayBars] = {}
+        self.__bar_interval: int = bar_interval
+        # Versions start from the wall clock so they keep growing across restarts
+        self.__version: int = time.time_ns() // 1000
+        self.__channel_versions: dict[tuple[str, str], int] = {}
+        self.__history: deque[tuple[int, dict[tuple[str, str], set[int]]]] = deque(
+            maxlen=history_size
+        )
+        self.__history_start: int = self.__version + 1
         self.pusher_trade_data: Callable[
-            [list[Instrument]], Awaitable[None]
-        ] = lambda x: asyncio.sleep(0)
+            [list[Instrument], int, CycleTiming], Awaitable[None]
+        ] = lambda *_: asyncio.sleep(0)
         self.pusher_orderbook_data: Callable[
-            [list[tuple[Instrument, list[int]]]], Awaitable[None]
-        ] = lambda x: asyncio.sleep(0)
+            [list[tuple[Instrument, list[int], list[int]]], int, CycleTiming],
+            Awaitable[None],
+        ] = lambda *_: asyncio.sleep(0)
         self.pusher_clienttype_data: Callable[
-            [list[Instrument]], Awaitable[None]
-        ] = lambda x: asyncio.sleep(0)
+            [list[Instrument], int, CycleTiming], Awaitable[None]
+        ] = lambda *_: asyncio.sleep(0)
+        self.pusher_bars_data: Callable[
+            [list[tuple[IntradayBars, list[int]]], int, CycleTiming],
+            Awaitable[None],
+        ] = lambda *_: asyncio.sleep(0)
+        self.pusher_batch_data: Callable[[MarketUpdateBatch], Awaitable[None]] = None
+        self.batch_listeners: list[Callable[[MarketUpdateBatch], None]] = []
+        self.__dispatch_loop: asyncio.AbstractEventLoop = None
+        self.__dispatch_queue: asyncio.Queue = None
+
+    def attach_event_loop(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Hands the updates to a queue on the given loop instead of new threads, \
+        dispatch_updates should be running on the same loop to consume them
+        """
+        self.__dispatch_queue = asyncio.Queue()
+        self.__dispatch_loop = loop
+
+    def detach_event_loop(self) -> None:
+        """Goes back to dispatching the updates on new threads"""
+        self.__dispatch_loop = None
+        self.__dispatch_queue = None
+
+    async def dispatch_updates(self) -> None:
+        """Consumes the queued updates in order on the attached event loop"""
+        queue = self.__dispatch_queue
+        while True:
+            pusher, args = await queue.get()
+            try:
+                await pusher(*args)
+            except Exception as ex:  # pylint: disable=broad-exception-caught
+                self._LOGGER.error("Exception on dispatching updates: %s", repr(ex))
+
+    def __dispatch_batch(self, batch: MarketUpdateBatch) -> None:
+        """
+        Hands a cycle's updates to the batch listeners right away, \
+        then to the batch pusher or to each channel's pusher
+        """
+        if self.batch_listeners and not batch.is_empty():
+            for listener in self.batch_listeners:
+                try:
+                    listener(batch)
+                except Exception as ex:  # pylint: disable=broad-exception-caught
+                    self._LOGGER.error("Exception on batch listener: %s", repr(ex))
+        if self.pusher_batch_data is not None:
+            if not batch.is_empty():
+                self.__dispatch(self.pusher_batch_data, batch)
+            return
+        if batch.trade:
+            self.__dispatch(
+                self.pusher_trade_data, batch.trade, batch.version, batch.timing
+            )
+        if batch.orderbook:
+            self.__dispatch(
+                self.pusher_orderbook_data, batch.orderbook, batch.version, batch.timing
+            )
+        if batch.clienttype:
+            self.__dispatch(
+                self.pusher_clienttype_data,
+                batch.clienttype,
+                batch.version,
+                batch.timing,
+            )
+        if batch.bars:
+            self.__dispatch(
+                self.pusher_bars_data, batch.bars, batch.version, batch.timing
+            )
+
+    def __dispatch(self, pusher: Callable[..., Awaitable[None]], *args: Any) -> None:
+        """Hands the updates to their pusher"""
+        loop = self.__dispatch_loop
+        if loop is None:
+            threading.Thread(
+                target=asyncio.run, args=(pusher(*args),), daemon=True
+            ).start()
+        else:
+            loop.call_soon_threadsafe(self.__dispatch_queue.put_nowait, (pusher, args))
 
     def apply_new_client_type(
-        self, client_type: list[MarketWatchClientTypeData]
-    ) -> None:
-        """Applies the new client type to the repository"""
-        updated_clienttype_instruments = []
+        self,
+        client_type: list[MarketWatchClientTypeData],
+        timing: CycleTiming = None,
+    ) -> MarketUpdateBatch:
+        """Applies the new client type to the repository and returns the changes"""
+        started = time.perf_counter()
+        batch = MarketUpdateBatch(timing=timing)
         with self.__instruments_lock:
             for mwi in client_type:
-                instrument = next(
-                    (
-                        x
-                        for x in self.__instruments
-                        if x.identification.tsetmc_code == mwi.tsetmc_code
-                    ),
-                    None,
-                )
+                instrument = self.__instruments_by_tsetmc_code.get(mwi.tsetmc_code)
                 if instrument and instrument.client_type != mwi:
                     self.update_instrument_client_type(instrument.client_type, mwi)
-                    updated_clienttype_instruments.append(instrument)
-        threading.Thread(
-            target=asyncio.run,
-            args=(self.pusher_clienttype_data(updated_clienttype_instruments),),
-            daemon=True,
-        ).start()
+                    batch.clienttype.append(instrument)
+            self.__bump_versions(batch)
+        if timing:
+            timing.applied = now_stamp()
+        observe_batch("clienttype", batch, started)
+        self.__dispatch_batch(batch)
+        return batch
 
     def update_instrument_client_type(
         self, instrument_ct: ClientType, mwi_ct: ClientType
@@ -63,72 +296,227 @@ class MarketRealtimeData:
         instrument_ct.natural.sell.num = mwi_ct.natural.sell.num
         instrument_ct.natural.sell.volume = mwi_ct.natural.sell.volume
 
-    def apply_new_trade_data(self, trade_data: list[MarketWatchTradeData]) -> None:
-        """Applies the new trade data to the repository"""
-        updated_trade_instruments = []
-        updated_orderbook_instruments = []
+    def apply_new_trade_data(
+        self, trade_data: list[MarketWatchTradeData], timing: CycleTiming = None
+    ) -> MarketUpdateBatch:
+        """Applies the new trade data to the repository and returns the changes"""
+        started = time.perf_counter()
+        batch = MarketUpdateBatch(timing=timing)
         with self.__instruments_lock:
             for mwi in trade_data:
-                instrument = next(
-                    (
-                        x
-                        for x in self.__instruments
-                        if x.identification.isin == mwi.identification.isin
-                    ),
-                    None,
-                )
+                instrument = self.__instruments_by_isin.get(mwi.identification.isin)
                 if not instrument:
-                    instrument = Instrument(
-                        InstrumentIdentification(
-                            isin=mwi.identification.isin,
-                            tsetmc_code=mwi.identification.tsetmc_code,
-                            ticker=mwi.identification.ticker,
-                            name_persian=mwi.identification.name_persian,
-                        )
-                    )
-                    self.__instruments.append(instrument)
+                    instrument = self.__add_instrument(mwi.identification)
                 if not (
                     instrument.intraday_trade_candle.last_trade_datetime
                     and instrument.intraday_trade_candle.last_trade_datetime.time()
                     == mwi.last_trade_time
                 ):
-                    self.update_instrument_trade_data(instrument, mwi)
-                    updated_trade_instruments.append(instrument)
-                updated_rows = []
+                    bar_indexes = self.update_instrument_trade_data(instrument, mwi)
+                    batch.trade.append(instrument)
+                    if bar_indexes:
+                        batch.bars.append(
+                            (self.__bars[instrument.identification.isin], bar_indexes)
+                        )
+                updated_rows, updated_fields = [], []
                 for rn, row in enumerate(mwi.orderbook.rows):
                     if row != instrument.orderbook.rows[rn]:
-                        self.update_instrument_orderbook_row(
-                            instrument.orderbook.rows[rn], row
+                        updated_fields.append(
+                            self.update_instrument_orderbook_row(
+                                instrument.orderbook.rows[rn], row
+                            )
                         )
                         updated_rows.append(rn)
                 if updated_rows:
-                    updated_orderbook_instruments.append((instrument, updated_rows))
-        threading.Thread(
-            target=asyncio.run,
-            args=(self.pusher_trade_data(updated_trade_instruments),),
-            daemon=True,
-        ).start()
-        threading.Thread(
-            target=asyncio.run,
-            args=(self.pusher_orderbook_data(updated_orderbook_instruments),),
-            daemon=True,
-        ).start()
+                    batch.orderbook.append((instrument, updated_rows, updated_fields))
+            self.__bump_versions(batch)
+        if timing:
+            timing.applied = now_stamp()
+        observe_batch("trade", batch, started)
+        self.__dispatch_batch(batch)
+        return batch
+
+    def apply_published_data(
+        self,
+        data: dict[str, dict[str, list]],
+        version: int = None,
+        snapshot: bool = False,
+        timing: CycleTiming = None,
+    ) -> MarketUpdateBatch:
+        """
+        Applies the channel data published by another repository, adopting \
+        its version if given, a snapshot also restarting the history from it, \
+        and keeping the timing of the cycle that the source has applied
+        """
+        started = time.perf_counter()
+        batch = MarketUpdateBatch(timing=timing)
+        with self.__instruments_lock:
+            if snapshot and version is not None:
+                self.__history.clear()
+                self.__version = version
+                self.__history_start = version + 1
+            for isin, channels in data.items():
+                instrument = self.__instruments_by_isin.get(isin)
+                if not instrument:
+                    instrument = self.__add_instrument(
+                        InstrumentIdentification(isin=isin)
+                    )
+                trade_changed = False
+                for channel, values in channels.items():
+                    match channel:
+                        case "thresholds":
+                            trade_changed |= assign_fields(
+                                instrument, PUBLISHED_FIELDS[channel], values
+                            )
+                        case "trade":
+                            if isinstance(values[2], str):
+                                values = list(values)
+                                values[2] = datetime.fromisoformat(values[2])
+                            trade_changed |= assign_fields(
+                                instrument, PUBLISHED_FIELDS[channel], values
+                            )
+                        case "orderbook":
+                            updated_rows, updated_fields = assign_orderbook_rows(
+                                instrument, values
+                            )
+                            if updated_rows:
+                                batch.orderbook.append(
+                                    (instrument, updated_rows, updated_fields)
+                                )
+                        case "clienttype":
+                            if assign_fields(
+                                instrument, PUBLISHED_FIELDS[channel], values
+                            ):
+                                batch.clienttype.append(instrument)
+                        case "bars":
+                            self.__assign_bars(isin, values, batch)
+                if trade_changed:
+                    batch.trade.append(instrument)
+            self.__bump_versions(batch, version)
+        observe_batch("published", batch, started)
+        self.__dispatch_batch(batch)
+        return batch
+
+    def __bump_versions(self, batch: MarketUpdateBatch, version: int = None) -> None:
+        """
+        Marks the channels changed in a cycle with a new repository version, \
+        or with the given one when it is published by another repository
+        """
+        if version is not None:
+            self.__version = max(self.__version, version)
+        elif not batch.is_empty():
+            self.__version += 1
+        batch.version = self.__version
+        if batch.is_empty():
+            return
+        changes: dict[tuple[str, str], set[int]] = {}
+        for instrument in batch.trade:
+            changes[(instrument.identification.isin, "thresholds")] = set()
+            changes[(instrument.identification.isin, "trade")] = set()
+        for instrument, rows, _ in batch.orderbook:
+            changes[(instrument.identification.isin, "orderbook")] = set(rows)
+        for instrument in batch.clienttype:
+            changes[(instrument.identification.isin, "clienttype")] = set()
+        for bars, indexes in batch.bars:
+            changes[(bars.isin, "bars")] = set(indexes)
+        for key in changes:
+            self.__channel_versions[key] = self.__version
+        if len(self.__history) == self.__history.maxlen:
+            self.__history_start = self.__history[0][0] + 1
+        self.__history.append((self.__version, changes))
+
+    def changes_since(self, version: int) -> dict[tuple[str, str], set[int]]:
+        """
+        Merges the channels changed after a version, \
+        or returns None when the history no longer reaches back to it
+        """
+        with self.__instruments_lock:
+            if not self.__history_start - 1 <= version <= self.__version:
+                return None
+            changes: dict[tuple[str, str], set[int]] = {}
+            for entry_version, entry_changes in reversed(self.__history):
+                if entry_version <= version:
+                    break
+                for key, rows in entry_changes.items():
+                    changes.setdefault(key, set()).update(rows)
+        return changes
+
+    @property
+    def version(self) -> int:
+        """The repository version, bumped on every cycle that changes some data"""
+        return self.__version
+
+    def get_channel_version(self, isin: str, channel: str) -> int:
+        """Returns the version in which an instrument's channel last changed"""
+        return self.__channel_versions.get((isin, channel), 0)
+
+    def __get_or_add_bars(self, isin: str) -> IntradayBars:
+        """Returns the intraday bars of an instrument, adding them if missing"""
+        bars = self.__bars.get(isin)
+        if bars is None:
+            bars = self.__bars[isin] = IntradayBars(isin, self.__bar_interval)
+        return bars
+
+    def __assign_bars(
+        self, isin: str, rows: list[list[int]], batch: MarketUpdateBatch
+    ) -> None:
+        """Sets the published bars of an instrument, adding the changed ones to a batch"""
+        bars = self.__get_or_add_bars(isin)
+        indexes = bars.assign(rows)
+        if indexes:
+            batch.bars.append((bars, indexes))
+
+    def get_bars(self, isin: str) -> IntradayBars:
+        """Returns the intraday bars of an instrument, if it has traded"""
+        return self.__bars.get(isin)
+
+    def __add_instrument(self, identification: InstrumentIdentification) -> Instrument:
+        """Adds a new instrument to the repository and its indexes"""
+        instrument = Instrument(
+            InstrumentIdentification(
+                isin=identification.isin,
+                tsetmc_code=identification.tsetmc_code,
+                ticker=identification.ticker,
+                name_persian=identification.name_persian,
+            )
+        )
+        self.__instruments.append(instrument)
+        self.__instruments_by_isin[identification.isin] = instrument
+        if identification.tsetmc_code:
+            self.__instruments_by_tsetmc_code[identification.tsetmc_code] = instrument
+        return instrument
 
     def update_instrument_orderbook_row(
         self, instrument_obr: OrderBookRow, mwi_obr: OrderBookRow
-    ) -> None:
-        """Update a single row in instrument's order book"""
+    ) -> int:
+        """
+        Update a single row in instrument's order book, \
+        returning a mask of the changed fields in the order they are sent
+        """
+        demand, supply = instrument_obr.demand, instrument_obr.supply
+        fields = (
+            (demand.num != mwi_obr.demand.num)
+            | (demand.price != mwi_obr.demand.price) << 1
+            | (demand.volume != mwi_obr.demand.volume) << 2
+            | (supply.num != mwi_obr.supply.num) << 3
+            | (supply.price != mwi_obr.supply.price) << 4
+            | (supply.volume != mwi_obr.supply.volume) << 5
+        )
         instrument_obr.demand.num = mwi_obr.demand.num
         instrument_obr.demand.volume = mwi_obr.demand.volume
         instrument_obr.demand.price = mwi_obr.demand.price
         instrument_obr.supply.num = mwi_obr.supply.num
         instrument_obr.supply.volume = mwi_obr.supply.volume
         instrument_obr.supply.price = mwi_obr.supply.price
+        return fields
 
     def update_instrument_trade_data(
         self, instrument: Instrument, mwi: MarketWatchTradeData
-    ) -> None:
-        """Updates trade data for a single instrument"""
+    ) -> list[int]:
+        """
+        Updates trade data for a single instrument, \
+        returning the indexes of the intraday bars changed by its last trade
+        """
         instrument.order_limitations.max_price = mwi.price_thresholds.max_price
         instrument.order_limitations.min_price = mwi.price_thresholds.min_price
         instrument.intraday_trade_candle.previous_price = (
@@ -155,16 +543,19 @@ class MarketRealtimeData:
         instrument.intraday_trade_candle.last_trade_datetime = datetime.combine(
             datetime.today(), mwi.last_trade_time
         )
+        candle = instrument.intraday_trade_candle
+        return self.__get_or_add_bars(instrument.identification.isin).update(
+            candle.last_trade_datetime,
+            candle.last_price,
+            candle.trade_volume,
+            candle.max_price,
+            candle.min_price,
+        )
 
     def get_instruments(self, isins: list[str]) -> list[Instrument]:
         """Returns instruments matching with a list of isins"""
         with self.__instruments_lock:
-            instruments = [
-                next(
-                    (x for x in self.__instruments if x.identification.isin == y), None
-                )
-                for y in isins
-            ]
+            instruments = [self.__instruments_by_isin.get(x) for x in isins]
         return instruments
 
     def get_all_instruments(self) -> list[Instrument]:
@@ -0,0 +1,296 @@
+"""
+This module contains the adaptive scheduling of the requests sent to TSETMC
+"""
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, TypeVar
+from tsetmc_pusher.timing import (
+    CRAWL_SLEEP_SECONDS,
+    CRAWL_INTERVAL_MAX,
+    CRAWL_INTERVAL_STEP,
+    CRAWL_BACKOFF_FACTOR,
+    CRAWL_REQUEST_RATE,
+    CRAWL_PRIORITY_AGING,
+    FULL_MARKET_WATCH_CYCLES,
+    FULL_MARKET_WATCH_SECONDS,
+    TRADE_DATA_TIMEOUT_MAX,
+    TRADE_DATA_TIMEOUT_MIN,
+    CLIENT_TYPE_TIMEOUT_MAX,
+    CLIENT_TYPE_TIMEOUT_MIN,
+)
+
+T = TypeVar("T")
+
+
+@dataclass
+class CrawlControllerSettings:  # pylint: disable=too-many-instance-attributes
+    """Holds the bounds and the gains of a crawl loop's controller"""
+
+    min_interval: float = CRAWL_SLEEP_SECONDS
+    max_interval: float = CRAWL_INTERVAL_MAX
+    interval_step: float = CRAWL_INTERVAL_STEP
+    backoff_factor: float = CRAWL_BACKOFF_FACTOR
+    timeout_min: float = TRADE_DATA_TIMEOUT_MIN
+    timeout_max: float = TRADE_DATA_TIMEOUT_MAX
+    timeout_percentile: float = 0.95
+    timeout_factor: float = 2.0
+    window: int = 50
+    priority: int = 0
+    hedge_requests: bool = False
+    hedge_percentile: float = 0.9
+    overlap_apply: bool = False
+
+
+@dataclass
+class CrawlSchedulerSettings:  # pylint: disable=too-many-instance-attributes
+    """Holds the settings of the crawl loops and their shared request budget"""
+
+    trade: CrawlControllerSettings = field(
+        default_factory=lambda: CrawlControllerSettings(
+            timeout_min=TRADE_DATA_TIMEOUT_MIN,
+            timeout_max=TRADE_DATA_TIMEOUT_MAX,
+            priority=0,
+        )
+    )
+    client_type: CrawlControllerSettings = field(
+        default_factory=lambda: CrawlControllerSettings(
+            timeout_min=CLIENT_TYPE_TIMEOUT_MIN,
+            timeout_max=CLIENT_TYPE_TIMEOUT_MAX,
+            priority=1,
+        )
+    )
+    request_rate: float = CRAWL_REQUEST_RATE
+    priority_aging: float = CRAWL_PRIORITY_AGING
+    incremental_market_watch: bool = False
+    full_market_watch_cycles: int = FULL_MARKET_WATCH_CYCLES
+    full_market_watch_seconds: float = FULL_MARKET_WATCH_SECONDS
+    parse_in_process_pool: bool = False
+
+
+@dataclass
+class CrawlControllerState:  # pylint: disable=too-many-instance-attributes
+    """A snapshot of a crawl loop's controller"""
+
+    interval: float
+    timeout: float
+    latency_p50: float
+    latency_p95: float
+    error_rate: float
+    requests: int
+    errors: int
+    timeouts: int
+    hedges: int
+    hedge_wins: int
+
+
+class RequestBudget:  # pylint: disable=too-few-public-methods
+    """
+    Spaces the requests of all crawl loops, serving higher priorities first, \
+    a waiter gaining a priority level for each aging period it waits
+    """
+
+    def __init__(self, rate: float, aging: float = CRAWL_PRIORITY_AGING):
+        self.rate: float = rate
+        self.aging: float = aging
+        self.__next_slot: float = 0.0
+        self.__waiters: list[tuple[int, float, asyncio.Future]] = []
+        self.__timer: asyncio.TimerHandle = None
+
+    async def acquire(self, priority: int = 0) -> None:
+        """Waits for a request slot, lower numbers meaning higher priorities"""
+        future = asyncio.get_running_loop().create_future()
+        self.__waiters.append((priority, time.monotonic(), future))
+        if self.__timer is None:
+            self.__wake()
+        await future
+
+    def __wake(self) -> None:
+        """Hands the next free slot to the highest priority waiter"""
+        self.__timer = None
+        self.__waiters = [x for x in self.__waiters if not x[2].done()]
+        if not self.__waiters:
+            return
+        now = time.monotonic()
+        if now < self.__next_slot:
+            self.__timer = asyncio.get_running_loop().call_later(
+                self.__next_slot - now, self.__wake
+            )
+            return
+        waiter = min(
+            self.__waiters, key=lambda x: (x[0] - (now - x[1]) / self.aging, x[1])
+        )
+        self.__waiters.remove(waiter)
+        waiter[2].set_result(None)
+        self.__next_slot = now + 1 / self.rate
+        if self.__waiters:
+            self.__timer = asyncio.get_running_loop().call_later(
+                1 / self.rate, self.__wake
+            )
+
+
+class CrawlController:  # pylint: disable=too-many-instance-attributes
+    """
+    Adapts a crawl loop's interval additively on success and multiplicatively \
+    on failure, and its timeout to a percentile of the recent latencies
+    """
+
+    def __init__(
+        self, name: str, settings: CrawlControllerSettings, budget: RequestBudget
+    ):
+        self.name: str = name
+        self.settings: CrawlControllerSettings = settings
+        self.budget: RequestBudget = budget
+        self.interval: float = settings.min_interval
+        self.timeout: float = settings.timeout_min
+        self.requests: int = 0
+        self.errors: int = 0
+        self.timeouts: int = 0
+        self.hedges: int = 0
+        self.hedge_wins: int = 0
+        self.__latencies: deque[float] = deque(maxlen=settings.window)
+        self.__outcomes: deque[bool] = deque(maxlen=settings.window)
+        self.__last_start: float = None
+
+    async def wait_turn(self) -> None:
+        """
+        Waits for the loop's interval to pass since its last request started \
+        and for a slot in the budget, which caps the requests sent to TSETMC
+        """
+        if self.__last_start is not None:
+            await asyncio.sleep(
+                max(0.0, self.__last_start + self.interval - time.monotonic())
+            )
+        await self.budget.acquire(self.settings.priority)
+        self.__last_start = time.monotonic()
+
+    async def request(self, request_func: Callable[[], Awaitable[T]]) -> T:
+        """
+        Sends a request and records its outcome, sending an identical one \
+        when hedging and the first passes the hedge percentile of the latencies
+        """
+        started = time.monotonic()
+        if not (self.settings.hedge_requests and self.__latencies):
+            result = await request_func()
+            self.record_success(time.monotonic() - started)
+            return result
+        tasks = {asyncio.ensure_future(request_func()): started}
+        hedge = None
+        try:
+            done, pending = await asyncio.wait(
+                tasks, timeout=self.latency_percentile(self.settings.hedge_percentile)
+            )
+            if not done:
+                self.hedges += 1
+                hedge = asyncio.ensure_future(request_func())
+                tasks[hedge] = time.monotonic()
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        self.record_success(time.monotonic() - tasks[task])
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def record_success(self, latency: float) -> None:
+        """Speeds the loop up after a successful request"""
+        self.requests += 1
+        self.__latencies.append(latency)
+        self.__outcomes.append(True)
+        self.interval = max(
+            self.settings.min_interval, self.interval - self.settings.interval_step
+        )
+        self.__adapt_timeout()
+
+    def record_timeout(self) -> None:
+        """Backs off after a timed out request, counting its timeout as its latency"""
+        self.timeouts += 1
+        self.__latencies.append(self.timeout)
+        self.record_error()
+        self.timeout = min(
+            self.settings.timeout_max, self.timeout * self.settings.backoff_factor
+        )
+
+    def record_error(self) -> None:
+        """Backs off after a failed request"""
+        self.requests += 1
+        self.errors += 1
+        self.__outcomes.append(False)
+        self.interval = min(
+            self.settings.max_interval, self.interval * self.settings.backoff_factor
+        )
+        self.__adapt_timeout()
+
+    def __adapt_timeout(self) -> None:
+        """Keeps the timeout at a multiple of the latency percentile"""
+        if not self.__latencies:
+            return
+        self.timeout = min(
+            self.settings.timeout_max,
+            max(
+                self.settings.timeout_min,
+                self.latency_percentile(self.settings.timeout_percentile)
+                * self.settings.timeout_factor,
+            ),
+        )
+
+    def latency_percentile(self, percentile: float) -> float:
+        """Returns a percentile of the recent latencies"""
+        if not self.__latencies:
+            return 0.0
+        latencies = sorted(self.__latencies)
+        return latencies[min(len(latencies) - 1, int(percentile * len(latencies)))]
+
+    @property
+    def error_rate(self) -> float:
+        """Ratio of the failed requests among the recent ones"""
+        if not self.__outcomes:
+            return 0.0
+        return self.__outcomes.count(False) / len(self.__outcomes)
+
+    def state(self) -> CrawlControllerState:
+        """Returns a snapshot of the controller"""
+        return CrawlControllerState(
+            interval=self.interval,
+            timeout=self.timeout,
+            latency_p50=self.latency_percentile(0.5),
+            latency_p95=self.latency_percentile(0.95),
+            error_rate=self.error_rate,
+            requests=self.requests,
+            errors=self.errors,
+            timeouts=self.timeouts,
+            hedges=self.hedges,
+            hedge_wins=self.hedge_wins,
+        )
+
+
+class CrawlScheduler:  # pylint: disable=too-few-public-methods
+    """Groups the controllers of the crawl loops sharing a request budget"""
+
+    def __init__(self, settings: CrawlSchedulerSettings = None):
+        self.settings: CrawlSchedulerSettings = (
+            settings if settings else CrawlSchedulerSettings()
+        )
+        self.budget: RequestBudget = RequestBudget(
+            self.settings.request_rate, self.settings.priority_aging
+        )
+        self.trade: CrawlController = CrawlController(
+            "trade", self.settings.trade, self.budget
+        )
+        self.client_type: CrawlController = CrawlController(
+            "client_type", self.settings.client_type, self.budget
+        )
+
+    def state(self) -> dict[str, CrawlControllerState]:
+        """Returns a snapshot of every crawl loop's controller"""
+        return {x.name: x.state() for x in (self.trade, self.client_type)}
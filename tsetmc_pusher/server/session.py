@@ -0,0 +1,482 @@
+"""
+This module contains the outbound side of each client's websocket connection
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field, replace
+from enum import Enum
+from typing import Callable
+from websockets.sync.client import ClientConnection
+from websockets.exceptions import ConnectionClosed
+from tsetmc_pusher import wire
+from tsetmc_pusher.metrics import Counter, Histogram, HistogramChild, MetricChild
+from tsetmc_pusher.server.repository import CycleTiming
+from tsetmc_pusher.wire import WireFormat
+
+
+UpdateRenderer = Callable[
+    [
+        dict[tuple[str, str], set[int]],
+        WireFormat,
+        Callable[[str], "OrderbookFilter"],
+    ],
+    str | bytes,
+]
+GLOBAL_ISIN = "*"
+# Frames are only written on the event loop, so these skip locking
+FANOUT_SECONDS = Histogram(
+    "tsetmc_pusher_fanout_seconds",
+    "Time from queueing a frame for a client to writing it to the socket.",
+    ("channel",),
+    thread_safe=False,
+)
+FRAMES_SENT = Counter(
+    "tsetmc_pusher_frames_sent_total",
+    "Frames written to the clients.",
+    ("channel",),
+    thread_safe=False,
+)
+BYTES_SENT = Counter(
+    "tsetmc_pusher_bytes_sent_total",
+    "Bytes written to the clients.",
+    ("channel",),
+    thread_safe=False,
+)
+DROPPED_FRAMES = Counter(
+    "tsetmc_pusher_dropped_frames_total",
+    "Frames dropped from the send queues of slow clients.",
+)
+SENT_METRICS: dict[str, tuple[HistogramChild, MetricChild, MetricChild]] = {}
+
+
+class SlowConsumerPolicy(Enum):
+    """Identifies how a client that cannot keep up with the pushes is treated"""
+
+    DROP_OLDEST = "drop_oldest"
+    CONFLATE = "conflate"
+    DISCONNECT = "disconnect"
+
+
+@dataclass
+class SendQueueSettings:
+    """Holds the bounds of the clients' send queues"""
+
+    max_queue_size: int = 10000
+    policy: SlowConsumerPolicy = SlowConsumerPolicy.DROP_OLDEST
+    lag_threshold: float = 30.0
+
+
+@dataclass(frozen=True)
+class OrderbookFilter:
+    """Holds the orderbook depth and the row fields a client has asked for"""
+
+    depth: int = None
+    fields_mask: int = wire.ORDERBOOK_ALL_FIELDS
+
+    def visible_rows(self, rows: list[int], fields: list[int] = None) -> list[int]:
+        """
+        Keeps the changed rows within the depth, dropping the ones \
+        whose changed fields, when known, are all filtered out
+        """
+        return [
+            x
+            for index, x in enumerate(rows)
+            if (self.depth is None or x < self.depth)
+            and (fields is None or fields[index] & self.fields_mask)
+        ]
+
+    def filter_update(self, update: "InstrumentUpdate") -> "InstrumentUpdate":
+        """Narrows an orderbook update to its visible rows, or None if there are none"""
+        rows = self.visible_rows(update.rows, update.fields)
+        if not rows:
+            return None
+        if len(rows) == len(update.rows):
+            return update
+        return InstrumentUpdate(update.isin, update.channel, rows, update.version)
+
+    def project(self, rows: list[list[int]]) -> list[list[int]]:
+        """Keeps the selected fields of the rows within the depth"""
+        if self.depth is not None:
+            rows = [x for x in rows if x[0] < self.depth]
+        return wire.project_orderbook_rows(rows, self.fields_mask)
+
+
+@dataclass
+class SubscriptionOptions:  # pylint: disable=too-many-instance-attributes
+    """
+    Holds the delivery options a client has asked for on subscription, \
+    the format, sequence and timing applying to its whole connection
+    """
+
+    conflate: bool = False
+    wire_format: WireFormat = WireFormat.JSON
+    sequence: int = None
+    sequenced: bool = False
+    timing: bool = False
+    max_rate: float = None
+    orderbook_depth: int = None
+    orderbook_fields: int = wire.ORDERBOOK_ALL_FIELDS
+
+    @property
+    def orderbook_filter(self) -> OrderbookFilter:
+        """The filter of the orderbook rows, or None when all are sent"""
+        if self.orderbook_depth is None and (
+            self.orderbook_fields == wire.ORDERBOOK_ALL_FIELDS
+        ):
+            return None
+        return OrderbookFilter(self.orderbook_depth, self.orderbook_fields)
+
+    @property
+    def merges_updates(self) -> bool:
+        """Whether updates are merged and rendered when sent instead of queued"""
+        return self.conflate or self.max_rate is not None
+
+    def with_connection_options(self, text: str) -> "SubscriptionOptions":
+        """
+        Returns a copy taking the connection wide options a text of options sets, \
+        keeping the current values of the ones it leaves out
+        """
+        given = self.parse(text)
+        keys = {x.partition("=")[0] for x in text.split(";")}
+        changes = {}
+        if "format" in keys:
+            changes["wire_format"] = given.wire_format
+        if "seq" in keys:
+            changes["sequenced"] = True
+        if "timing" in keys:
+            changes["timing"] = given.timing
+        return replace(self, **changes)
+
+    @classmethod
+    def parse(cls, text: str) -> "SubscriptionOptions":
+        """Parses the options given as key=value pairs separated by semicolons"""
+        options = cls()
+        for pair in filter(None, text.split(";")):
+            key, _, value = pair.partition("=")
+            match key:
+                case "conflate":
+                    options.conflate = value in ("1", "true")
+                case "format":
+                    options.wire_format = WireFormat(value)
+                case "seq":
+                    options.sequence = int(value)
+                    options.sequenced = True
+                case "timing":
+                    options.timing = value in ("1", "true")
+                case "rate":
+                    options.max_rate = float(value)
+                    if options.max_rate <= 0:
+                        raise ValueError(f"Rate [{value}] is not positive")
+                case "depth":
+                    options.orderbook_depth = int(value)
+                    if options.orderbook_depth <= 0:
+                        raise ValueError(f"Depth [{value}] is not positive")
+                case "fields":
+                    options.orderbook_fields = wire.orderbook_fields_mask(
+                        value.split(",")
+                    )
+                case _:
+                    raise ValueError(f"Unknown subscription option [{key}]")
+        return options
+
+
+@dataclass
+class PendingUpdates:
+    """
+    Holds the merged updates of the subscriptions sharing a maximum rate, \
+    along with the lowest and highest sequences of the updates held
+    """
+
+    updates: dict[tuple[str, str], set[int]] = field(default_factory=dict)
+    first_sequence: int = 0
+    sequence: int = 0
+    since: float = 0.0
+    timing: CycleTiming = None
+
+
+@dataclass
+class InstrumentUpdate:
+    """Identifies the changed data of an instrument's channel"""
+
+    isin: str
+    channel: str
+    rows: list[int] = None
+    version: int = 0
+    fields: list[int] = None
+
+    def key(self) -> tuple:
+        """Key of the data that a newer update on the same channel replaces"""
+        if self.rows is None:
+            return (self.isin, self.channel)
+        return (self.isin, self.channel, tuple(self.rows))
+
+
+def sent_metrics(channel: str) -> tuple[HistogramChild, MetricChild, MetricChild]:
+    """Returns the metrics of the frames sent on a channel"""
+    metrics = SENT_METRICS.get(channel)
+    if metrics is None:
+        metrics = SENT_METRICS[channel] = (
+            FANOUT_SECONDS.labels(channel),
+            FRAMES_SENT.labels(channel),
+            BYTES_SENT.labels(channel),
+        )
+    return metrics
+
+
+def message_channel(updates: list[InstrumentUpdate]) -> str:
+    """Names the channel of a frame for the metrics"""
+    if not updates:
+        return "snapshot"
+    if len(updates) == 1:
+        return updates[0].channel
+    return "batch"
+
+
+@dataclass
+class OutboundMessage:
+    """A single frame waiting in a client's send queue"""
+
+    payload: str | bytes
+    key: tuple = None
+    enqueued_at: float = 0.0
+    sequence: int = 0
+    channel: str = None
+    timing: CycleTiming = None
+
+
+class ClientSession:  # pylint: disable=too-many-instance-attributes
+    """Holds a client's bounded send queue and the task writing it to the socket"""
+
+    _LOGGER = logging.getLogger(__name__)
+
+    def __init__(
+        self,
+        client: ClientConnection,
+        settings: SendQueueSettings,
+        renderer: UpdateRenderer,
+    ):
+        self.client: ClientConnection = client
+        self.settings: SendQueueSettings = settings
+        self.options: SubscriptionOptions = SubscriptionOptions()
+        self.subscriptions: dict[tuple[str, str], SubscriptionOptions] = {}
+        self.renderer: UpdateRenderer = renderer
+        self.dropped_messages: int = 0
+        self.__queue: deque[OutboundMessage] = deque()
+        self.__pending_keys: dict[tuple, OutboundMessage] = {}
+        self.__dirty: dict[float, PendingUpdates] = {}
+        self.__next_render_at: dict[float, float] = {}
+        self.__ready: asyncio.Event = asyncio.Event()
+        self.__loop: asyncio.AbstractEventLoop = None
+        self.__writer: asyncio.Task = None
+        self.__closing: bool = False
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of frames, or conflated channels, waiting to be sent to the client"""
+        return len(self.__queue) + sum(len(x.updates) for x in self.__dirty.values())
+
+    def subscribe(
+        self, isin: str, channels: list[str], options: SubscriptionOptions
+    ) -> None:
+        """Keeps the options of a subscription to some channels of an instrument"""
+        for channel in channels:
+            self.subscriptions[(isin, channel)] = options
+
+    def unsubscribe(self, isin: str, channels: list[str]) -> None:
+        """Forgets the options of a subscription to some channels of an instrument"""
+        for channel in channels:
+            self.subscriptions.pop((isin, channel), None)
+
+    def subscription_options(self, isin: str, channel: str) -> SubscriptionOptions:
+        """
+        Returns the options of the subscription an instrument's channel \
+        is sent through, an instrument's own one going before the global one
+        """
+        options = self.subscriptions.get((isin, channel))
+        if options is None:
+            options = self.subscriptions.get((GLOBAL_ISIN, channel))
+        return options if options is not None else self.options
+
+    def orderbook_filter(self, isin: str) -> OrderbookFilter:
+        """Returns the filter of an instrument's orderbook rows, or None"""
+        return self.subscription_options(isin, "orderbook").orderbook_filter
+
+    def start(self) -> None:
+        """Starts the writer task on the running event loop"""
+        self.__loop = asyncio.get_running_loop()
+        self.__writer = asyncio.create_task(self.__write_loop())
+
+    def stop(self) -> None:
+        """Stops the writer task and drops the remaining frames"""
+        self.__closing = True
+        if self.__writer:
+            self.__writer.cancel()
+        self.__queue.clear()
+        self.__pending_keys.clear()
+        self.__dirty.clear()
+
+    def enqueue(
+        self,
+        payload: str | bytes,
+        updates: list[InstrumentUpdate] = None,
+        sequence: int = 0,
+        timing: CycleTiming = None,
+    ) -> None:
+        """
+        Queues a frame carrying some instrument updates for the client, \
+        along with the timing of their crawl cycle, safe to call from any thread
+        Without a payload, the updates are merged and rendered when sent
+        """
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if self.__loop is None or running_loop is self.__loop:
+            self.__enqueue(payload, updates, sequence, timing)
+        else:
+            self.__loop.call_soon_threadsafe(
+                self.__enqueue, payload, updates, sequence, timing
+            )
+
+    def __enqueue(
+        self,
+        payload: str | bytes,
+        updates: list[InstrumentUpdate],
+        sequence: int,
+        timing: CycleTiming,
+    ) -> None:
+        """Queues a frame, or marks its updates when conflating"""
+        if self.__closing:
+            return
+        if payload is None:
+            self.__mark_dirty(updates, sequence, timing)
+            return
+        key = updates[0].key() if updates and len(updates) == 1 else None
+        now = time.monotonic()
+        if self.settings.policy == SlowConsumerPolicy.CONFLATE and key is not None:
+            pending = self.__pending_keys.get(key)
+            if pending:
+                pending.payload = payload
+                pending.timing = timing
+                return
+        if self.settings.policy == SlowConsumerPolicy.DISCONNECT and (
+            len(self.__queue) >= self.settings.max_queue_size
+            or (
+                self.__queue
+                and now - self.__queue[0].enqueued_at > self.settings.lag_threshold
+            )
+        ):
+            self.__disconnect()
+            return
+        while len(self.__queue) >= self.settings.max_queue_size:
+            dropped = self.__queue.popleft()
+            self.__forget(dropped)
+            self.dropped_messages += 1
+            DROPPED_FRAMES.inc()
+            if dropped.sequence and self.options.sequenced:
+                # A gap in the sequence would go unnoticed, the client resumes instead
+                self.__disconnect()
+                return
+        message = OutboundMessage(
+            payload=payload,
+            key=key,
+            enqueued_at=now,
+            sequence=sequence,
+            channel=message_channel(updates),
+            timing=timing,
+        )
+        self.__queue.append(message)
+        if key is not None:
+            self.__pending_keys[key] = message
+        self.__ready.set()
+
+    def __mark_dirty(
+        self, updates: list[InstrumentUpdate], sequence: int, timing: CycleTiming
+    ) -> None:
+        """Merges updates into the channels waiting to be rendered at their rate"""
+        for update in updates:
+            max_rate = self.subscription_options(update.isin, update.channel).max_rate
+            pending = self.__dirty.get(max_rate)
+            if pending is None:
+                pending = self.__dirty[max_rate] = PendingUpdates(
+                    first_sequence=sequence, since=time.monotonic()
+                )
+            pending.first_sequence = min(pending.first_sequence, sequence)
+            pending.sequence = max(pending.sequence, sequence)
+            if timing:
+                pending.timing = timing
+            rows = pending.updates.setdefault((update.isin, update.channel), set())
+            if update.rows:
+                rows.update(update.rows)
+        self.__ready.set()
+
+    def __forget(self, message: OutboundMessage) -> None:
+        """Removes a frame that is leaving the queue from the key index"""
+        if message.key is not None and self.__pending_keys.get(message.key) is message:
+            del self.__pending_keys[message.key]
+
+    def __disconnect(self) -> None:
+        """Closes the connection to a client that has fallen too far behind"""
+        self._LOGGER.warning(
+            "Disconnecting slow consumer [%s] with %d queued frames.",
+            self.client.id,
+            len(self.__queue),
+        )
+        self.stop()
+        asyncio.ensure_future(self.client.close(code=1008, reason="Slow consumer"))
+
+    async def __write_loop(self) -> None:
+        """Writes the queued frames to the socket one by one"""
+        while True:
+            while not (self.__queue or self.__dirty):
+                self.__ready.clear()
+                await self.__ready.wait()
+            if self.__queue:
+                message = self.__queue.popleft()
+                self.__forget(message)
+                payload, sequence = message.payload, message.sequence
+                channel, enqueued_at = message.channel, message.enqueued_at
+                timing = message.timing
+            else:
+                max_rate = min(
+                    self.__dirty, key=lambda x: self.__next_render_at.get(x, 0.0)
+                )
+                if max_rate:
+                    # Lets the updates of the interval merge, queued frames going first
+                    delay = self.__next_render_at.get(max_rate, 0.0) - time.monotonic()
+                    if delay > 0:
+                        # Wakes up early for frames and faster subscriptions
+                        self.__ready.clear()
+                        try:
+                            await asyncio.wait_for(self.__ready.wait(), delay)
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+                    self.__next_render_at[max_rate] = time.monotonic() + 1 / max_rate
+                pending = self.__dirty.pop(max_rate)
+                sequence, timing = pending.sequence, pending.timing
+                channel, enqueued_at = "conflated", pending.since
+                payload = self.renderer(
+                    pending.updates, self.options.wire_format, self.orderbook_filter
+                )
+                if not payload:
+                    continue
+            if self.options.sequenced and self.__dirty:
+                # A client resuming from the stamp must not skip the updates held back
+                sequence = min(
+                    sequence, min(x.first_sequence for x in self.__dirty.values()) - 1
+                )
+            if self.options.sequenced and sequence > 0:
+                payload = wire.stamp_sequence(payload, sequence)
+            if self.options.timing and timing:
+                payload = wire.stamp_timing(payload, timing.stamps())
+            try:
+                await self.client.send(payload)
+            except ConnectionClosed:
+                return
+            fanout_seconds, frames_sent, bytes_sent = sent_metrics(channel)
+            fanout_seconds.observe(time.monotonic() - enqueued_at)
+            frames_sent.inc()
+            bytes_sent.inc(len(payload))
@@ -0,0 +1,302 @@
+"""
+This module contains the simulated TSETMC sources used for offline load tests
+"""
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from tse_utils.tsetmc import MarketWatchTradeData, MarketWatchClientTypeData
+from tsetmc_pusher.journal import JournalReader
+
+
+ORDERBOOK_DEPTH: int = 5
+TRADE_KEYS: tuple[str, ...] = (
+    "pcl",
+    "pdv",
+    "hEven",
+    "pmx",
+    "pmn",
+    "pf",
+    "py",
+    "ztt",
+    "qtc",
+    "qtj",
+)
+ORDERBOOK_KEYS: tuple[str, ...] = ("zmd", "pmd", "qmd", "zmo", "pmo", "qmo")
+CLIENT_TYPE_KEYS: tuple[str, ...] = (
+    "buy_CountN",
+    "buy_N_Volume",
+    "sell_CountN",
+    "sell_N_Volume",
+    "buy_CountI",
+    "buy_I_Volume",
+    "sell_CountI",
+    "sell_I_Volume",
+)
+
+
+def to_h_even(moment: datetime) -> int:
+    """Converts a moment into the time of day format used by TSETMC"""
+    return moment.hour * 10000 + moment.minute * 100 + moment.second
+
+
+def market_watch_row(isin: str, tsetmc_code: str, price: int = 1000) -> dict:
+    """Builds the market watch row of an instrument that has not traded yet"""
+    return {
+        "insCode": tsetmc_code,
+        "insID": isin,
+        "lva": isin[4:8],
+        "lvc": isin,
+        "ztd": 10**9,
+        "bv": 1,
+        "eps": None,
+        "pMax": price * 105 // 100,
+        "pMin": price * 95 // 100,
+        "py": price,
+        "pf": 0,
+        "pcl": price,
+        "pdv": price,
+        "pmx": 0,
+        "pmn": 0,
+        "ztt": 0,
+        "qtc": 0,
+        "qtj": 0,
+        "hEven": 0,
+        "blDs": [
+            {
+                "zmd": 0,
+                "qmd": 0,
+                "pmd": 0,
+                "zmo": 0,
+                "qmo": 0,
+                "pmo": 0,
+                "rid": 0,
+            }
+            for _ in range(ORDERBOOK_DEPTH)
+        ],
+    }
+
+
+def client_type_row(tsetmc_code: str) -> dict:
+    """Builds the client type row of an instrument that has not traded yet"""
+    return {"insCode": tsetmc_code} | {x: 0 for x in CLIENT_TYPE_KEYS}
+
+
+class SimulatedTsetmc:  # pylint: disable=unused-argument
+    """
+    Serves market watch and client type responses from simulated rows, \
+    in place of TsetmcScraper, both parsed and raw for the process pool
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency: float = latency
+        self.market_watch: dict[str, dict] = {}
+        self.client_type: dict[str, dict] = {}
+        self.requests: int = 0
+        self.__row_id: int = 0
+
+    def next_row_id(self) -> int:
+        """Returns a new orderbook row id, as TSETMC does on every row change"""
+        self.__row_id += 1
+        return self.__row_id
+
+    def advance(self) -> None:
+        """Moves the simulated market forward to the current time"""
+
+    def __changed_rows(self, h_even: int, ref_id: int) -> list[dict]:
+        """Returns the rows traded after a time or having newer orderbook rows"""
+        if not (h_even or ref_id):
+            return list(self.market_watch.values())
+        return [
+            x
+            for x in self.market_watch.values()
+            if x["hEven"] > h_even or any(y["rid"] > ref_id for y in x["blDs"])
+        ]
+
+    async def __respond(self) -> None:
+        """Advances the market and waits for the simulated latency"""
+        self.requests += 1
+        self.advance()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def get_market_watch(
+        self, ref_id: int = 0, h_even: int = 0, timeout: float = 3
+    ) -> list[MarketWatchTradeData]:
+        """Returns the parsed market watch, or its changes after the request ids"""
+        await self.__respond()
+        return [MarketWatchTradeData(x) for x in self.__changed_rows(h_even, ref_id)]
+
+    async def get_client_type_all(
+        self, timeout: float = 3
+    ) -> list[MarketWatchClientTypeData]:
+        """Returns the parsed client type of all instruments"""
+        await self.__respond()
+        return [MarketWatchClientTypeData(x) for x in self.client_type.values()]
+
+    async def fetch_market_watch(
+        self, ref_id: int = 0, h_even: int = 0, timeout: float = 3
+    ) -> bytes:
+        """Returns the raw market watch, or its changes after the request ids"""
+        await self.__respond()
+        return json.dumps({"marketwatch": self.__changed_rows(h_even, ref_id)}).encode()
+
+    async def fetch_client_type_all(self, timeout: float = 3) -> bytes:
+        """Returns the raw client type of all instruments"""
+        await self.__respond()
+        return json.dumps(
+            {"clientTypeAllDto": list(self.client_type.values())}
+        ).encode()
+
+
+@dataclass
+class SyntheticMarketSettings:
+    """Holds the size and the activity of a synthetic market"""
+
+    instruments: int = 1000
+    tick_rate: float = 50.0
+    orderbook_churn: float = 200.0
+    speed: float = 1.0
+    latency: float = 0.0
+    seed: int = 0
+
+
+class SyntheticTsetmc(SimulatedTsetmc):
+    """
+    Simulates a market of random walking instruments, trading and changing \
+    their orderbooks at the configured market-wide rates
+    """
+
+    def __init__(self, settings: SyntheticMarketSettings = None):
+        self.settings: SyntheticMarketSettings = (
+            settings if settings else SyntheticMarketSettings()
+        )
+        super().__init__(self.settings.latency)
+        self.__random: random.Random = random.Random(self.settings.seed)
+        for index in range(self.settings.instruments):
+            isin, code = f"IRO1S{index:07d}", str(10**8 + index)
+            row = market_watch_row(isin, code, self.__random.randrange(1000, 50000))
+            for number, orderbook_row in enumerate(row["blDs"]):
+                self.__fill_orderbook_row(row, number, orderbook_row)
+            self.market_watch[isin] = row
+            self.client_type[isin] = client_type_row(code)
+        self.__started: float = time.monotonic()
+        self.__start_moment: datetime = datetime.combine(
+            datetime.today(), datetime.min.time()
+        ) + timedelta(hours=9)
+        self.__simulated: float = 0.0
+        self.__pending_trades: float = 0.0
+        self.__pending_changes: float = 0.0
+
+    def advance(self) -> None:
+        """Applies the trades and orderbook changes due since the last advance"""
+        simulated = (time.monotonic() - self.__started) * self.settings.speed
+        elapsed, self.__simulated = simulated - self.__simulated, simulated
+        h_even = to_h_even(self.__start_moment + timedelta(seconds=simulated))
+        rows = list(self.market_watch.values())
+        self.__pending_trades += elapsed * self.settings.tick_rate
+        while self.__pending_trades >= 1:
+            self.__pending_trades -= 1
+            self.__trade(self.__random.choice(rows), h_even)
+        self.__pending_changes += elapsed * self.settings.orderbook_churn
+        while self.__pending_changes >= 1:
+            self.__pending_changes -= 1
+            row = self.__random.choice(rows)
+            number = self.__random.randrange(ORDERBOOK_DEPTH)
+            self.__fill_orderbook_row(row, number, row["blDs"][number])
+
+    def __trade(self, row: dict, h_even: int) -> None:
+        """Trades an instrument at a price a tick away from its last price"""
+        price = min(
+            row["pMax"],
+            max(row["pMin"], row["pdv"] + self.__random.choice((-1, 0, 1))),
+        )
+        volume = self.__random.randrange(1, 10000)
+        row["pf"] = row["pf"] or price
+        row["pmx"] = max(row["pmx"], price)
+        row["pmn"] = min(row["pmn"], price) if row["pmn"] else price
+        row["pcl"] = (row["pcl"] * row["qtj"] + price * volume) // (row["qtj"] + volume)
+        row["pdv"] = price
+        row["ztt"] += 1
+        row["qtj"] += volume
+        row["qtc"] += price * volume
+        row["hEven"] = h_even
+        client_type = self.client_type[row["insID"]]
+        buyer, seller = self.__random.choice("IN"), self.__random.choice("IN")
+        client_type[f"buy_Count{buyer}"] += 1
+        client_type[f"buy_{buyer}_Volume"] += volume
+        client_type[f"sell_Count{seller}"] += 1
+        client_type[f"sell_{seller}_Volume"] += volume
+
+    def __fill_orderbook_row(self, row: dict, number: int, orderbook_row: dict):
+        """Gives an orderbook row new random orders around the last price"""
+        orderbook_row.update(
+            zmd=self.__random.randrange(1, 20),
+            qmd=self.__random.randrange(1, 100000),
+            pmd=row["pdv"] - number - 1,
+            zmo=self.__random.randrange(1, 20),
+            qmo=self.__random.randrange(1, 100000),
+            pmo=row["pdv"] + number + 1,
+            rid=self.next_row_id(),
+        )
+
+
+class JournalReplayTsetmc(SimulatedTsetmc):
+    """
+    Replays the changes recorded in a journal as TSETMC responses, \
+    at a multiple of the speed they were recorded at
+    """
+
+    def __init__(self, path: str, speed: float = 1.0, latency: float = 0.0):
+        super().__init__(latency)
+        self.speed: float = speed
+        self.__reader: JournalReader = JournalReader(path)
+        self.__records = self.__reader.records()
+        self.__next = next(self.__records, None)
+        self.__started: float = time.monotonic()
+        self.__recorded_start: datetime = self.__next.timestamp if self.__next else None
+        self.__codes: dict[str, str] = {}
+
+    @property
+    def finished(self) -> bool:
+        """Checks if all recorded changes are replayed"""
+        return self.__next is None
+
+    def advance(self) -> None:
+        """Applies the recorded changes due since the replay started"""
+        if self.__next is None:
+            return
+        until = self.__recorded_start + timedelta(
+            seconds=(time.monotonic() - self.__started) * self.speed
+        )
+        while self.__next is not None and self.__next.timestamp <= until:
+            record = self.__next
+            row, client_type = self.__rows(record.isin)
+            match record.channel:
+                case "thresholds":
+                    row["pMax"], row["pMin"] = record.data
+                case "trade":
+                    values = list(record.data)
+                    values[2] = to_h_even(values[2]) if values[2] else 0
+                    row.update(zip(TRADE_KEYS, values))
+                case "orderbook":
+                    for values in record.data:
+                        row["blDs"][values[0]].update(
+                            zip(ORDERBOOK_KEYS, values[1:]), rid=self.next_row_id()
+                        )
+                case "clienttype":
+                    if record.data[0] is not None:
+                        client_type.update(zip(CLIENT_TYPE_KEYS, record.data))
+            self.__next = next(self.__records, None)
+        if self.__next is None:
+            self.__reader.close()
+
+    def __rows(self, isin: str) -> tuple[dict, dict]:
+        """Returns the rows of an instrument, adding them on its first record"""
+        if isin not in self.market_watch:
+            code = self.__codes.setdefault(isin, str(10**8 + len(self.__codes)))
+            self.market_watch[isin] = market_watch_row(isin, code)
+            self.client_type[isin] = client_type_row(code)
+        return self.market_watch[isin], self.client_type[isin]
@@ -2,97 +2,71 @@
 This module contains the websocket for TSETMC
 """
 import asyncio
+import functools
 import json
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import logging
+from datetime import datetime, time
 from typing import Callable, Awaitable
 from threading import Lock
 from websockets.server import serve
 from websockets.sync.client import ClientConnection
 from websockets.exceptions import ConnectionClosedError, ConnectionClosedOK
 from tse_utils.models.instrument import Instrument
-from tsetmc_pusher.server.repository import MarketRealtimeData
+from tsetmc_pusher.bars import IntradayBars
+from tsetmc_pusher.server.repository import (
+    CycleTiming,
+    MarketRealtimeData,
+    MarketUpdateBatch,
+)
+from tsetmc_pusher.server.channels import (
+    InstrumentChannel,
+    remove_subscriber,
+    subscribe_all,
+    subscribe_bars,
+    subscribe_clienttype,
+    subscribe_orderbook,
+    subscribe_trade,
+    unsubscribe_all,
+    unsubscribe_bars,
+    unsubscribe_clienttype,
+    unsubscribe_orderbook,
+    unsubscribe_trade,
+)
+from tsetmc_pusher.server.session import (
+    GLOBAL_ISIN,
+    ClientSession,
+    SendQueueSettings,
+    SubscriptionOptions,
+    InstrumentUpdate,
+    OrderbookFilter,
+)
+from tsetmc_pusher import wire
+from tsetmc_pusher.metrics import Gauge
+from tsetmc_pusher.wire import WireFormat
 from tsetmc_pusher.timing import sleep_until, MARKET_END_TIME
 
-
-@dataclass
-class InstrumentChannel:
-    """Holds essential channels for each instrument"""
-
-    isin: str = None
-    trade_subscribers: set[ClientConnection] = None
-    orderbook_subscribers: set[ClientConnection] = None
-    clienttype_subscribers: set[ClientConnection] = None
-
-    def __init__(self, isin: str):
-        self.isin = isin
-        self.trade_subscribers = set()
-        self.orderbook_subscribers = set()
-        self.clienttype_subscribers = set()
-
-    def __repr__(self) -> str:
-        return f"{self.isin}: {[x.id for x in self.orderbook_subscribers]}"
-
-
-def subscribe_trade(client: ClientConnection, instrument_channel: InstrumentChannel):
-    """Subscribe to instrument's trade data"""
-    instrument_channel.trade_subscribers.add(client)
-
-
-def subscribe_orderbook(
-    client: ClientConnection, instrument_channel: InstrumentChannel
-):
-    """Subscribe to instrument's orderbook data"""
-    instrument_channel.orderbook_subscribers.add(client)
-
-
-def subscribe_clienttype(
-    client: ClientConnection, instrument_channel: InstrumentChannel
-):
-    """Subscribe to instrument's clienttype data"""
-    instrument_channel.clienttype_subscribers.add(client)
-
-
-def subscribe_all(client: ClientConnection, instrument_channel: InstrumentChannel):
-    """Subscribe to all instrument's data"""
-    subscribe_trade(client, instrument_channel)
-    subscribe_orderbook(client, instrument_channel)
-    subscribe_clienttype(client, instrument_channel)
-
-
-def unsubscribe_trade(client: ClientConnection, instrument_channel: InstrumentChannel):
-    """Unsubscribe from instrument's trade data"""
-    try:
-        instrument_channel.trade_subscribers.remove(client)
-    except KeyError:
-        pass
-
-
-def unsubscribe_orderbook(
-    client: ClientConnection, instrument_channel: InstrumentChannel
-):
-    """Unsubscribe from instrument's orderbook data"""
-    try:
-        instrument_channel.orderbook_subscribers.remove(client)
-    except KeyError:
-        pass
+CONNECTIONS = Gauge("tsetmc_pusher_connections", "Connected websocket clients.")
+SUBSCRIPTIONS = Gauge(
+    "tsetmc_pusher_subscriptions",
+    "Subscriptions of the clients to instruments' or the global channels.",
+    ("scope", "channel"),
+)
+CLIENT_QUEUE_DEPTH = Gauge(
+    "tsetmc_pusher_client_queue_depth",
+    "Frames waiting in the send queue of each client.",
+    ("client",),
+)
 
 
-def unsubscribe_clienttype(
-    client: ClientConnection, instrument_channel: InstrumentChannel
-):
-    """Unsubscribe from instrument's clienttype data"""
-    try:
-        instrument_channel.clienttype_subscribers.remove(client)
-    except KeyError:
-        pass
-
+@dataclass
+class TsetmcWebsocketSettings:
+    """Holds the optional behaviours of the websocket server"""
 
-def unsubscribe_all(client: ClientConnection, instrument_channel: InstrumentChannel):
-    """Unsubscribe from all instrument's data"""
-    unsubscribe_trade(client, instrument_channel)
-    unsubscribe_orderbook(client, instrument_channel)
-    unsubscribe_clienttype(client, instrument_channel)
+    single_loop_dispatch: bool = False
+    batch_frames: bool = False
+    reuse_port: bool = False
+    send_queue: SendQueueSettings = field(default_factory=SendQueueSettings)
 
 
 def instrument_data_trade(instrument: Instrument) -> list:
@@ -102,7 +76,7 @@ def instrument_data_trade(instrument: Instrument) -> list:
         "trade": [
             instrument.intraday_trade_candle.close_price,
             instrument.intraday_trade_candle.last_price,
-            str(ltd),
+            ltd,
             instrument.intraday_trade_candle.max_price,
             instrument.intraday_trade_candle.min_price,
             instrument.intraday_trade_candle.open_price,
@@ -177,6 +151,11 @@ def instrument_data_thresholds(instrument: Instrument) -> list[int]:
     }
 
 
+def instrument_data_bars(bars: IntradayBars, indexes: list[int] = None) -> list:
+    """Convert instrument's intraday bars, or some of them, for websocket transfer"""
+    return {"bars": bars.rows(indexes) if bars else []}
+
+
 def instrument_data_all(instrument: Instrument) -> dict[str, list]:
     """Convert all instrument's data for websocket transfer"""
     return (
@@ -187,7 +166,210 @@ def instrument_data_all(instrument: Instrument) -> dict[str, list]:
     )
 
 
-class TsetmcWebsocket:
+CHANNEL_DATA_FUNCS: dict[str, Callable[[Instrument], dict[str, list]]] = {
+    "thresholds": instrument_data_thresholds,
+    "trade": instrument_data_trade,
+    "orderbook": instrument_data_orderbook,
+    "clienttype": instrument_data_clienttype,
+}
+SUBSCRIPTION_CHANNELS: dict[str, list[str]] = {
+    "all": ["thresholds", "trade", "orderbook", "clienttype"],
+    "trade": ["trade"],
+    "orderbook": ["orderbook"],
+    "clienttype": ["clienttype"],
+    "bars": ["bars"],
+}
+
+
+def encode_fragment(
+    isin: str,
+    data: dict[str, list],
+    wire_format: WireFormat = WireFormat.JSON,
+    fields_mask: int = wire.ORDERBOOK_ALL_FIELDS,
+) -> str | bytes:
+    """Encodes a single channel's data of an instrument as a fragment of a frame"""
+    if wire_format == WireFormat.BINARY:
+        ((channel, values),) = data.items()
+        return wire.encode_record(isin, channel, values, fields_mask)
+    trade = data.get("trade")
+    if trade and trade[2] is None:
+        # A missing trade time has always been sent as a string in JSON
+        data = {"trade": [*trade[:2], str(None), *trade[3:]]}
+    return json.dumps(data, default=str)[1:-1]
+
+
+def encode_orderbook_fragment(
+    isin: str,
+    data: dict[str, list],
+    wire_format: WireFormat = WireFormat.JSON,
+    orderbook_filter: OrderbookFilter = None,
+) -> str | bytes:
+    """Encodes an instrument's orderbook rows, keeping only what a filter selects"""
+    if orderbook_filter is None:
+        return encode_fragment(isin, data, wire_format)
+    return encode_fragment(
+        isin,
+        {"orderbook": orderbook_filter.project(data["orderbook"])},
+        wire_format,
+        orderbook_filter.fields_mask,
+    )
+
+
+def encode_frame(
+    fragments: dict[str, list[str | bytes]],
+    wire_format: WireFormat = WireFormat.JSON,
+) -> str | bytes:
+    """Joins the encoded fragments of instruments into a websocket frame"""
+    if wire_format == WireFormat.BINARY:
+        return wire.encode_frame([y for x in fragments.values() for y in x])
+    return (
+        "{"
+        + ", ".join(
+            f"{json.dumps(isin)}: {{{', '.join(x)}}}" for isin, x in fragments.items()
+        )
+        + "}"
+    )
+
+
+class PayloadCache:
+    """Shares the encoded channel data of instruments among all subscribers"""
+
+    def __init__(self, market_realtime_data: MarketRealtimeData):
+        self.market_realtime_data: MarketRealtimeData = market_realtime_data
+        self.__fragments: dict[
+            tuple[str, str, WireFormat, OrderbookFilter], tuple[int, str]
+        ] = {}
+        self.__global_snapshots: dict[
+            tuple[str, WireFormat, OrderbookFilter], tuple[int, str]
+        ] = {}
+
+    def fragment(
+        self,
+        instrument: Instrument,
+        channel: str,
+        wire_format: WireFormat = WireFormat.JSON,
+        orderbook_filter: OrderbookFilter = None,
+    ) -> str | bytes:
+        """
+        Returns an instrument's encoded channel data, encoding it only on change, \
+        the orderbook only holding what the filter selects
+        """
+        isin = instrument.identification.isin
+        if channel != "orderbook":
+            orderbook_filter = None
+        version = self.market_realtime_data.get_channel_version(isin, channel)
+        key = (isin, channel, wire_format, orderbook_filter)
+        cached = self.__fragments.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+        if channel == "bars":
+            bars = self.market_realtime_data.get_bars(isin)
+            fragment = (
+                encode_fragment(isin, instrument_data_bars(bars), wire_format)
+                if bars
+                else None
+            )
+        elif orderbook_filter:
+            fragment = encode_orderbook_fragment(
+                isin,
+                CHANNEL_DATA_FUNCS[channel](instrument),
+                wire_format,
+                orderbook_filter,
+            )
+        else:
+            fragment = encode_fragment(
+                isin, CHANNEL_DATA_FUNCS[channel](instrument), wire_format
+            )
+        self.__fragments[key] = (version, fragment)
+        return fragment
+
+    def snapshot(
+        self,
+        instruments: list[Instrument],
+        subscription: str,
+        wire_format: WireFormat = WireFormat.JSON,
+        orderbook_filter: OrderbookFilter = None,
+    ) -> str | bytes:
+        """
+        Returns the encoded frame holding the instruments' subscribed data, \
+        skipping the intraday bars of the instruments that have not traded yet
+        """
+        fragments = {}
+        for instrument in instruments:
+            if not instrument:
+                continue
+            instrument_fragments = [
+                x
+                for x in (
+                    self.fragment(instrument, y, wire_format, orderbook_filter)
+                    for y in SUBSCRIPTION_CHANNELS[subscription]
+                )
+                if x is not None
+            ]
+            if instrument_fragments:
+                fragments[instrument.identification.isin] = instrument_fragments
+        return encode_frame(fragments, wire_format) if fragments else None
+
+    def global_snapshot(
+        self,
+        subscription: str,
+        wire_format: WireFormat = WireFormat.JSON,
+        orderbook_filter: OrderbookFilter = None,
+    ) -> str | bytes:
+        """Returns the encoded frame holding the subscribed data of all instruments"""
+        version = self.market_realtime_data.version
+        key = (subscription, wire_format, orderbook_filter)
+        cached = self.__global_snapshots.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+        frame = self.snapshot(
+            self.market_realtime_data.get_all_instruments(),
+            subscription,
+            wire_format,
+            orderbook_filter,
+        )
+        self.__global_snapshots[key] = (version, frame)
+        return frame
+
+
+def encode_batch(batch: MarketUpdateBatch, payload_cache: PayloadCache = None) -> bytes:
+    """Encodes the changed channels of a crawl cycle, and its timing, into a binary frame"""
+
+    def fragment(instrument: Instrument, channel: str) -> bytes:
+        if payload_cache:
+            return payload_cache.fragment(instrument, channel, WireFormat.BINARY)
+        return encode_fragment(
+            instrument.identification.isin,
+            CHANNEL_DATA_FUNCS[channel](instrument),
+            WireFormat.BINARY,
+        )
+
+    records = []
+    for instrument in batch.trade:
+        records.append(fragment(instrument, "thresholds"))
+        records.append(fragment(instrument, "trade"))
+    for instrument, rows, _ in batch.orderbook:
+        records.append(
+            encode_fragment(
+                instrument.identification.isin,
+                instrument_data_orderbook_rows(instrument, rows),
+                WireFormat.BINARY,
+            )
+        )
+    for instrument in batch.clienttype:
+        records.append(fragment(instrument, "clienttype"))
+    for bars, indexes in batch.bars:
+        records.append(
+            encode_fragment(
+                bars.isin, instrument_data_bars(bars, indexes), WireFormat.BINARY
+            )
+        )
+    return wire.encode_frame(
+        records, batch.version, batch.timing.stamps() if batch.timing else None
+    )
+
+
+class TsetmcWebsocket:  # pylint: disable=too-many-instance-attributes
     """Holds the websocket for TSETMC"""
 
     _LOGGER = logging.getLogger(__name__)
@@ -197,151 +379,425 @@ class TsetmcWebsocket:
         market_realtime_data: MarketRealtimeData,
         websocket_host: str,
         websocket_port: int,
+        settings: TsetmcWebsocketSettings = None,
     ):
         self.market_realtime_data: MarketRealtimeData = market_realtime_data
         self.websocket_host: str = websocket_host
         self.websocket_port: int = websocket_port
-        self.__channels: list[InstrumentChannel] = []
+        self.settings: TsetmcWebsocketSettings = (
+            settings if settings else TsetmcWebsocketSettings()
+        )
+        self.__channels: dict[str, InstrumentChannel] = {}
+        self.__client_channels: dict[ClientConnection, set[str]] = {}
+        self.__sessions: dict[ClientConnection, ClientSession] = {}
         self.__channels_lock = Lock()
-        self.__global_channel: InstrumentChannel = InstrumentChannel(isin="*")
+        self.__global_channel: InstrumentChannel = InstrumentChannel(isin=GLOBAL_ISIN)
+        self.payload_cache: PayloadCache = PayloadCache(market_realtime_data)
         self.set_market_realtime_data_pushers()
+        CONNECTIONS.set_function(lambda: len(self.__sessions))
+        SUBSCRIPTIONS.set_function(self.subscription_counts)
+        CLIENT_QUEUE_DEPTH.set_function(
+            lambda: {(x,): y for x, y in self.client_queue_depths().items()}
+        )
 
     def set_market_realtime_data_pushers(self) -> None:
         """Sets the pusher methods for market realtime data"""
         self.market_realtime_data.pusher_trade_data = self.pusher_trade_data
         self.market_realtime_data.pusher_orderbook_data = self.pusher_orderbook_data
         self.market_realtime_data.pusher_clienttype_data = self.pusher_clienttype_data
+        self.market_realtime_data.pusher_bars_data = self.pusher_bars_data
+        if self.settings.batch_frames:
+            self.market_realtime_data.pusher_batch_data = self.pusher_batch_data
+
+    def __channel_endpoints(
+        self,
+        isin: str,
+        subscribers: Callable[[InstrumentChannel], set[ClientConnection]],
+    ) -> set[ClientConnection]:
+        """Takes a copy of an instrument's subscribers, including global ones"""
+        with self.__channels_lock:
+            channel = self.__channels.get(isin)
+            endpoints = set(subscribers(self.__global_channel))
+            if channel:
+                endpoints.update(subscribers(channel))
+        return endpoints
+
+    def update_fragment(
+        self, instrument: Instrument, update: InstrumentUpdate
+    ) -> Callable[[WireFormat, OrderbookFilter], str | bytes]:
+        """
+        Returns an encoder of an update's channel data for any wire format, \
+        the orderbook rows only holding what an optional filter selects
+        """
+        if update.channel == "orderbook":
+            return functools.cache(
+                lambda x, y=None: encode_orderbook_fragment(
+                    update.isin,
+                    instrument_data_orderbook_rows(
+                        instrument,
+                        y.visible_rows(update.rows, update.fields)
+                        if y
+                        else update.rows,
+                    ),
+                    x,
+                    y,
+                )
+            )
+        if update.channel == "bars":
+            return functools.cache(
+                lambda x, y=None: encode_fragment(
+                    update.isin,
+                    instrument_data_bars(
+                        self.market_realtime_data.get_bars(update.isin), update.rows
+                    ),
+                    x,
+                )
+            )
+        return lambda x, y=None: self.payload_cache.fragment(
+            instrument, update.channel, x
+        )
+
+    def __push(
+        self, instrument: Instrument, update: InstrumentUpdate, timing: CycleTiming
+    ) -> None:
+        """Pushes a single update to the subscribers of its channel"""
+        endpoints = self.__channel_endpoints(
+            update.isin, lambda x: x.subscribers(update.channel)
+        )
+        if endpoints:
+            # The rest of the update's version may still be on its way
+            self.broadcast(
+                endpoints,
+                update,
+                self.update_fragment(instrument, update),
+                max(update.version - 1, 0),
+                timing,
+            )
 
     async def pusher_trade_data(
-        self, instruments: list[Instrument]
-    ) -> Callable[[list[Instrument]], Awaitable[None]]:
+        self,
+        instruments: list[Instrument],
+        version: int = 0,
+        timing: CycleTiming = None,
+    ) -> Callable[[list[Instrument], int, CycleTiming], Awaitable[None]]:
         """Returns the pusher_trade_data to override in repo"""
         for instrument in instruments:
-            with self.__channels_lock:
-                channel = next(
-                    (
-                        x
-                        for x in self.__channels
-                        if x.isin == instrument.identification.isin
-                    ),
-                    None,
-                )
-                endpoints = self.__global_channel.trade_subscribers
-                if channel:
-                    endpoints = endpoints.union(channel.trade_subscribers)
-                if endpoints:
-                    await self.broadcast(
-                        endpoints,
-                        json.dumps(
-                            {
-                                instrument.identification.isin: instrument_data_trade(
-                                    instrument
-                                )
-                            }
-                        ),
-                    )
+            self.__push(
+                instrument,
+                InstrumentUpdate(
+                    instrument.identification.isin, "trade", version=version
+                ),
+                timing,
+            )
 
     async def pusher_orderbook_data(
-        self, instruments: list[tuple[Instrument, list[int]]]
-    ) -> Callable[[list[tuple[Instrument, list[int]]]], Awaitable[None]]:
+        self,
+        instruments: list[tuple[Instrument, list[int], list[int]]],
+        version: int = 0,
+        timing: CycleTiming = None,
+    ) -> Callable[
+        [list[tuple[Instrument, list[int], list[int]]], int, CycleTiming],
+        Awaitable[None],
+    ]:
         """Returns the pusher_orderbook_data to override in repo"""
-        for instrument, rows in instruments:
-            with self.__channels_lock:
-                channel = next(
-                    (
-                        x
-                        for x in self.__channels
-                        if x.isin == instrument.identification.isin
-                    ),
-                    None,
-                )
-                endpoints = self.__global_channel.orderbook_subscribers
-                if channel:
-                    endpoints = endpoints.union(channel.orderbook_subscribers)
-                if endpoints:
-                    await self.broadcast(
-                        endpoints,
-                        json.dumps(
-                            {
-                                instrument.identification.isin: instrument_data_orderbook_rows(
-                                    instrument, rows
-                                )
-                            }
-                        ),
-                    )
+        for instrument, rows, fields in instruments:
+            self.__push(
+                instrument,
+                InstrumentUpdate(
+                    instrument.identification.isin, "orderbook", rows, version, fields
+                ),
+                timing,
+            )
 
     async def pusher_clienttype_data(
-        self, instruments: list[Instrument]
-    ) -> Callable[[list[Instrument]], Awaitable[None]]:
+        self,
+        instruments: list[Instrument],
+        version: int = 0,
+        timing: CycleTiming = None,
+    ) -> Callable[[list[Instrument], int, CycleTiming], Awaitable[None]]:
         """Returns the pusher_clienttype_data to override in repo"""
         for instrument in instruments:
-            with self.__channels_lock:
-                channel = next(
-                    (
-                        x
-                        for x in self.__channels
-                        if x.isin == instrument.identification.isin
-                    ),
-                    None,
+            self.__push(
+                instrument,
+                InstrumentUpdate(
+                    instrument.identification.isin, "clienttype", version=version
+                ),
+                timing,
+            )
+
+    async def pusher_bars_data(
+        self,
+        instruments: list[tuple[IntradayBars, list[int]]],
+        version: int = 0,
+        timing: CycleTiming = None,
+    ) -> Callable[
+        [list[tuple[IntradayBars, list[int]]], int, CycleTiming], Awaitable[None]
+    ]:
+        """Returns the pusher_bars_data to override in repo"""
+        for bars, indexes in instruments:
+            # The bars are read from the repository rather than from the instrument
+            self.__push(
+                None,
+                InstrumentUpdate(bars.isin, "bars", indexes, version),
+                timing,
+            )
+
+    async def pusher_batch_data(self, batch: MarketUpdateBatch) -> None:
+        """Pushes all updates of a crawl cycle as a single frame per client"""
+        updates = (
+            [(x, InstrumentUpdate(x.identification.isin, "trade")) for x in batch.trade]
+            + [
+                (x, InstrumentUpdate(x.identification.isin, "orderbook", y, fields=z))
+                for x, y, z in batch.orderbook
+            ]
+            + [
+                (x, InstrumentUpdate(x.identification.isin, "clienttype"))
+                for x in batch.clienttype
+            ]
+            + [(None, InstrumentUpdate(x.isin, "bars", y)) for x, y in batch.bars]
+        )
+        client_updates: dict[
+            ClientConnection,
+            list[
+                tuple[
+                    InstrumentUpdate,
+                    Callable[[WireFormat, OrderbookFilter], str | bytes],
+                ]
+            ],
+        ] = {}
+        for instrument, update in updates:
+            fragment = self.update_fragment(instrument, update)
+            for client in self.__channel_endpoints(
+                update.isin, lambda x, y=update: x.subscribers(y.channel)
+            ):
+                client_updates.setdefault(client, []).append((update, fragment))
+        for client, pairs in client_updates.items():
+            session = self.__sessions.get(client)
+            if session:
+                self.__enqueue_batch(session, pairs, batch)
+
+    def __enqueue_batch(
+        self,
+        session: ClientSession,
+        pairs: list[
+            tuple[
+                InstrumentUpdate, Callable[[WireFormat, OrderbookFilter], str | bytes]
+            ]
+        ],
+        batch: MarketUpdateBatch,
+    ) -> None:
+        """
+        Queues a client's share of a crawl cycle as a single frame, \
+        merging the updates of the subscriptions that are merged instead
+        """
+        wire_format = session.options.wire_format
+        merged_updates: list[InstrumentUpdate] = []
+        sent_updates: list[InstrumentUpdate] = []
+        fragments: dict[str, list[str | bytes]] = {}
+        for update, fragment in pairs:
+            options = session.subscription_options(update.isin, update.channel)
+            orderbook_filter = (
+                options.orderbook_filter if update.channel == "orderbook" else None
+            )
+            if orderbook_filter:
+                update = orderbook_filter.filter_update(update)
+                if not update:
+                    continue
+            if options.merges_updates:
+                merged_updates.append(update)
+                continue
+            sent_updates.append(update)
+            fragments.setdefault(update.isin, []).append(
+                fragment(wire_format, orderbook_filter)
+            )
+        if merged_updates:
+            session.enqueue(None, merged_updates, batch.version, batch.timing)
+        if sent_updates:
+            session.enqueue(
+                encode_frame(fragments, wire_format),
+                sent_updates,
+                batch.version,
+                batch.timing,
+            )
+
+    def render_updates(
+        self,
+        updates: dict[tuple[str, str], set[int]],
+        wire_format: WireFormat = WireFormat.JSON,
+        orderbook_filters: Callable[[str], OrderbookFilter] = None,
+    ) -> str | bytes:
+        """
+        Encodes the current data of conflated updates into a single frame, \
+        filtering each instrument's orderbook as its subscription asks
+        """
+        fragments: dict[str, list[str | bytes]] = {}
+        instruments = dict(
+            zip(
+                (x[0] for x in updates),
+                self.market_realtime_data.get_instruments([x[0] for x in updates]),
+            )
+        )
+        for (isin, channel), rows in updates.items():
+            instrument = instruments[isin]
+            if not instrument:
+                continue
+            orderbook_filter = (
+                orderbook_filters(isin)
+                if channel == "orderbook" and orderbook_filters
+                else None
+            )
+            if orderbook_filter:
+                rows = orderbook_filter.visible_rows(sorted(rows))
+                if not rows:
+                    continue
+            fragment = self.update_fragment(
+                instrument,
+                InstrumentUpdate(
+                    isin,
+                    channel,
+                    sorted(rows) if channel in ("orderbook", "bars") else None,
+                ),
+            )
+            fragments.setdefault(isin, []).append(
+                fragment(wire_format, orderbook_filter)
+            )
+        return encode_frame(fragments, wire_format) if fragments else None
+
+    def send(
+        self, client: ClientConnection, message: str | bytes, sequence: int = 0
+    ) -> None:
+        """Queues a message on a client's session"""
+        session = self.__sessions.get(client)
+        if session:
+            session.enqueue(message, sequence=sequence)
+
+    def broadcast(  # pylint: disable=too-many-arguments
+        self,
+        clients: set[ClientConnection],
+        update: InstrumentUpdate,
+        fragment: Callable[[WireFormat], str | bytes],
+        sequence: int = 0,
+        timing: CycleTiming = None,
+    ) -> None:
+        """
+        Broadcast an update to a bunch of users, each in its own wire format, \
+        skipping the orderbook updates that only touch what a user filters out
+        """
+        frames: dict[tuple[WireFormat, OrderbookFilter], str | bytes] = {}
+        filtered: dict[OrderbookFilter, InstrumentUpdate] = {}
+        for client in clients:
+            session = self.__sessions.get(client)
+            if not session:
+                continue
+            client_update = update
+            options = session.subscription_options(update.isin, update.channel)
+            orderbook_filter = (
+                options.orderbook_filter if update.channel == "orderbook" else None
+            )
+            if orderbook_filter:
+                if orderbook_filter not in filtered:
+                    filtered[orderbook_filter] = orderbook_filter.filter_update(update)
+                client_update = filtered[orderbook_filter]
+                if client_update is None:
+                    continue
+            if options.merges_updates:
+                session.enqueue(None, [client_update], sequence, timing)
+                continue
+            view = (session.options.wire_format, orderbook_filter)
+            if view not in frames:
+                frames[view] = encode_frame(
+                    {update.isin: [fragment(*view)]}, session.options.wire_format
                 )
-                endpoints = self.__global_channel.clienttype_subscribers
-                if channel:
-                    endpoints = endpoints.union(channel.clienttype_subscribers)
-                if endpoints:
-                    await self.broadcast(
-                        endpoints,
-                        json.dumps(
-                            {
-                                instrument.identification.isin: instrument_data_clienttype(
-                                    instrument
-                                )
-                            }
-                        ),
-                    )
-
-    @classmethod
-    async def try_send(cls, client: ClientConnection, message: str) -> None:
-        """Tries sending a message to a client"""
-        try:
-            await client.send(message)
-        except ConnectionClosedOK:
-            pass
-
-    @classmethod
-    async def broadcast(cls, clients: list[ClientConnection], message: str) -> None:
-        """Broadcast a message to a bunch of users"""
-        group = asyncio.gather(*[cls.try_send(client, message) for client in clients])
-        await asyncio.wait_for(group, timeout=None)
+            session.enqueue(frames[view], [client_update], sequence, timing)
+
+    def open_session(self, client: ClientConnection) -> ClientSession:
+        """Starts the outbound session for a newly connected client"""
+        session = ClientSession(
+            client=client,
+            settings=self.settings.send_queue,
+            renderer=self.render_updates,
+        )
+        session.start()
+        self.__sessions[client] = session
+        return session
+
+    def close_session(self, client: ClientConnection) -> None:
+        """Stops the outbound session of a disconnected client"""
+        session = self.__sessions.pop(client, None)
+        if session:
+            session.stop()
+
+    def client_queue_depths(self) -> dict[str, int]:
+        """Returns the number of frames queued for each connected client"""
+        return {str(x.id): y.queue_depth for x, y in list(self.__sessions.items())}
+
+    def subscription_counts(self) -> dict[tuple[str, str], int]:
+        """Returns the number of subscriptions to each channel"""
+        counts = {}
+        with self.__channels_lock:
+            for channel in ("trade", "orderbook", "clienttype", "bars"):
+                counts[("global", channel)] = len(
+                    self.__global_channel.subscribers(channel)
+                )
+                counts[("instrument", channel)] = sum(
+                    len(x.subscribers(channel)) for x in self.__channels.values()
+                )
+        return counts
 
     async def handle_connection(self, client: ClientConnection) -> None:
         """Handles the clients' connections"""
         self._LOGGER.info("Connection opened to [%s]", client.id)
+        self.open_session(client)
         try:
             async for message in client:
                 self._LOGGER.info(
                     "Receieved message [%s] from [%s]", message, client.id
                 )
+                version = self.market_realtime_data.version
                 response = self.handle_connection_message(client, message)
                 if response:
-                    await client.send(json.dumps(response))
+                    self.send(client, response, version)
         except (ConnectionClosedError, ConnectionClosedOK):
             pass
         finally:
             self._LOGGER.info("Connection closed to [%s]", client.id)
             self._LOGGER.info("Removing [%s] from all channels", client.id)
             self.remove_from_channels(client)
+            self.close_session(client)
 
     def remove_from_channels(self, client: ClientConnection) -> None:
-        """Removes a client from all channels"""
+        """Removes a client from all channels it has joined"""
         with self.__channels_lock:
-            for channel in self.__channels:
-                unsubscribe_all(client, channel)
+            for isin in self.__client_channels.pop(client, set()):
+                if isin == self.__global_channel.isin:
+                    remove_subscriber(client, self.__global_channel)
+                    continue
+                channel = self.__channels.get(isin)
+                if channel:
+                    remove_subscriber(client, channel)
+                    if channel.is_empty():
+                        del self.__channels[isin]
+
+    def __update_client_channels(
+        self, client: ClientConnection, channel: InstrumentChannel
+    ) -> None:
+        """Keeps the client's reverse index in line with a channel's subscribers"""
+        if channel.has_subscriber(client):
+            self.__client_channels.setdefault(client, set()).add(channel.isin)
+            return
+        client_channels = self.__client_channels.get(client)
+        if client_channels is not None:
+            client_channels.discard(channel.isin)
+            if not client_channels:
+                del self.__client_channels[client]
+        if channel is not self.__global_channel and channel.is_empty():
+            self.__channels.pop(channel.isin, None)
 
     def __message_is_invalid(self, message: str, message_parts: list[str]) -> bool:
         """Checks if client message is valid"""
         acceptable_actions = ["0", "1"]
-        acceptable_channels = ["all", "trade", "orderbook", "clienttype"]
-        if len(message_parts) != 3:
+        acceptable_channels = ["all", "trade", "orderbook", "clienttype", "bars"]
+        if len(message_parts) not in (3, 4):
             self._LOGGER.error("Message [%s] has unacceptable format.", message)
             return True
         if message_parts[0] not in acceptable_actions:
@@ -352,52 +808,137 @@ class TsetmcWebsocket:
             return True
         return False
 
-    def handle_connection_message(self, client: ClientConnection, message: str) -> dict:
+    def __parse_options(self, message_parts: list[str]) -> SubscriptionOptions:
+        """Parses the subscription options of a message, or returns None if invalid"""
+        if len(message_parts) < 4:
+            return SubscriptionOptions()
+        try:
+            return SubscriptionOptions.parse(message_parts[3])
+        except ValueError as ex:
+            self._LOGGER.error(
+                "Options [%s] are not acceptable: %s", message_parts[3], ex
+            )
+            return None
+
+    def __apply_options(
+        self,
+        session: ClientSession,
+        message_parts: list[str],
+        isins: list[str],
+        options: SubscriptionOptions,
+    ) -> None:
+        """
+        Keeps the options of a message on the client's session, \
+        the connection wide ones only changing when the message sets them
+        """
+        if not session:
+            return
+        if len(message_parts) == 4:
+            session.options = session.options.with_connection_options(message_parts[3])
+        channels = SUBSCRIPTION_CHANNELS[message_parts[1]]
+        for isin in isins:
+            if message_parts[0] == "1":
+                session.subscribe(isin, channels, options)
+            else:
+                session.unsubscribe(isin, channels)
+
+    def handle_connection_message(
+        self, client: ClientConnection, message: str
+    ) -> str | bytes:
         """
-        Handles a single message from client
-        Standard message format is: <Action>.<Channel>.<Isin1>,<Isin2>,...
+        Handles a single message from client and returns the encoded initial data
+        Standard message format is: <Action>.<Channel>.<Isin1>,<Isin2>,...[.<Options>]
         For instance: 1.trade.IRO1FOLD0001,IRO1IKCO0001
+        Options are key=value pairs separated by semicolons, e.g. 1.all.*.format=binary
+        Sending the last received sequence, e.g. 1.all.*.seq=123, replays missed updates
+        A maximum rate, e.g. 1.all.*.rate=5, merges the updates sent per second
+        The orderbook may be limited to some rows and fields, e.g. depth=1;fields=price
+        The format, seq and timing options hold for the whole connection until changed, \
+        the others only for the channels and instruments of their message
+        Intraday bars are opt-in, as they are not part of all, e.g. 1.bars.IRO1FOLD0001
         """
-        message_parts = message.split(".")
+        message_parts = message.split(".", 3)
         if self.__message_is_invalid(message, message_parts):
             return None
-        global_subscription_requested = message_parts[2] == "*"
+        options = self.__parse_options(message_parts)
+        if options is None:
+            return None
+        action, subscription = message_parts[0], message_parts[1]
+        global_subscription_requested = message_parts[2] == GLOBAL_ISIN
         if global_subscription_requested:
-            instruments = self.market_realtime_data.get_all_instruments()
-            isins = [x.identification.isin for x in instruments]
+            isins = [self.__global_channel.isin]
         else:
             isins = message_parts[2].split(",")
             fake_isin = next((x for x in isins if len(x) != 12), None)
             if fake_isin:
                 self._LOGGER.error("Isin [%s] is not acceptable.", fake_isin)
                 return None
-            instruments = self.market_realtime_data.get_instruments(isins)
-        channel_action_func = self.get_channel_action_func(
-            message_parts[0], message_parts[1]
-        )
-        initial_data_func = self.get_initial_data_func(
-            message_parts[0], message_parts[1]
-        )
-        initial_data = {}
+        channel_action_func = self.get_channel_action_func(action, subscription)
         with self.__channels_lock:
-            if global_subscription_requested:
-                channel_action_func(client, self.__global_channel)
-                for instrument in instruments:
-                    if instrument:
-                        initial_data[
-                            instrument.identification.isin
-                        ] = initial_data_func(instrument)
-            else:
-                for counter, isin in enumerate(isins):
-                    channel = next((x for x in self.__channels if x.isin == isin), None)
-                    if not channel:
-                        channel = InstrumentChannel(isin)
-                        self.__channels.append(channel)
-                        self._LOGGER.info("New channel for [%s]", isin)
-                    channel_action_func(client, channel)
-                    if instruments[counter]:
-                        initial_data[isin] = initial_data_func(instruments[counter])
-        return initial_data
+            for isin in isins:
+                if global_subscription_requested:
+                    channel = self.__global_channel
+                else:
+                    channel = self.__channels.get(isin)
+                if not channel:
+                    channel = InstrumentChannel(isin)
+                    self.__channels[isin] = channel
+                    self._LOGGER.info("New channel for [%s]", isin)
+                channel_action_func(client, channel)
+                self.__update_client_channels(client, channel)
+        session = self.__sessions.get(client)
+        self.__apply_options(session, message_parts, isins, options)
+        data = None
+        if action == "1":
+            data = self.initial_data(
+                session,
+                None if global_subscription_requested else isins,
+                subscription,
+                options,
+            )
+        # The resume point only holds for the instruments of the message carrying it
+        options.sequence = None
+        return data
+
+    def initial_data(
+        self,
+        session: ClientSession,
+        isins: list[str],
+        subscription: str,
+        options: SubscriptionOptions = None,
+    ) -> str | bytes:
+        """
+        Encodes the subscribed data of the instruments, or of all instruments \
+        when no isins are given, replaying only the changes a resuming client missed
+        """
+        wire_format = session.options.wire_format if session else WireFormat.JSON
+        options = options if options else SubscriptionOptions()
+        sequence, orderbook_filter = options.sequence, options.orderbook_filter
+        if sequence:
+            changes = self.market_realtime_data.changes_since(sequence)
+            if changes is not None:
+                channels = SUBSCRIPTION_CHANNELS[subscription]
+                wanted = None if isins is None else set(isins)
+                return self.render_updates(
+                    {
+                        x: y
+                        for x, y in changes.items()
+                        if x[1] in channels and (wanted is None or x[0] in wanted)
+                    },
+                    wire_format,
+                    lambda _: orderbook_filter,
+                )
+            self._LOGGER.info("Sequence [%d] is too old to be replayed.", sequence)
+        if isins is None:
+            return self.payload_cache.global_snapshot(
+                subscription, wire_format, orderbook_filter
+            )
+        return self.payload_cache.snapshot(
+            self.market_realtime_data.get_instruments(isins),
+            subscription,
+            wire_format,
+            orderbook_filter,
+        )
 
     def get_channel_action_func(
         self, action: str, channel: str
@@ -409,43 +950,39 @@ class TsetmcWebsocket:
                 "trade": subscribe_trade,
                 "orderbook": subscribe_orderbook,
                 "clienttype": subscribe_clienttype,
+                "bars": subscribe_bars,
             },
             "0": {
                 "all": unsubscribe_all,
                 "trade": unsubscribe_trade,
                 "orderbook": unsubscribe_orderbook,
                 "clienttype": unsubscribe_clienttype,
+                "bars": unsubscribe_bars,
             },
         }
         return return_values[action][channel]
 
-    def get_initial_data_func(
-        self, action: str, channel: str
-    ) -> Callable[[Instrument], None]:
-        """Returns the method for getting the initial data after subscription"""
-        return_values = {
-            "1": {
-                "all": instrument_data_all,
-                "trade": instrument_data_trade,
-                "orderbook": instrument_data_orderbook,
-                "clienttype": instrument_data_clienttype,
-            },
-            "0": {
-                "all": lambda x: None,
-                "trade": lambda x: None,
-                "orderbook": lambda x: None,
-                "clienttype": lambda x: None,
-            },
-        }
-        return return_values[action][channel]
-
-    async def serve_websocket(self) -> None:
-        """Serves the websocket for the project"""
+    async def serve_websocket(self, end_time: time | datetime = None) -> None:
+        """Serves the websocket for the project until the market, or the given time, ends"""
         self._LOGGER.info(
             "Serving has started on [%s:%d].", self.websocket_host, self.websocket_port
         )
-        async with serve(
-            self.handle_connection, self.websocket_host, self.websocket_port
-        ):
-            await sleep_until(MARKET_END_TIME)
+        dispatcher = None
+        if self.settings.single_loop_dispatch:
+            self.market_realtime_data.attach_event_loop(asyncio.get_running_loop())
+            dispatcher = asyncio.create_task(
+                self.market_realtime_data.dispatch_updates()
+            )
+        try:
+            async with serve(
+                self.handle_connection,
+                self.websocket_host,
+                self.websocket_port,
+                reuse_port=self.settings.reuse_port,
+            ):
+                await sleep_until(end_time if end_time else MARKET_END_TIME)
+        finally:
+            if dispatcher:
+                self.market_realtime_data.detach_event_loop()
+                dispatcher.cancel()
         self._LOGGER.info("Serving has ended.")
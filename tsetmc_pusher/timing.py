@@ -7,17 +7,29 @@ MORNING_STARTUP_TIME: time = time(hour=7, minute=0, second=0)
 MARKET_START_TIME: time = time(hour=8, minute=30, second=0)
 MARKET_END_TIME: time = time(hour=15, minute=0, second=0)
 CRAWL_SLEEP_SECONDS: float = 0.5
+CRAWL_INTERVAL_MAX: float = 8.0
+CRAWL_INTERVAL_STEP: float = 0.05
+CRAWL_BACKOFF_FACTOR: float = 2.0
+CRAWL_REQUEST_RATE: float = 4.0
+CRAWL_PRIORITY_AGING: float = 1.0
+FULL_MARKET_WATCH_CYCLES: int = 20
+FULL_MARKET_WATCH_SECONDS: float = 30.0
 TRADE_DATA_TIMEOUT_MAX: float = 1.5
 TRADE_DATA_TIMEOUT_MIN: float = 0.5
-TRADE_DATA_TIMEOUT_STEP: float = 0.25
 CLIENT_TYPE_TIMEOUT_MAX: float = 3.0
 CLIENT_TYPE_TIMEOUT_MIN: float = 0.5
-CLIENT_TYPE_TIMEOUT_STEP: float = 0.25
 
 
-async def sleep_until(wakeup_at: time) -> None:
-    """Sleep until appointed time"""
-    time_delta = datetime.combine(datetime.today(), wakeup_at) - datetime.now()
+def moment_of(appointed: time | datetime) -> datetime:
+    """Returns the moment of an appointed time of today, or of a given moment"""
+    if isinstance(appointed, datetime):
+        return appointed
+    return datetime.combine(datetime.today(), appointed)
+
+
+async def sleep_until(wakeup_at: time | datetime) -> None:
+    """Sleep until appointed time, of today unless a whole moment is given"""
+    time_delta = moment_of(wakeup_at) - datetime.now()
     await asyncio.sleep(time_delta.total_seconds())
 
 
@@ -0,0 +1,359 @@
+"""
+This module contains the wire formats shared by the pusher's server and client
+"""
+import functools
+import json
+import struct
+from operator import itemgetter
+from typing import Iterator
+from datetime import datetime, timedelta
+from enum import Enum
+
+
+class WireFormat(Enum):
+    """Identifies the encoding of the frames sent to a client"""
+
+    JSON = "json"
+    BINARY = "binary"
+
+
+BINARY_VERSION: int = 2
+# Frames hold blocks of records sharing the same layout, each decoded in one pass
+FRAME_HEADER = struct.Struct("<BIQ")
+BLOCK_HEADER = struct.Struct("<I")
+SEQUENCE_KEY: str = "_"
+# Frames may carry the microsecond wall clock times of the stages they went through
+TIMING_FLAG: int = 0x80
+TIMING_HEADER = struct.Struct("<qqqq")
+TIMING_KEY: str = "@"
+TIMING_STAGES: tuple[str, ...] = (
+    "scrape_started",
+    "scrape_received",
+    "applied",
+    "pushed",
+)
+RECORD_HEADER = struct.Struct("<12sBH")
+ISIN_SIZE: int = 12
+ORDERBOOK_HEADER = struct.Struct("<BBB")
+ORDERBOOK_ALL_FIELDS: int = 0b111111
+# Each orderbook row holds these fields of the demand side, then of the supply side
+ORDERBOOK_FIELD_NAMES: tuple[str, ...] = ("num", "price", "volume")
+CHANNEL_CODES: dict[str, int] = {
+    "thresholds": 1,
+    "trade": 2,
+    "orderbook": 3,
+    "clienttype": 4,
+    "bars": 5,
+}
+CHANNEL_NAMES: dict[int, str] = {y: x for x, y in CHANNEL_CODES.items()}
+CHANNEL_LENGTHS: dict[str, int] = {
+    "thresholds": 2,
+    "trade": 10,
+    "clienttype": 8,
+    "bars": 6,
+}
+BARS_HEADER = struct.Struct("<H")
+# Records of these channels hold rows, counted in a header following the record's
+ROWS_HEADERS: dict[int, struct.Struct] = {
+    CHANNEL_CODES["orderbook"]: ORDERBOOK_HEADER,
+    CHANNEL_CODES["bars"]: BARS_HEADER,
+}
+NULL_INT: int = -(2**31)
+NULL_LONG: int = -(2**63)
+NULL_BYTES: bytes = struct.pack("<i", NULL_INT)
+EPOCH: datetime = datetime(1970, 1, 1)
+
+
+@functools.lru_cache(maxsize=None)
+def _values_struct(formats: str) -> struct.Struct:
+    """Returns the compiled layout of some values"""
+    return struct.Struct("<" + formats)
+
+
+@functools.lru_cache(maxsize=None)
+def _value_formats(widths_mask: int, count: int) -> str:
+    """Returns the formats of some values, the mask marking the 8-byte ones"""
+    return "".join("q" if widths_mask >> x & 1 else "i" for x in range(count))
+
+
+def _widths_mask(values: list[int]) -> int:
+    """Marks the values that do not fit in 4 bytes"""
+    mask = 0
+    for index, value in enumerate(values):
+        if value is not None and not NULL_INT < value < -NULL_INT:
+            mask |= 1 << index
+    return mask
+
+
+def _pack_values(values: list[int], widths_mask: int) -> bytes:
+    """Packs nullable values, each in the width given by the mask"""
+    return _values_struct(_value_formats(widths_mask, len(values))).pack(
+        *(
+            (NULL_LONG if widths_mask >> x & 1 else NULL_INT) if y is None else y
+            for x, y in enumerate(values)
+        )
+    )
+
+
+def _unpack_values(raw: tuple[int]) -> list[int]:
+    """Maps the null sentinels of unpacked values back to missing values"""
+    if NULL_INT in raw or NULL_LONG in raw:
+        return [None if x in (NULL_INT, NULL_LONG) else x for x in raw]
+    return list(raw)
+
+
+@functools.lru_cache(maxsize=2**16)
+def _epoch_datetime(seconds: int) -> datetime:
+    """Returns the moment of some seconds since the epoch, shared by many trades"""
+    return None if seconds is None else EPOCH + timedelta(seconds=seconds)
+
+
+def orderbook_fields_mask(names: list[str]) -> int:
+    """Selects the named fields on both sides of the orderbook rows"""
+    mask = 0
+    for name in names:
+        if name not in ORDERBOOK_FIELD_NAMES:
+            raise ValueError(f"Unknown orderbook field [{name}]")
+        index = ORDERBOOK_FIELD_NAMES.index(name)
+        mask |= 1 << index | 1 << (index + len(ORDERBOOK_FIELD_NAMES))
+    return mask
+
+
+@functools.lru_cache(maxsize=None)
+def orderbook_field_indexes(fields_mask: int) -> tuple[int, ...]:
+    """Returns the indexes, within a row's values, of the fields selected by a mask"""
+    return tuple(
+        x for x in range(ORDERBOOK_ALL_FIELDS.bit_length()) if fields_mask >> x & 1
+    )
+
+
+def project_orderbook_rows(rows: list[list[int]], fields_mask: int) -> list[list[int]]:
+    """Keeps the row number and only the fields selected by the mask of each row"""
+    if fields_mask == ORDERBOOK_ALL_FIELDS:
+        return rows
+    indexes = orderbook_field_indexes(fields_mask)
+    return [[row[0]] + [row[x + 1] for x in indexes] for row in rows]
+
+
+def encode_record(
+    isin: str, channel: str, data: list, fields_mask: int = ORDERBOOK_ALL_FIELDS
+) -> bytes:
+    """
+    Encodes a single channel's data of an instrument into a binary record, \
+    orderbook rows only holding the fields selected by the mask
+    """
+    match channel:
+        case "orderbook":
+            return RECORD_HEADER.pack(
+                isin.encode("ascii"), CHANNEL_CODES[channel], 0
+            ) + encode_orderbook_body(data, fields_mask)
+        case "bars":
+            widths_mask = 0
+            for row in data:
+                widths_mask |= _widths_mask(row)
+            return (
+                RECORD_HEADER.pack(
+                    isin.encode("ascii"), CHANNEL_CODES[channel], widths_mask
+                )
+                + BARS_HEADER.pack(len(data))
+                + b"".join(_pack_values(x, widths_mask) for x in data)
+            )
+        case "trade":
+            data = list(data)
+            if data[2] is not None:
+                data[2] = int((data[2] - EPOCH).total_seconds())
+        case "thresholds" | "clienttype":
+            pass
+        case _:
+            raise ValueError(f"Unknown channel [{channel}]")
+    widths_mask = _widths_mask(data)
+    return RECORD_HEADER.pack(
+        isin.encode("ascii"), CHANNEL_CODES[channel], widths_mask
+    ) + _pack_values(data, widths_mask)
+
+
+def encode_orderbook_body(rows: list[list[int]], fields_mask: int) -> bytes:
+    """Encodes orderbook rows that only hold the fields selected by the mask"""
+    widths_mask = 0
+    for row in rows:
+        widths_mask |= _widths_mask(row[1:])
+    return ORDERBOOK_HEADER.pack(len(rows), fields_mask, widths_mask) + b"".join(
+        bytes((row[0],)) + _pack_values(row[1:], widths_mask) for row in rows
+    )
+
+
+def _layout_size(code: int) -> int:
+    """Returns the size of the headers following an ISIN, which lay out the values"""
+    rows_header = ROWS_HEADERS.get(code)
+    return RECORD_HEADER.size - ISIN_SIZE + (rows_header.size if rows_header else 0)
+
+
+def encode_frame(
+    records: list[bytes], sequence: int = 0, timing: tuple[int, ...] = None
+) -> bytes:
+    """
+    Joins binary records into a single frame, optionally stamped with timing, \
+    grouping the records of the same layout into blocks that hold the layout once, \
+    then the instruments and then the values of their records
+    """
+    blocks: dict[bytes, tuple[list[bytes], list[bytes]]] = {}
+    for record in records:
+        size = ISIN_SIZE + _layout_size(record[ISIN_SIZE])
+        key = record[ISIN_SIZE:size]
+        block = blocks.get(key)
+        if block is None:
+            block = blocks[key] = ([], [])
+        block[0].append(record[:ISIN_SIZE])
+        block[1].append(record[size:])
+    if timing is None:
+        header = FRAME_HEADER.pack(BINARY_VERSION, len(blocks), sequence)
+    else:
+        header = FRAME_HEADER.pack(
+            BINARY_VERSION | TIMING_FLAG, len(blocks), sequence
+        ) + TIMING_HEADER.pack(*timing)
+    return header + b"".join(
+        BLOCK_HEADER.pack(len(x)) + y + b"".join(x) + b"".join(z)
+        for y, (x, z) in blocks.items()
+    )
+
+
+def stamp_sequence(payload: str | bytes, sequence: int) -> str | bytes:
+    """Adds a sequence number to an already encoded JSON or binary frame"""
+    if isinstance(payload, str):
+        return f'{{"{SEQUENCE_KEY}": {sequence}, {payload[1:]}'
+    frame = bytearray(payload)
+    version, count, _ = FRAME_HEADER.unpack_from(frame, 0)
+    FRAME_HEADER.pack_into(frame, 0, version, count, sequence)
+    return bytes(frame)
+
+
+def stamp_timing(payload: str | bytes, timing: tuple[int, ...]) -> str | bytes:
+    """Adds the times of the timing stages to an already encoded frame"""
+    if isinstance(payload, str):
+        return f'{{"{TIMING_KEY}": [{", ".join(map(str, timing))}], {payload[1:]}'
+    version, count, sequence = FRAME_HEADER.unpack_from(payload, 0)
+    body = FRAME_HEADER.size + (TIMING_HEADER.size if version & TIMING_FLAG else 0)
+    return (
+        FRAME_HEADER.pack(version | TIMING_FLAG, count, sequence)
+        + TIMING_HEADER.pack(*timing)
+        + payload[body:]
+    )
+
+
+def decode_message(message: str | bytes) -> dict[str, dict[str, list]]:
+    """Decodes a JSON or binary frame received from the pusher"""
+    if isinstance(message, bytes):
+        return decode_frame(message)
+    return json.loads(message)
+
+
+def decode_frame_header(
+    payload: bytes, offset: int = 0
+) -> tuple[int, int, list[int], int]:
+    """Decodes the block count, sequence and timing of a frame and its blocks' offset"""
+    version, count, sequence = FRAME_HEADER.unpack_from(payload, offset)
+    if version & ~TIMING_FLAG != BINARY_VERSION:
+        raise ValueError(f"Unsupported binary frame version [{version}]")
+    offset += FRAME_HEADER.size
+    timing = None
+    if version & TIMING_FLAG:
+        timing = list(TIMING_HEADER.unpack_from(payload, offset))
+        offset += TIMING_HEADER.size
+    return count, sequence, timing, offset
+
+
+def decode_frame(payload: bytes) -> dict[str, dict[str, list]]:
+    """Decodes a binary frame into the same shape as a JSON frame"""
+    count, sequence, timing, offset = decode_frame_header(payload)
+    result: dict[str, dict[str, list]] = {SEQUENCE_KEY: sequence} if sequence else {}
+    if timing:
+        result[TIMING_KEY] = timing
+    for _ in range(count):
+        channel, isins, values, offset = decode_block(payload, offset)
+        for isin, data in zip(isins, values):
+            channels = result.get(isin)
+            if channels is None:
+                result[isin] = {channel: data}
+            else:
+                channels[channel] = data
+    return result
+
+
+def iter_records(
+    payload: bytes, offset: int, count: int, decode: bool = True
+) -> Iterator[tuple[str, str, list]]:
+    """Iterates over the records of a frame's blocks, only naming them when not decoding"""
+    for _ in range(count):
+        channel, isins, values, offset = decode_block(payload, offset, decode)
+        yield from zip(isins, (channel,) * len(isins), values or (None,) * len(isins))
+
+
+@functools.lru_cache(maxsize=None)
+def _block_layout(key: bytes) -> tuple[str, struct.Struct, int]:
+    """
+    Returns the channel and the compiled layout of a block's records, \
+    or of their rows along with the number of rows in each record
+    """
+    code, widths_mask = key[0], int.from_bytes(key[1:3], "little")
+    channel = CHANNEL_NAMES[code]
+    match channel:
+        case "orderbook":
+            row_count, fields_mask, widths_mask = ORDERBOOK_HEADER.unpack(key[3:])
+            return (
+                channel,
+                _values_struct(
+                    "B" + _value_formats(widths_mask, fields_mask.bit_count())
+                ),
+                row_count,
+            )
+        case "bars":
+            (row_count,) = BARS_HEADER.unpack(key[3:])
+            return (
+                channel,
+                _values_struct(_value_formats(widths_mask, CHANNEL_LENGTHS[channel])),
+                row_count,
+            )
+    return (
+        channel,
+        _values_struct(_value_formats(widths_mask, CHANNEL_LENGTHS[channel])),
+        None,
+    )
+
+
+def decode_block(
+    payload: bytes, offset: int, decode: bool = True
+) -> tuple[str, list[str], list[list], int]:
+    """
+    Decodes the instruments and the values of a block's records in one pass \
+    and returns the next offset, only reading the instruments when not decoding
+    """
+    (count,) = BLOCK_HEADER.unpack_from(payload, offset)
+    offset += BLOCK_HEADER.size
+    size = _layout_size(payload[offset])
+    channel, values_struct, row_count = _block_layout(payload[offset : offset + size])
+    offset += size
+    end = offset + ISIN_SIZE * count
+    names = payload[offset:end].decode("ascii")
+    isins = [names[x : x + ISIN_SIZE] for x in range(0, len(names), ISIN_SIZE)]
+    offset = end
+    end += values_struct.size * count * (1 if row_count is None else row_count)
+    if not decode:
+        return channel, isins, None, end
+    chunk = payload[offset:end]
+    values = list(map(list, values_struct.iter_unpack(chunk)))
+    # Only the blocks that may hold a null sentinel are checked value by value
+    if NULL_BYTES in chunk:
+        values = [
+            x if NULL_INT not in x and NULL_LONG not in x else _unpack_values(x)
+            for x in values
+        ]
+    if row_count is not None:
+        if not row_count:
+            return channel, isins, [[] for _ in isins], end
+        values = [values[x : x + row_count] for x in range(0, len(values), row_count)]
+    elif channel == "trade":
+        for data, moment in zip(
+            values, map(_epoch_datetime, map(itemgetter(2), values))
+        ):
+            data[2] = moment
+    return channel, isins, values, end